@@ -1,73 +1,327 @@
+import time
 import streamlit as st
-from tools import generate_summary, generate_flashcards, generate_quiz_questions
-from utils import moderate_text, get_pdf_text, get_vectorstore
-from langchain.chains import RetrievalQA
+from commons import (
+    get_embedding, get_text_splitter, STREAM_ANSWERS, MODERATION_OVERLAP, ANSWER_CACHE_ENABLED,
+    CHAT_WINDOW_MESSAGES, CHAT_PAGE_MESSAGES,
+)
+from moderation import moderate_text, start_moderation
+from tracing import add_token_usage, record_span, span
+from jobs import get_job_runner, partial_results
+from retrieval import default_settings, get_retriever, pack_context, settings_key
+from registry import get_index_registry
+from records import flashcard_records, question_records
+from cache import (
+    file_hash, ingest_cache_key, load_ingest, save_ingest, load_pack, get_result_cache, get_answer_cache,
+    get_query_embeddings,
+)
 
-def process_uploaded_pdfs(pdf_docs, text_splitter):
-    """Handles PDF upload, processing, and vector storage."""
+# tools.py, utils.py (LangChain chains, FAISS, PyPDF2) and langchain.chains are imported by the
+# functions that use them, on the first upload, generation or question, so the first page load
+# doesn't wait for them
+
+def build_index_for(uploads, text_splitter, cache_key, base=None):
+    """Builds (vectorstore, indexed_files, text_chunks, lexical_index) for the uploads ({file hash: pdf}).
+
+    With a `base` registry entry, only the difference to it is chunked and embedded, on a copy,
+    since other sessions may be attached to the base. Either way the result is stored in the ingest
+    cache under `cache_key`.
+    """
+    from utils import (
+        chunk_pdfs, chunk_ids, index_files, indexed_chunks, update_vectorstore, get_vectorstore, clone_vectorstore
+    )
+    from lexical import build_lexical_index
+    # Same PDFs + splitter + embedding model were processed before (in full or incrementally): load them from disk
+    cached = load_ingest(cache_key, get_embedding())
+    if cached:
+        documents, vectorstore = cached
+        indexed_files = index_files(documents, chunk_ids(documents))
+    elif base is not None:
+        vectorstore = clone_vectorstore(base["vectorstore"])
+        indexed_files = {file_hash: dict(entry) for file_hash, entry in base["indexed_files"].items()}
+        # Only embed added files and delete removed ones, the rest of the index is kept
+        added, removed = update_vectorstore(vectorstore, indexed_files, uploads, text_splitter)
+        print(f"Index updated: {added} file(s) added, {removed} file(s) removed")
+        # Stored like a full build, so the set survives a registry eviction or a restart
+        documents = [vectorstore.docstore.search(id_) for entry in indexed_files.values() for id_ in entry["ids"]]
+        save_ingest(cache_key, documents, vectorstore)
+    elif not uploads:
+        raise LookupError("The documents are no longer in the ingest cache")  # See restore_session_index()
+    else:
+        documents = chunk_pdfs(uploads.values(), text_splitter)  # Use passed splitter
+        ids = chunk_ids(documents)
+        vectorstore = get_vectorstore(documents, ids)
+        save_ingest(cache_key, documents, vectorstore)
+        indexed_files = index_files(documents, ids)
+    # The BM25 index is rebuilt from the chunks rather than cached; it takes a fraction of embedding time
+    lexical_index = build_lexical_index(vectorstore, indexed_files)
+    return vectorstore, indexed_files, indexed_chunks(vectorstore, indexed_files), lexical_index
+
+def ingest_pdfs(pdf_docs, text_splitter, session_id, current_key=None) -> dict:
+    """Attaches the session to the shared index of the uploads, building it if no session has yet.
+
+    Runs as a background job, so it must not touch st.* and returns the new session values.
+    """
+    with span("process_uploads", files=len(pdf_docs)) as attributes:
+        uploads = {file_hash(pdf): pdf for pdf in pdf_docs}  # Same file uploaded twice is indexed once
+        cache_key = ingest_cache_key(uploads.values(), text_splitter)
+        registry = get_index_registry()
+        base = registry.get(current_key) if current_key and current_key != cache_key else None
+
+        builds_before = registry.builds
+        entry = registry.acquire(
+            cache_key, session_id, lambda: build_index_for(uploads, text_splitter, cache_key, base)
+        )
+        attributes["shared"] = registry.builds == builds_before
+        if current_key and current_key != cache_key:
+            registry.release(current_key, session_id)
+
+        return {
+            "index_key": cache_key,
+            "vectorstore": entry["vectorstore"],
+            "indexed_files": entry["indexed_files"],
+            "text_chunks": entry["text_chunks"],
+            "lexical_index": entry["lexical_index"],
+        }
+
+def restore_session_index():
+    """Reattaches a session that lost its index references (spilled while idle, see sessions.py) to
+    its documents: the shared index if another session kept it loaded, else the ingest cache."""
+    index_key = st.session_state.get("index_key")
+    if index_key is None or "vectorstore" in st.session_state:
+        return
+    session_id = st.session_state.session_id
+    try:
+        entry = get_index_registry().acquire(index_key, session_id, lambda: build_index_for({}, None, index_key))
+    except Exception as e:
+        print(f"Could not restore the index of session {session_id}: {e}")
+        for key in ["index_key", "indexed_files"]:
+            st.session_state.pop(key, None)
+        st.info("Your documents were unloaded while you were away. Please process them again.")
+        return
+    st.session_state.vectorstore = entry["vectorstore"]
+    st.session_state.indexed_files = entry["indexed_files"]
+    st.session_state.text_chunks = entry["text_chunks"]
+    st.session_state.lexical_index = entry["lexical_index"]
+
+def process_uploaded_pdfs(pdf_docs):
+    """Handles PDF upload; processing and vector storage run as a background job."""
     if not pdf_docs:
         return  # Do nothing if no PDFs uploaded
 
-    process_button_disabled = not pdf_docs  # Disable processing if no PDFs
+    # Disable processing if no PDFs or while the previous upload is still being processed
+    process_button_disabled = not pdf_docs or is_job_running("ingest")
     if st.button("Process", disabled=process_button_disabled):
-        with st.spinner("Processing..."):
-            raw_text = get_pdf_text(pdf_docs)
-            text_chunks = text_splitter.split_text(raw_text)  # Use passed splitter
-            vectorstore = get_vectorstore(text_chunks)
-            
-            # Store results in session state
-            st.session_state.vectorstore = vectorstore
-            st.session_state.text_chunks = text_chunks  
-            
-            st.success("Documents processed!")
-
-def generate_and_store_summary(text_chunks, model):
-    """Generates and stores the summary with error handling in one function."""
-    try:
-        # Step 1: Check if text_chunks is available
-        if not text_chunks:
-            raise ValueError("No text chunks available for summarization.")
-        
-        # Step 2: Generate summary using the tool
-        summary = generate_summary.invoke({"text_chunks": text_chunks, "model": model})
-
-        # Step 3: Store the summary in session state
-        st.session_state.summary = summary
-        st.success("Summary Generated!")  # Notify the user
-
-    except ValueError as e:
-        st.error(f"Error: {e}")  # Handle missing text_chunks error
-    except Exception as e:
-        st.error(f"An error occurred during summarization: {e}")  # Handle other exceptions
+        start_job(
+            "ingest", ingest_pdfs, list(pdf_docs), get_text_splitter(),
+            st.session_state.session_id, st.session_state.get("index_key"),
+        )
 
+def show_run_stats(label):
+    """Shows wall-clock and per-chunk latency of the generation job that just finished, and how its
+    chunks were packed into requests."""
+    stats = st.session_state.get("run_stats", {}).get(label)
+    if stats:
+        st.caption(
+            f"{stats['chunks']} requests in {stats['wall_clock_s']:.1f}s "
+            f"(concurrency {stats['max_concurrency']}, p50 request {stats['p50_chunk_s']:.1f}s, "
+            f"slowest request {stats['max_chunk_s']:.1f}s, {stats.get('cache_hits', 0)} chunks from cache, "
+            f"cache hit rate {get_result_cache().stats()['hit_rate']:.0%})"
+        )
+    if stats and stats.get("packed_chunks"):
+        st.caption(
+            f"{stats['packed_chunks']} chunks packed into {stats['packed_chunks'] - stats['requests_saved']} requests "
+            f"(filled to {stats['fill_ratio']:.0%} of the token budget), "
+            f"{stats['prompt_tokens_saved']} prompt tokens saved"
+        )
 
-def generate_and_store_flashcards(text_chunks, model):
-    try:
-        flashcards = []
-        for chunk in text_chunks:
-            new_flashcards = generate_flashcards.invoke({"text_chunks": [chunk], "model": model})
-            flashcards.extend(new_flashcards)
+def start_job(kind, fn, *args):
+    """Runs fn(*args) as a background job of this session; the result is stored by collect_finished_jobs()."""
+    job = get_job_runner().submit(kind, st.session_state.session_id, fn, *args)
+    st.session_state.setdefault("jobs", {})[kind] = job.id
+    st.session_state[f"generating_{kind}"] = True
+    return job
 
-        st.session_state.flashcards = flashcards
-        st.success(f"✅ Flashcards Generated: {len(flashcards)}")
-    except Exception as e:
-        st.error(f"❌ An error occurred during flashcard generation: {e}")
+def get_session_jobs():
+    """Returns this session's jobs as {kind: Job}, skipping ids the runner no longer knows."""
+    runner = get_job_runner()
+    jobs = {}
+    for kind, job_id in st.session_state.get("jobs", {}).items():
+        job = runner.get(job_id)
+        if job is not None:
+            jobs[kind] = job
+    return jobs
 
+def is_job_running(kind):
+    job = get_session_jobs().get(kind)
+    return job is not None and not job.finished
 
+def cancel_job(kind):
+    job = get_session_jobs().get(kind)
+    if job is not None:
+        job.cancel()
 
-def generate_and_store_quiz(text_chunks, model):
-    try:
-        quiz_questions = generate_quiz_questions.invoke({"text_chunks": text_chunks, "model": model})
+def load_study_packs(kind, model):
+    """The pre-generated `kind` ("summary", "flashcards" or "quiz") of this session's documents, if
+    batch.py wrote packs for all of them with the current settings; otherwise None."""
+    from tools import pack_settings
+    text_splitter = get_text_splitter()
+    indexed_files = st.session_state.get("indexed_files") or {}
+    packs = [load_pack(file_hash) for file_hash in indexed_files]
+    if not packs or any(
+        pack is None or kind not in pack
+        or pack.get("settings") != pack_settings(model, text_splitter, len(entry["ids"]))
+        for pack, entry in zip(packs, indexed_files.values())
+    ):
+        return None
+    if kind == "summary":
+        if len(packs) == 1:
+            return packs[0]["summary"]
+        return "\n\n".join(f"**{pack['source']}**\n\n{pack['summary']}" for pack in packs)
+    records = flashcard_records if kind == "flashcards" else question_records
+    return [record for pack in packs for record in records(pack[kind])]
 
-        # Store all types of questions
-        st.session_state.quiz_questions = quiz_questions  
-        st.session_state.current_question = 0  # Initialize question index
-        st.session_state.score = 0  # Initialize score
-        st.session_state.submitted = False  # Track question submission
+def pack_job(result):
+    # Pre-generated results still go through a job, so they are stored and announced like generated ones
+    return result
 
-        st.success(f"{len(quiz_questions)} Quiz questions generated!")
-    except Exception as e:
-        st.error(f"An error occurred during quiz question generation: {e}")
+def generate_and_store_summary(text_chunks, model, regenerate=False):
+    """Starts summary generation in the background; store_summary() picks up the result."""
+    packed = None if regenerate else load_study_packs("summary", model)
+    if packed is not None:
+        return start_job("summary", pack_job, packed)
+    return start_job("summary", summary_job, text_chunks, model, regenerate)
+
+def summary_job(text_chunks, model, regenerate):
+    from tools import generate_summary
+    # Step 1: Check if text_chunks is available
+    if not text_chunks:
+        raise ValueError("No text chunks available for summarization.")
+
+    # Step 2: Generate summary using the tool
+    return generate_summary.invoke({"text_chunks": text_chunks, "model": model, "regenerate": regenerate})
+
+def store_summary(summary):
+    # Step 3: Store the summary in session state
+    st.session_state.summary = summary
+    st.success("Summary Generated!")  # Notify the user
+
+
+def generate_and_store_flashcards(text_chunks, model, regenerate=False):
+    """Starts flashcard generation in the background; store_flashcards() picks up the result."""
+    packed = None if regenerate else load_study_packs("flashcards", model)
+    if packed is not None:
+        return start_job("flashcards", pack_job, packed)
+    return start_job("flashcards", flashcards_job, text_chunks, model, regenerate)
+
+def flashcards_job(text_chunks, model, regenerate):
+    # Cards are appended as chunks finish, so the student can start before the slowest chunk returns
+    flashcards = partial_results()
+    from tools import iter_flashcards
+    for items in iter_flashcards(text_chunks, model, regenerate=regenerate):
+        flashcards.extend(flashcard_records(items))
+    return flashcards
+
+def show_partial_flashcards(flashcards):
+    # The list keeps growing while the job runs, display_flashcards() reads its current length
+    st.session_state.flashcards = flashcards
+    for key in ["current_flashcard", "reveal_answer"]:
+        st.session_state.pop(key, None)
+
+def store_flashcards(flashcards):
+    if st.session_state.get("flashcards") is not flashcards:
+        show_partial_flashcards(flashcards)
+    st.success(f"✅ Flashcards Generated: {len(flashcards)}")
+    show_run_stats("flashcards")
+
+
+def generate_and_store_quiz(text_chunks, model, regenerate=False):
+    """Starts quiz generation in the background; store_quiz() picks up the result."""
+    packed = None if regenerate else load_study_packs("quiz", model)
+    if packed is not None:
+        return start_job("quiz", pack_job, packed)
+    return start_job("quiz", quiz_job, text_chunks, model, regenerate)
+
+def quiz_job(text_chunks, model, regenerate):
+    quiz_questions = partial_results()
+    from tools import iter_quiz_questions
+    for items in iter_quiz_questions(text_chunks, model, regenerate=regenerate):
+        quiz_questions.extend(question_records(items))
+    return quiz_questions
+
+def show_partial_quiz(quiz_questions):
+    # Store all types of questions (the list keeps growing while the job runs)
+    st.session_state.quiz_questions = quiz_questions
+    st.session_state.current_question = 0  # Initialize question index
+    st.session_state.score = 0  # Initialize score
+    st.session_state.submitted = False  # Track question submission
+
+def store_quiz(quiz_questions):
+    # Keep the student's place if they already started on the partial quiz
+    if st.session_state.get("quiz_questions") is not quiz_questions:
+        show_partial_quiz(quiz_questions)
+
+    st.success(f"{len(quiz_questions)} Quiz questions generated!")
+    show_run_stats("questions")
+
+def store_ingest(result):
+    # Store results in session state (shared with other sessions that uploaded the same PDFs)
+    st.session_state.index_key = result["index_key"]
+    st.session_state.vectorstore = result["vectorstore"]
+    st.session_state.indexed_files = result["indexed_files"]
+    st.session_state.text_chunks = result["text_chunks"]
+    st.session_state.lexical_index = result["lexical_index"]
+    st.success("Documents processed!")
+
+# Shown next to the job's progress bar
+JOB_LABELS = {"ingest": "Processing documents", "summary": "Summary", "flashcards": "Flashcards", "quiz": "Quiz"}
+
+# How a finished job's result is handed into session state, and how its failure is reported
+JOB_HANDLERS = {
+    "ingest": (store_ingest, "An error occurred while processing the documents: {}"),
+    "summary": (store_summary, "An error occurred during summarization: {}"),
+    "flashcards": (store_flashcards, "❌ An error occurred during flashcard generation: {}"),
+    "quiz": (store_quiz, "An error occurred during quiz question generation: {}"),
+}
+
+# Jobs whose items can be used before the job finishes, and how they are handed over
+PARTIAL_HANDLERS = {"flashcards": show_partial_flashcards, "quiz": show_partial_quiz}
+
+def has_undelivered_items(kind, job):
+    """True if a running job produced its first items and they weren't handed to the display yet."""
+    return kind in PARTIAL_HANDLERS and bool(job.partial) and st.session_state.get(f"{kind}_delivered") != job.id
+
+def collect_finished_jobs():
+    """Hands the results of this session's finished jobs into session state (runs on the script thread).
+
+    Flashcards and quiz questions are handed over as soon as the first chunk is done.
+    """
+    runner = get_job_runner()
+    for kind, job in get_session_jobs().items():
+        if not job.finished:
+            if has_undelivered_items(kind, job):
+                PARTIAL_HANDLERS[kind](job.partial)
+                st.session_state[f"{kind}_delivered"] = job.id  # Only once, so exiting the review sticks
+            continue
+        store, error_message = JOB_HANDLERS[kind]
+        if job.status == "done":
+            st.session_state.run_stats = job.stats  # Read by show_run_stats() in the handler
+            store(job.result)
+        elif job.status == "failed":
+            if isinstance(job.error, ValueError):
+                st.error(f"Error: {job.error}")  # Handle missing text_chunks error
+            else:
+                st.error(error_message.format(job.error))
+        else:
+            st.info(f"{JOB_LABELS[kind]} cancelled.")
+        runner.forget(job.id)
+        del st.session_state.jobs[kind]
+        st.session_state[f"generating_{kind}"] = False
+
+    # Jobs the runner already dropped can't report back anymore
+    for kind in list(st.session_state.get("jobs", {})):
+        if runner.get(st.session_state.jobs[kind]) is None:
+            del st.session_state.jobs[kind]
+            st.session_state[f"generating_{kind}"] = False
 
 
 # Checker for flashcards and quiz, for the user to not be able to chat with the bot while taking the flashcards and quiz
@@ -95,17 +349,159 @@ def initialize_chat_history():
         st.session_state.chat_started = False
 
 def display_chat_history():
-    """Display chat messages from history."""
-    for message in st.session_state.messages:
+    """Display the latest chat messages; older ones stay collapsed until the student asks for them,
+    so reruns of a long chat don't render the whole history."""
+    messages = st.session_state.messages
+    shown = st.session_state.get("chat_shown", CHAT_WINDOW_MESSAGES)
+    if CHAT_WINDOW_MESSAGES and len(messages) > shown:
+        if st.button(f"Show earlier messages ({len(messages) - shown} hidden)", key="show_earlier_messages"):
+            st.session_state.chat_shown = shown + CHAT_PAGE_MESSAGES
+            st.rerun()
+        messages = messages[-shown:]
+    for message in messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
+def get_retrieval_settings():
+    """This session's retrieval settings (mode, k, filters, context budget), see retrieval.py."""
+    if "retrieval_settings" not in st.session_state:
+        st.session_state.retrieval_settings = default_settings()
+    return st.session_state.retrieval_settings
+
+def get_qa_chain(vectorstore, model, settings, lexical_index=None):
+    """Returns the session's QA chain, building it only when the vectorstore or retrieval settings changed.
+
+    Incremental updates modify the vectorstore in place, which the retriever already sees.
+    """
+    from langchain.chains import RetrievalQA
+    cached = st.session_state.get("qa_chain")
+    key = settings_key(settings)
+    if (
+        cached and cached["vectorstore"] is vectorstore and cached["lexical_index"] is lexical_index
+        and cached["model"] is model and cached["settings"] == key
+    ):
+        return cached["chain"]
+
+    retriever = get_retriever(vectorstore, settings, lexical_index)
+    chain = RetrievalQA.from_chain_type(llm=model, chain_type="stuff", retriever=retriever)
+    st.session_state.qa_chain = {
+        "vectorstore": vectorstore, "lexical_index": lexical_index, "model": model, "settings": key, "chain": chain,
+    }
+    return chain
+
+def stream_answer(user_input, docs, model, turn_start, mode=None):
+    """Streams the answer for already retrieved docs, with the same prompt as the "stuff" QA chain."""
+    from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
+    prompt = PROMPT_SELECTOR.get_prompt(model)
+    context = "\n\n".join(doc.page_content for doc in docs)
+    chain = prompt | model
+
+    stream_start = time.time()
+    attributes = {"bytes": len(context), "mode": mode}
+    first_token_at = None
+    for chunk in chain.stream({"context": context, "question": user_input}):
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+            attributes["time_to_first_token_ms"] = (first_token_at - turn_start) * 1000
+            print(f"Time to first token: {first_token_at - turn_start:.2f}s")
+        add_token_usage(attributes, chunk)
+        yield chunk.content
+
+    print(f"Answer streamed in {time.perf_counter() - turn_start:.2f}s")
+    record_span("llm.chat", stream_start, time.time(), attributes)
+
+def retrieve(qa_chain, user_input, settings):
+    """Retrieves chunks for the question and trims them to the context token budget."""
+    with span("retrieval", mode=settings["mode"]) as attributes:
+        docs = qa_chain.retriever.invoke(user_input)
+        packed = pack_context(docs, settings["context_token_budget"])
+        attributes["docs"] = len(docs)
+        attributes["packed_docs"] = len(packed)
+    return packed
+
+def fast_path_retrieve(qa_chain, user_input, settings):
+    """The packed chunks of a confident lexical match (hybrid mode), found without embedding the
+    question; None if there is none. Such questions skip the answer cache, which needs the embedding."""
+    confident_documents = getattr(qa_chain.retriever, "confident_documents", None)
+    if confident_documents is None:
+        return None
+    start = time.time()
+    docs = confident_documents(user_input)
+    if docs is None:
+        return None
+    packed = pack_context(docs, settings["context_token_budget"])
+    record_span("retrieval", start, time.time(), {
+        "mode": settings["mode"], "docs": len(docs), "packed_docs": len(packed), "fast_path": True,
+    })
+    return packed
+
+def answer_cache_scope(settings, model):
+    """Cached answers are only reused for the same documents, retrieval settings and model.
+    Returns None when the answer cache is off or bypassed for this session."""
+    index_key = st.session_state.get("index_key")
+    if not ANSWER_CACHE_ENABLED or st.session_state.get("bypass_answer_cache") or index_key is None:
+        return None
+    return index_key, settings_key(settings), getattr(model, "model_name", None)
+
+def lookup_cached_answer(scope, user_input):
+    """Returns (answer, question embedding); the answer is None on a miss."""
+    start = time.perf_counter()
+    with span("answer_cache") as attributes:
+        # Through the query embedding cache, so the retriever and a repeated question reuse the vector
+        vector = get_query_embeddings().embed_query(user_input, get_embedding())
+        hit = get_answer_cache().lookup(scope, vector, time.perf_counter() - start)
+        attributes["hit"] = hit is not None
+        if hit is None:
+            return None, vector
+        attributes["similarity"] = hit[1]
+    print(f"Answered from the answer cache (similarity {hit[1]:.3f}) in {time.perf_counter() - start:.3f}s")
+    return hit[0], vector
+
+def store_answer(scope, question_vector, answer, turn_start):
+    """Adds a freshly generated answer to the answer cache (if the question was looked up there)."""
+    if scope is not None and question_vector is not None and answer:
+        get_answer_cache().store(scope, question_vector, answer, time.perf_counter() - turn_start)
+
 def handle_user_input(user_input, model):
     """Process user input and generate a response using LLM."""
     if not user_input:
         return
 
-    if not moderate_text(user_input):  # Check if input is safe
+    settings = get_retrieval_settings()
+    qa_chain = get_qa_chain(st.session_state.vectorstore, model, settings, st.session_state.get("lexical_index"))
+    turn_start = time.perf_counter()
+
+    # Similar questions on the same documents are answered from the answer cache
+    scope = answer_cache_scope(settings, model)
+    cached_answer, question_vector = None, None
+
+    # In overlap mode moderation runs while the answer cache is checked and documents are
+    # retrieved, and the verdict is awaited before any answer is shown or LLM call made.
+    # A confident lexical match comes first: it needs no question embedding, the cache does
+    docs = None
+    if STREAM_ANSWERS and MODERATION_OVERLAP:
+        verdict = start_moderation(user_input)
+        try:
+            docs = fast_path_retrieve(qa_chain, user_input, settings)
+            if docs is None and scope is not None:
+                cached_answer, question_vector = lookup_cached_answer(scope, user_input)
+            if docs is None and cached_answer is None:
+                with st.spinner("Searching your documents..."):
+                    docs = retrieve(qa_chain, user_input, settings)
+        except Exception as e:
+            print(f"Error during retrieval: {e}")  # Retried below, after the verdict
+        is_safe = verdict.result()
+    else:
+        is_safe = moderate_text(user_input)
+        if is_safe:
+            try:
+                docs = fast_path_retrieve(qa_chain, user_input, settings)
+                if docs is None and scope is not None:
+                    cached_answer, question_vector = lookup_cached_answer(scope, user_input)
+            except Exception as e:
+                print(f"Error checking the answer cache: {e}")
+
+    if not is_safe:  # Check if input is safe
         st.warning("Your input was flagged as inappropriate. Please try again.")
         st.session_state.moderation_warning = True #set warning flag
         return
@@ -119,17 +515,43 @@ def handle_user_input(user_input, model):
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    vectorstore = st.session_state.vectorstore
-    qa_chain = RetrievalQA.from_chain_type(llm=model, chain_type="stuff", retriever=vectorstore.as_retriever())
+    if cached_answer is not None:
+        st.session_state.messages.append({"role": "assistant", "content": cached_answer})
+        with st.chat_message("assistant"):
+            st.markdown(cached_answer)
+        return
+
+    if STREAM_ANSWERS:
+        try:
+            # Retrieve first, then render tokens as they arrive
+            if docs is None:
+                with st.spinner("Searching your documents..."):
+                    docs = retrieve(qa_chain, user_input, settings)
+            print(f"Moderation and retrieval took {time.perf_counter() - turn_start:.2f}s")
+
+            with st.chat_message("assistant"):
+                answer = st.write_stream(stream_answer(user_input, docs, model, turn_start, settings["mode"]))
+
+            # Append LLM response
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+            store_answer(scope, question_vector, answer, turn_start)
+        except Exception as e:
+            st.error(f"Error generating answer: {e}")  # Handle LLM errors
+        return
 
     with st.spinner("Generating Answer..."):
         try:
-            answer_dict = qa_chain.invoke(user_input)
-            answer = answer_dict['result']
+            if docs is None:
+                docs = retrieve(qa_chain, user_input, settings)
+            with span("qa_chain", mode=settings["mode"]):
+                # Same "stuff" chain as qa_chain.invoke(), but with the packed chunks
+                answer_dict = qa_chain.combine_documents_chain.invoke({"input_documents": docs, "question": user_input})
+            answer = answer_dict['output_text']
 
             # Append LLM response
             st.session_state.messages.append({"role": "assistant", "content": answer})
             with st.chat_message("assistant"):
                 st.markdown(answer)
+            store_answer(scope, question_vector, answer, turn_start)
         except Exception as e:
             st.error(f"Error generating answer: {e}")  # Handle LLM errors
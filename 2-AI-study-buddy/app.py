@@ -1,28 +1,51 @@
+import uuid
 import streamlit as st
-from display import display_quiz, display_flashcards 
-from langchain.chains import RetrievalQA 
-from commons import init_model, init_moderation
-from langchain_text_splitters import TokenTextSplitter
+from display import (
+    display_quiz, display_flashcards, display_performance_panel, display_job_progress, display_retrieval_settings,
+)
+from commons import get_model, prewarm_tokenizer
+from tracing import set_session
+from registry import get_index_registry
+from sessions import session_run
 from actions import (
     generate_and_store_summary, 
     generate_and_store_flashcards, 
     generate_and_store_quiz, 
     is_activity_active, 
+    collect_finished_jobs,
+    get_session_jobs,
     initialize_chat_history, 
     display_chat_history, 
     handle_user_input, 
-    process_uploaded_pdfs
+    process_uploaded_pdfs,
+    restore_session_index,
 )
 
-# Initialize model & text splitter
-model = init_model()  
-moderation = init_moderation()
-text_splitter = TokenTextSplitter.from_tiktoken_encoder(model_name="gpt-4o-mini")
+# The tokenizer loads in the background while the first page renders; the API clients are built
+# on first use (get_model() etc. are shared by all sessions, built once per server process)
+prewarm_tokenizer()
 
 def main():
     st.set_page_config(page_title="Chatbot", page_icon=":books:")
     st.header("AI Study Buddy")
 
+    # Attribute this session's timing spans to it for the performance panel
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    set_session(st.session_state.session_id)
+
+    # Idle sessions are spilled to disk (sessions.py); this one's chat, study aids and index come
+    # back here, and it isn't spilled while the page below runs
+    with session_run(st.session_state.session_id):
+        restore_session_index()
+        show_page()
+
+def show_page():
+    """Everything below the header; the session's state is restored by now."""
+    # Keep this session attached to the shared index of its documents
+    if "index_key" in st.session_state:
+        get_index_registry().touch(st.session_state.index_key, st.session_state.session_id)
+
     initialize_chat_history()
     activity_active = is_activity_active()
 
@@ -30,50 +53,64 @@ def main():
     if "moderation_warning" not in st.session_state:
         st.session_state.moderation_warning = False
 
+    # Initialize session state flags
+    if "generating_ingest" not in st.session_state:
+        st.session_state.generating_ingest = False
+    if "generating_summary" not in st.session_state:
+        st.session_state.generating_summary = False
+    if "generating_quiz" not in st.session_state:
+        st.session_state.generating_quiz = False
+    if "generating_flashcards" not in st.session_state:
+        st.session_state.generating_flashcards = False
+
     with st.sidebar:
         st.subheader("Your documents")
         st.write("Upload your PDFs here")
 
         pdf_docs = st.file_uploader(" ", accept_multiple_files=True)
-        process_uploaded_pdfs(pdf_docs, text_splitter)
+        process_uploaded_pdfs(pdf_docs)
+
+        # Results of background jobs that finished since the last rerun, then live progress of the rest
+        collect_finished_jobs()
+        if get_session_jobs():
+            display_job_progress()
 
         st.markdown("---")  # Divider for separation
         st.subheader("Actions")
         st.container()
         col1, col2 = st.columns(2)
+        regenerate = st.checkbox("Regenerate (ignore cached results)", key="regenerate")
 
-        # Initialize session state flags
-        if "generating_summary" not in st.session_state:
-            st.session_state.generating_summary = False
-        if "generating_quiz" not in st.session_state:
-            st.session_state.generating_quiz = False
-        if "generating_flashcards" not in st.session_state:
-            st.session_state.generating_flashcards = False
+        # Generation runs in the background, so chat and review stay usable; each button is
+        # disabled while its own job runs
+        no_chunks = "text_chunks" not in st.session_state
 
         # Generate Summary Button
-        if col1.button("Generate Summary", key="get_summary_button", disabled="text_chunks" not in st.session_state) and "text_chunks" in st.session_state:
-            st.session_state.generating_summary = True
-            with st.spinner("Generating Summary..."):
-                generate_and_store_summary(st.session_state.text_chunks, model)
-            st.session_state.generating_summary = False
+        if col1.button("Generate Summary", key="get_summary_button", disabled=no_chunks or st.session_state.generating_summary) and "text_chunks" in st.session_state:
+            generate_and_store_summary(st.session_state.text_chunks, get_model(), regenerate)
+            st.rerun()
 
         # Show Summary Button
         if col2.button("Show Summary", key="show_summary_button", disabled="summary" not in st.session_state) and "summary" in st.session_state:
             st.session_state.show_summary_popup = True
 
         # Generate Flashcards Button
-        if col1.button("Generate Flashcards", key="generate_flashcards_button", disabled="text_chunks" not in st.session_state):
-            st.session_state.generating_flashcards = True
-            with st.spinner("Generating Flashcards..."):
-                generate_and_store_flashcards(st.session_state.text_chunks, model)
-            st.session_state.generating_flashcards = False
+        if col1.button("Generate Flashcards", key="generate_flashcards_button", disabled=no_chunks or st.session_state.generating_flashcards):
+            generate_and_store_flashcards(st.session_state.text_chunks, get_model(), regenerate)
+            st.rerun()
 
         # Take Quiz Button
-        if col2.button("Take Quiz", key="take_quiz_button", disabled="text_chunks" not in st.session_state):
-            st.session_state.generating_quiz = True
-            with st.spinner("Generating Quiz..."):
-                generate_and_store_quiz(st.session_state.text_chunks, model)
-            st.session_state.generating_quiz = False
+        if col2.button("Take Quiz", key="take_quiz_button", disabled=no_chunks or st.session_state.generating_quiz):
+            generate_and_store_quiz(st.session_state.text_chunks, get_model(), regenerate)
+            st.rerun()
+
+        # How chat questions pick chunks from the documents
+        st.markdown("---")
+        display_retrieval_settings()
+
+        # Optional latency breakdown and token spend of this session
+        if st.checkbox("Show performance panel", key="show_performance_panel"):
+            display_performance_panel()
 
     # Display quiz if active
     if "quiz_questions" in st.session_state:
@@ -89,11 +126,11 @@ def main():
         if st.button("Close Summary", key="close_summary_button"):
             st.session_state.show_summary_popup = False
 
-    # Disable chat input if quiz, flashcards, or flashcard generation is active
+    # Disable chat input if quiz or flashcards are active, or while the documents are being (re)indexed
     chat_input_disabled = (
         activity_active or
         "vectorstore" not in st.session_state or
-        st.session_state.generating_flashcards or
+        st.session_state.generating_ingest or
         "flashcards" in st.session_state or
         "quiz_questions" in st.session_state
     )
@@ -105,6 +142,7 @@ def main():
             if st.button("🗑️ Clear Chat", key="clear_chat_button"):
                 st.session_state.messages = []
                 st.session_state.chat_started = False
+                st.session_state.pop("chat_shown", None)
                 st.rerun()
 
     # Display moderation warning if needed
@@ -116,7 +154,7 @@ def main():
     # Chat input is disabled when necessary
     if user_input := st.chat_input("Ask a question about your documents...", disabled=chat_input_disabled):
         st.session_state.chat_started = True
-        handle_user_input(user_input, model)
+        handle_user_input(user_input, get_model())
         st.rerun()
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+# batch.py
+"""Pre-generates study packs (index, summary, flashcards and quiz) for a directory of PDFs.
+
+    python batch.py lectures/ --workers 4
+    python batch.py lectures/ --recursive --only flashcards quiz
+
+Each PDF is indexed into the ingest cache and its summary, flashcards and quiz are written
+to PACK_DIR as <file hash>.json, where the app loads them when a student uploads the same
+PDF. Files with a complete pack generated with the current settings (model, splitter, prompts,
+token budgets) are skipped, so an interrupted run can simply be restarted; chunks generated
+before the interruption come from the result cache.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import file_hash, ingest_cache_key, load_ingest, load_pack, save_ingest, save_pack
+from commons import get_embedding, get_model, get_text_splitter, RATE_LIMIT_RPM, RATE_LIMIT_TPM
+from jobs import collect_stats
+from scheduler import TokenBucket, get_scheduler, set_lane
+from tools import generate_flashcards, generate_quiz_questions, generate_summary, pack_settings
+from tracing import set_session
+from utils import chunk_ids, chunk_pdfs, get_vectorstore
+
+PACK_KINDS = ("summary", "flashcards", "quiz")
+
+
+def find_pdfs(directory, recursive=False) -> list:
+    if not recursive:
+        return sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(".pdf")
+        )
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names if name.lower().endswith(".pdf")
+    )
+
+
+def init_worker(rpm, tpm):
+    """Every worker process has its own scheduler, so each gets an equal share of the gateway limits."""
+    scheduler = get_scheduler()
+    scheduler.requests = TokenBucket(rpm)
+    scheduler.tokens = TokenBucket(tpm)
+    set_lane("bulk")
+
+
+def is_complete(pack, kinds, settings) -> bool:
+    return pack is not None and pack.get("settings") == settings and all(kind in pack for kind in kinds)
+
+
+def process_pdf(path, kinds) -> dict:
+    """Worker: indexes one PDF and generates its study pack. Returns its stats."""
+    start = time.time()
+    model = get_model()
+    text_splitter = get_text_splitter()
+    with open(path, "rb") as pdf:
+        pdf_hash = file_hash(pdf)
+        cache_key = ingest_cache_key([pdf], text_splitter)  # The key of a single-file upload in the app
+    set_session(f"batch:{pdf_hash}")  # Groups the spans of this file in the trace file
+
+    cached = load_ingest(cache_key, get_embedding())
+    if cached:
+        documents, _ = cached
+    else:
+        documents = chunk_pdfs([path], text_splitter, max_workers=1)  # Files are spread over processes already
+        vectorstore = get_vectorstore(documents, chunk_ids(documents))
+        save_ingest(cache_key, documents, vectorstore)
+    text_chunks = [doc.page_content for doc in documents]
+
+    # The chunk count is part of the settings, so they are known only once the file is chunked
+    settings = pack_settings(model, text_splitter, len(text_chunks))
+    pack = load_pack(pdf_hash)
+    if is_complete(pack, kinds, settings):
+        return {"path": path, "status": "skipped"}
+    if pack is None or pack.get("settings") != settings:
+        pack = {"source": os.path.basename(path), "file_hash": pdf_hash, "settings": settings}
+    inputs = {"text_chunks": text_chunks, "model": model}
+    # The generators count their token usage and failed requests (a failed chunk yields no items)
+    with collect_stats() as run_stats:
+        if "summary" in kinds and "summary" not in pack:
+            pack["summary"] = generate_summary.invoke(inputs)
+        if "flashcards" in kinds and "flashcards" not in pack:
+            pack["flashcards"] = generate_flashcards.invoke(inputs)
+        if "quiz" in kinds and "quiz" not in pack:
+            pack["quiz"] = generate_quiz_questions.invoke(inputs)
+
+    stats = {
+        "path": path,
+        "chunks": len(text_chunks),
+        "input_tokens": sum(values.get("input_tokens", 0) for values in run_stats.values()),
+        "output_tokens": sum(values.get("output_tokens", 0) for values in run_stats.values()),
+        "failed_requests": sum(values.get("failed_requests", 0) for values in run_stats.values()),
+        "seconds": time.time() - start,
+    }
+    if stats["failed_requests"]:
+        # Don't mark the file done with chunks missing; the next run only redoes the failed chunks
+        stats["status"] = "incomplete"
+        return stats
+    save_pack(pdf_hash, pack)
+    stats["status"] = "done"
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--recursive", action="store_true", help="Also process PDFs in subdirectories")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="PDFs processed at once")
+    parser.add_argument("--only", nargs="+", choices=PACK_KINDS, default=list(PACK_KINDS),
+                        help="Generate only these parts of the packs")
+    args = parser.parse_args()
+
+    paths = find_pdfs(args.directory, args.recursive)
+    if not paths:
+        print(f"No PDFs in {args.directory}")
+        return 1
+    workers = max(1, min(args.workers, len(paths)))
+    print(f"Processing {len(paths)} PDFs with {workers} worker processes")
+
+    start = time.time()
+    totals = {"done": 0, "skipped": 0, "incomplete": 0, "failed": 0, "input_tokens": 0, "output_tokens": 0}
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(RATE_LIMIT_RPM // workers, RATE_LIMIT_TPM // workers)
+    ) as executor:
+        futures = {executor.submit(process_pdf, path, tuple(args.only)): path for path in paths}
+        for number, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                print(f"[{number}/{len(paths)}] {path}: failed: {e}")
+                totals["failed"] += 1
+                continue
+            totals[stats["status"]] += 1
+            if stats["status"] == "skipped":
+                print(f"[{number}/{len(paths)}] {path}: already done")
+                continue
+            totals["input_tokens"] += stats["input_tokens"]
+            totals["output_tokens"] += stats["output_tokens"]
+            print(
+                f"[{number}/{len(paths)}] {path}: {stats['status']}, {stats['chunks']} chunks in "
+                f"{stats['seconds']:.1f}s, {stats['input_tokens']} tokens in / {stats['output_tokens']} out"
+                + (f", {stats['failed_requests']} failed requests" if stats["failed_requests"] else "")
+            )
+
+    minutes = (time.time() - start) / 60
+    processed = totals["done"] + totals["incomplete"]
+    print(
+        f"{totals['done']} done, {totals['skipped']} skipped, {totals['incomplete']} incomplete, "
+        f"{totals['failed']} failed in {minutes:.1f} min ({processed / max(minutes, 1e-9):.1f} files/min); "
+        f"tokens: {totals['input_tokens']} in / {totals['output_tokens']} out"
+    )
+    return 1 if totals["incomplete"] or totals["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
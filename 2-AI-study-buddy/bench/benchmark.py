@@ -0,0 +1,254 @@
+# bench/benchmark.py
+"""End-to-end benchmark of ingestion, chat and study-aid generation against the offline fake backend.
+
+    python bench/benchmark.py --pages 10 100 500 2000 --save-baseline
+    python bench/benchmark.py --pages 10 100 500 2000 --check        # exits 1 on regression
+
+Timings depend on the machine, so there is no stored baseline in the repo: save one on the
+machine (e.g. the CI runner) that runs --check. --check without a baseline exits 2 right away.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openai import start_server  # noqa: E402
+from synthetic_pdf import write_pdf  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+QUESTIONS = [
+    "What is the function of the mitochondria?",
+    "Explain photosynthesis and chlorophyll.",
+    "How does supply and demand affect inflation?",
+    "What is a derivative of a function?",
+    "Describe the role of enzymes in a reaction.",
+]
+GENERATION_CHUNKS = 40  # Generation runs on the first chunks only, so large uploads stay affordable
+
+
+def use_fake_backend(base_url, work_dir, rpm=0, tpm=0):
+    """Points the app (imported after this) at the fake backend and a scratch cache. The scheduler's
+    rate limits are off by default; they would be measured instead of the app."""
+    os.environ["STUDY_BUDDY_BASE_URL"] = base_url
+    os.environ["STUDY_BUDDY_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ["STUDY_BUDDY_RATE_LIMIT_RPM"] = str(rpm)
+    os.environ["STUDY_BUDDY_RATE_LIMIT_TPM"] = str(tpm)
+    os.environ.setdefault("OPENAI_API_KEY", "fake-key")
+
+
+def add_rate_limit_arguments(parser):
+    parser.add_argument("--rate-limit-rpm", type=int, default=0, help="Scheduler requests per minute (0: no limit)")
+    parser.add_argument("--rate-limit-tpm", type=int, default=0, help="Scheduler tokens per minute (0: no limit)")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux (bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def api_stats(base_url):
+    with urllib.request.urlopen(base_url + "/stats") as response:
+        return json.loads(response.read())
+
+
+def reset_api_stats(base_url):
+    urllib.request.urlopen(urllib.request.Request(base_url + "/stats/reset", data=b"{}", method="POST")).read()
+
+
+def first_items(items_iterator):
+    """Returns the first non-empty batch of a progressive generator and stops it."""
+    try:
+        for items in items_iterator:
+            if items:
+                return items
+    finally:
+        items_iterator.close()
+
+
+def measure(name, base_url, repeats, run, units):
+    """Runs `run()` `repeats` times; `units` is the amount of work per run (pages, questions, chunks)."""
+    reset_api_stats(base_url)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+    stats = api_stats(base_url)
+    calls = stats["calls"]
+    result = {
+        "p50_s": percentile(latencies, 0.5),
+        "p95_s": percentile(latencies, 0.95),
+        "throughput_per_s": units / statistics.mean(latencies) if latencies else 0.0,
+        "api_calls": {key: value / repeats for key, value in calls.items() if value},
+        "prompt_tokens": stats["tokens"]["prompt"] / repeats,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(
+        f"{name:<28} p50 {result['p50_s']:7.3f}s  p95 {result['p95_s']:7.3f}s  "
+        f"{result['throughput_per_s']:9.1f}/s  rss {result['peak_rss_mb']:7.1f}MB  "
+        f"prompt tokens {result['prompt_tokens']:8.0f}  calls {result['api_calls']}"
+    )
+    return result
+
+
+def run_benchmarks(page_counts, repeats, work_dir, base_url, chunk_workers):
+    # Imported after the environment points the app at the fake backend and a scratch cache
+    from langchain.chains import RetrievalQA
+    from commons import get_model, get_text_splitter
+    from tools import (
+        generate_summary, generate_flashcards, generate_quiz_questions, iter_flashcards, iter_quiz_questions
+    )
+    from utils import chunk_pdfs, chunk_ids, index_files, get_vectorstore, get_embedding_store
+    from retrieval import RETRIEVAL_MODES, default_settings, get_retriever, pack_context
+    from lexical import build_lexical_index
+
+    model = get_model()
+    text_splitter = get_text_splitter()
+    results = {}
+
+    for pages in page_counts:
+        pdf_path = write_pdf(os.path.join(work_dir, f"synthetic-{pages}.pdf"), pages, seed=pages)
+        state = {}
+
+        def ingest():
+            # Cold run every time: forget embeddings stored by the previous repeat
+            store = get_embedding_store()
+            with store.lock:
+                store.conn.execute("DELETE FROM embeddings")
+                store.conn.commit()
+            documents = chunk_pdfs([pdf_path], text_splitter)
+            ids = chunk_ids(documents)
+            state["chunks"] = [doc.page_content for doc in documents]
+            state["vectorstore"] = get_vectorstore(documents, ids)
+            state["lexical_index"] = build_lexical_index(state["vectorstore"], index_files(documents, ids))
+
+        results[f"ingest/{pages}p"] = measure(f"ingest {pages} pages", base_url, repeats, ingest, pages)
+
+        # Extraction + splitting alone, to see how chunking throughput scales with worker processes
+        for workers in chunk_workers:
+            results[f"chunk_{workers}w/{pages}p"] = measure(
+                f"chunk {workers} workers {pages} pages", base_url, repeats,
+                lambda workers=workers: chunk_pdfs([pdf_path], text_splitter, workers), pages,
+            )
+
+        # One scenario per retrieval mode; "chat" is the default mode
+        for mode in RETRIEVAL_MODES:
+            settings = dict(default_settings(), mode=mode)
+            retriever = get_retriever(state["vectorstore"], settings, state["lexical_index"])
+            qa_chain = RetrievalQA.from_chain_type(llm=model, chain_type="stuff", retriever=retriever)
+
+            def ask(question, qa_chain=qa_chain, settings=settings):
+                docs = pack_context(qa_chain.retriever.invoke(question), settings["context_token_budget"])
+                return qa_chain.combine_documents_chain.invoke({"input_documents": docs, "question": question})
+
+            scenario = "chat" if mode == default_settings()["mode"] else f"chat_{mode}"
+            results[f"{scenario}/{pages}p"] = measure(
+                f"{scenario} {pages} pages", base_url, repeats,
+                lambda ask=ask: [ask(question) for question in QUESTIONS], len(QUESTIONS),
+            )
+
+        chunks = state["chunks"][:GENERATION_CHUNKS]
+        inputs = {"text_chunks": chunks, "model": model, "regenerate": True}
+        for name, tool in (("summary", generate_summary), ("flashcards", generate_flashcards),
+                           ("quiz", generate_quiz_questions)):
+            results[f"{name}/{pages}p"] = measure(
+                f"{name} {pages} pages", base_url, repeats, lambda tool=tool: tool.invoke(inputs), len(chunks)
+            )
+
+        # Time until the first flashcards / questions can be shown while the rest keep generating
+        for name, iterate in (("flashcards", iter_flashcards), ("quiz", iter_quiz_questions)):
+            results[f"{name}_first/{pages}p"] = measure(
+                f"{name} first {pages} pages", base_url, repeats,
+                lambda iterate=iterate: first_items(iterate(chunks, model, regenerate=True)), 1,
+            )
+
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for scenario, base in baseline.items():
+        current = results.get(scenario)
+        if current is None:
+            continue
+        if current["p95_s"] > base["p95_s"] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {current['p95_s']:.3f}s > baseline {base['p95_s']:.3f}s")
+        if current["throughput_per_s"] < base["throughput_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{scenario}: throughput {current['throughput_per_s']:.1f}/s < baseline {base['throughput_per_s']:.1f}/s"
+            )
+        if "_first/" in scenario:
+            continue  # Stopped at the first items; how many requests were in flight by then varies
+        for key, count in current["api_calls"].items():
+            if count > base["api_calls"].get(key, 0):
+                regressions.append(f"{scenario}: {key} calls {count:g} > baseline {base['api_calls'].get(key, 0):g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 500, 2000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--chunk-workers", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+                        help="Worker process counts tried for the chunking scenarios")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake backend latency per request (s)")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="Exit 1 if results regress against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    add_rate_limit_arguments(parser)
+    args = parser.parse_args()
+    if args.check and not args.save_baseline and not os.path.exists(args.baseline):
+        # Timings depend on the machine, so no baseline ships with the repo; fail before the run, not after it
+        parser.error(
+            f"--check needs a baseline, but {args.baseline} doesn't exist. Create one on this machine "
+            f"with --save-baseline (same --pages and options), then run --check again"
+        )
+
+    server, _, base_url = start_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    with tempfile.TemporaryDirectory(prefix="study-buddy-bench-") as work_dir:
+        use_fake_backend(base_url, work_dir, args.rate_limit_rpm, args.rate_limit_tpm)
+        results = run_benchmarks(args.pages, args.repeats, work_dir, base_url, sorted(set(args.chunk_workers)))
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
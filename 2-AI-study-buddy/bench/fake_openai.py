@@ -0,0 +1,313 @@
+# bench/fake_openai.py
+"""Offline stand-in for the OpenAI-compatible gateway: chat completions (plain and streamed),
+embeddings and moderations, with configurable latency, jitter and error rate.
+
+Outputs are deterministic for a given request and follow the formats parse_flashcards and
+parse_questions expect, including the '=== SECTION n ===' markers of packed requests.
+
+    python bench/fake_openai.py --port 8765 --latency 0.2 --jitter 0.05 --error-rate 0.01
+    STUDY_BUDDY_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake \
+        STUDY_BUDDY_RATE_LIMIT_RPM=0 STUDY_BUDDY_RATE_LIMIT_TPM=0 streamlit run app.py
+
+The scheduler's rate limits are meant for the real gateway; leave them on only to measure them.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIM = 1536
+SECTION_PATTERN = re.compile(r"^=== SECTION (\d+) ===$", re.MULTILINE)
+MODERATION_CATEGORIES = (
+    "harassment", "harassment/threatening", "hate", "hate/threatening", "illicit", "illicit/violent",
+    "self-harm", "self-harm/instructions", "self-harm/intent", "sexual", "sexual/minors",
+    "violence", "violence/graphic",
+)
+
+
+class FakeBackend:
+    """Request handling and counters, shared by all server threads."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500, token_latency=0.0, seed=0,
+                 word_embeddings=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.token_latency = token_latency
+        self.word_embeddings = word_embeddings
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {"chat": 0, "embeddings": 0, "embedded_texts": 0, "moderations": 0, "errors": 0}
+        self.tokens = {"prompt": 0, "completion": 0}
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.calls[key] += amount
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": dict(self.calls), "tokens": dict(self.tokens)}
+
+    def reset(self):
+        with self.lock:
+            for key in self.calls:
+                self.calls[key] = 0
+            for key in self.tokens:
+                self.tokens[key] = 0
+
+    def delay_and_maybe_fail(self) -> bool:
+        """Sleeps for the configured latency; returns True if this request should fail."""
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if fail:
+            self.count("errors")
+        return fail
+
+
+def words_of(text, count, offset=0):
+    words = re.findall(r"[A-Za-z][A-Za-z-]{3,}", text)
+    if not words:
+        words = ["concept"]
+    return [words[(offset + i) % len(words)] for i in range(count)]
+
+
+def fake_flashcards(text, seed):
+    cards = []
+    for i in range(2):
+        term, detail, extra = words_of(text, 3, seed + i * 3)
+        cards.append(f"Front: What is {term}?\nBack: {term} relates to {detail} and {extra}.")
+    return "\n\n".join(cards)
+
+
+def fake_questions(text, seed):
+    a, b, c, d, e = words_of(text, 5, seed)
+    return (
+        f"Question: Which term is described alongside {a}?\n"
+        f"Type: multiple_choice\n"
+        f"Options: A) {b}, B) {c}, C) {d}, D) {e}\n"
+        f"Correct Answer: A\n"
+        f"Explanation: The text mentions {a} together with {b}.\n\n"
+        f"Question: The text discusses {c}.\n"
+        f"Type: true_false\n"
+        f"Options: A) True, B) False\n"
+        f"Correct Answer: A\n"
+        f"Explanation: {c} appears in the text."
+    )
+
+
+def fake_completion(prompt) -> str:
+    """Deterministic answer shaped by what the prompt asks for."""
+    seed = int(hashlib.sha256(prompt.encode()).hexdigest()[:8], 16) % 97
+    if "flashcards" in prompt:
+        make = fake_flashcards
+    elif "quiz questions" in prompt:
+        make = fake_questions
+    else:
+        return "Summary: " + " ".join(words_of(prompt, 40, seed)) + "."
+
+    parts = SECTION_PATTERN.split(prompt)
+    if len(parts) == 1:
+        return make(prompt, seed)
+    sections = []
+    for number, body in zip(parts[1::2], parts[2::2]):
+        sections.append(f"=== SECTION {number} ===\n{make(body, seed)}")
+    return "\n\n".join(sections)
+
+
+def fake_embedding(item) -> list:
+    """Unit vector derived from the input, so identical texts get identical embeddings."""
+    key = item if isinstance(item, str) else json.dumps(item)
+    rng = random.Random(hashlib.sha256(key.encode()).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(EMBEDDING_DIM)]
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def word_embedding(item) -> list:
+    """Hashed bag of words, normalized: texts that share words get similar vectors, roughly like a
+    real embedding model, so retrieval quality can be compared offline."""
+    if isinstance(item, list) and item and isinstance(item[0], int):
+        import tiktoken  # LangChain sends token arrays; only needed with --word-embeddings
+        item = tiktoken.get_encoding("cl100k_base").decode(item)
+    if not isinstance(item, str):
+        return fake_embedding(item)
+    vector = [0.0] * EMBEDDING_DIM
+    for word in re.findall(r"\w+", item.lower()):
+        digest = hashlib.blake2b(word.encode(), digest_size=16).digest()
+        for i in range(0, 16, 2):  # 8 signed coordinates per word
+            vector[int.from_bytes(digest[i:i + 2], "little") % EMBEDDING_DIM] += 1.0 if digest[i] & 1 else -1.0
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector] if norm else fake_embedding(item)
+
+
+def make_handler(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass  # Keep benchmark output readable
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                self.send_json(200, backend.stats())
+            else:
+                self.send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            path = self.path.rstrip("/")
+
+            if path.endswith("/stats/reset"):
+                backend.reset()
+                self.send_json(200, {"ok": True})
+                return
+
+            if backend.delay_and_maybe_fail():
+                headers = {"Retry-After": "1"} if backend.error_status == 429 else None
+                self.send_json(backend.error_status, {"error": {"message": "injected failure"}}, headers)
+                return
+
+            if path.endswith("/chat/completions"):
+                self.chat(request)
+            elif path.endswith("/embeddings"):
+                self.embeddings(request)
+            elif path.endswith("/moderations"):
+                self.moderations(request)
+            else:
+                self.send_json(404, {"error": {"message": f"unknown endpoint {self.path}"}})
+
+        def chat(self, request):
+            backend.count("chat")
+            prompt = "\n".join(
+                message["content"] if isinstance(message.get("content"), str) else json.dumps(message.get("content"))
+                for message in request.get("messages", [])
+            )
+            content = fake_completion(prompt)
+            prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+            with backend.lock:
+                backend.tokens["prompt"] += prompt_tokens
+                backend.tokens["completion"] += completion_tokens
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+            base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": request.get("model", "fake")}
+
+            if not request.get("stream"):
+                self.send_json(200, dict(
+                    base, object="chat.completion", usage=usage,
+                    choices=[{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                ))
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            pieces = re.findall(r"\S+\s*", content) or [content]
+            for i, piece in enumerate(pieces):
+                delta = {"content": piece} if i else {"role": "assistant", "content": piece}
+                chunk = dict(base, object="chat.completion.chunk",
+                             choices=[{"index": 0, "delta": delta, "finish_reason": None}])
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                if backend.token_latency:
+                    time.sleep(backend.token_latency)
+            final = dict(base, object="chat.completion.chunk", usage=usage,
+                         choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+            self.wfile.flush()
+            self.close_connection = True
+
+        def embeddings(self, request):
+            inputs = request.get("input", [])
+            if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]  # A single text, or a single token array
+            backend.count("embeddings")
+            backend.count("embedded_texts", len(inputs))
+
+            data = []
+            for index, item in enumerate(inputs):
+                vector = word_embedding(item) if backend.word_embeddings else fake_embedding(item)
+                if request.get("encoding_format") == "base64":
+                    vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+                data.append({"object": "embedding", "index": index, "embedding": vector})
+            self.send_json(200, {
+                "object": "list", "data": data, "model": request.get("model", "fake"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            })
+
+        def moderations(self, request):
+            backend.count("moderations")
+            inputs = request.get("input", "")
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            results = []
+            for text in inputs:
+                flagged = "FLAGME" in str(text)
+                results.append({
+                    "flagged": flagged,
+                    "categories": {category: flagged for category in MODERATION_CATEGORIES},
+                    "category_scores": {category: 0.9 if flagged else 0.0 for category in MODERATION_CATEGORIES},
+                    "category_applied_input_types": {category: ["text"] for category in MODERATION_CATEGORIES},
+                })
+            self.send_json(200, {"id": "modr-fake", "model": request.get("model", "fake"), "results": results})
+
+    return Handler
+
+
+def start_server(port=0, **backend_options):
+    """Starts the fake backend in a daemon thread. Returns (server, backend, base_url)."""
+    backend = FakeBackend(**backend_options)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(backend))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, backend, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- seconds around --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of failed requests (429 adds Retry-After)")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds between streamed tokens")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--word-embeddings", action="store_true", help="Bag-of-words instead of random embeddings")
+    args = parser.parse_args()
+
+    server, _, base_url = start_server(
+        args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, token_latency=args.token_latency, seed=args.seed,
+        word_embeddings=args.word_embeddings,
+    )
+    print(f"Fake OpenAI backend listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# bench/index_benchmark.py
+"""Recall vs. latency of the FAISS index types against exact (flat) search.
+
+    python bench/index_benchmark.py --vectors 20000 100000 --dim 256
+    python bench/index_benchmark.py --vectors 50000 --dim 1536 --types flat ivf ivfsq --nprobe 8 16 32
+
+Vectors are synthetic: normalized points around random cluster centers, which is roughly how
+chunk embeddings of a few textbooks spread out. Queries are drawn the same way.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import faiss
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from indexes import INDEX_TYPES, build_index, index_type_of  # noqa: E402
+
+
+def clustered_vectors(count, dimension, clusters, rng):
+    centers = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    points = centers[rng.integers(0, clusters, count)] + 0.5 * rng.normal(size=(count, dimension)).astype(np.float32)
+    return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def search_settings(index, nprobes, ef_searches):
+    """(label, apply) pairs for the search-time knob of the index type: nprobe for IVF, efSearch for HNSW."""
+    index_type = index_type_of(index)
+    if index_type in ("ivf", "ivfpq", "ivfsq"):
+        ivf = faiss.extract_index_ivf(index)
+        return [(f"nprobe={nprobe}", lambda nprobe=nprobe: setattr(ivf, "nprobe", min(nprobe, ivf.nlist)))
+                for nprobe in nprobes]
+    if index_type == "hnsw":
+        return [(f"ef={ef}", lambda ef=ef: setattr(index.hnsw, "efSearch", ef)) for ef in ef_searches]
+    return [(None, lambda: None)]
+
+
+def search_latencies(index, queries, k):
+    """Searches one query at a time, like a chat turn does. Returns (latencies in s, result ids)."""
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids[0])
+    return latencies, np.array(results)
+
+
+def recall(results, truth):
+    """Fraction of the exact top-k neighbours that the index found."""
+    return float(np.mean([len(set(found) & set(expected)) / len(expected) for found, expected in zip(results, truth)]))
+
+
+def run(vector_count, dimension, types, nprobes, ef_searches, query_count, k):
+    rng = np.random.default_rng(0)
+    clusters = max(8, vector_count // 500)
+    vectors = clustered_vectors(vector_count, dimension, clusters, rng)
+    queries = clustered_vectors(query_count, dimension, clusters, rng)
+
+    results = {}
+    truth = None
+    for index_type in ["flat"] + [t for t in types if t != "flat"]:
+        start = time.perf_counter()
+        index = build_index(vectors, index_type)
+        index.add(vectors)
+        build_s = time.perf_counter() - start
+        size_mb = faiss.serialize_index(index).nbytes / 1024 ** 2
+
+        for label, apply in search_settings(index, nprobes, ef_searches):
+            apply()
+            latencies, found = search_latencies(index, queries, k)
+            if truth is None:
+                truth = found  # The flat index runs first and gives the exact neighbours
+            name = index_type_of(index) + (f"/{label}" if label else "")
+            result = {
+                "build_s": build_s,
+                "size_mb": size_mb,
+                "p50_ms": statistics.median(latencies) * 1000,
+                "p95_ms": float(np.percentile(latencies, 95)) * 1000,
+                f"recall@{k}": recall(found, truth),
+            }
+            results[f"{name}/{vector_count}v"] = result
+            print(
+                f"{vector_count:>8} x {dimension:<5} {name:<18} build {build_s:7.2f}s  size {size_mb:8.1f}MB  "
+                f"p50 {result['p50_ms']:7.3f}ms  p95 {result['p95_ms']:7.3f}ms  recall@{k} {result[f'recall@{k}']:.3f}"
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", type=int, nargs="+", default=[20000, 100000])
+    parser.add_argument("--dim", type=int, default=256, help="1536 matches text-embedding-3-small")
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64], help="Settings tried for IVF types")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128], help="Settings tried for HNSW")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for vector_count in args.vectors:
+        results.update(run(vector_count, args.dim, args.types, args.nprobe, args.ef_search, args.queries, args.k))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+# bench/retrieval_benchmark.py
+"""Latency and quality of hybrid (BM25 + vector) retrieval against vector-only search on one corpus.
+
+    python bench/retrieval_benchmark.py --chunks 2000 --queries 200
+    python bench/retrieval_benchmark.py --chunks 10000 --latency 0.2 --output retrieval.json
+
+The corpus is synthetic: every chunk is text about a few topic words of synthetic_pdf's
+vocabulary plus one made-up fact ("The melting point of Varnokite is 412 kelvin."). Exact
+questions ask for a fact by name; topic questions name three of a chunk's topic words. The
+fake backend uses bag-of-words embeddings, so vector search finds related text as well.
+Quality is recall@k and mean reciprocal rank of the chunk each question was written from.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openai import start_server  # noqa: E402
+from synthetic_pdf import VOCABULARY  # noqa: E402
+from benchmark import add_rate_limit_arguments, api_stats, percentile, reset_api_stats, use_fake_backend  # noqa: E402
+
+ATTRIBUTES = ("melting point", "atomic mass", "half-life", "founding year", "population", "wavelength")
+SYLLABLES = ("var", "no", "kite", "zel", "dra", "quo", "mir", "tan", "pex", "lo", "shi", "bru", "gan", "ith")
+CHUNK_WORDS = 300
+TOPIC_WORDS = 5
+TOPIC_SHARE = 0.3  # Fraction of a chunk's words that are its topic words
+
+# Vector-only is the "similarity" mode; hybrid is run with and without the lexical fast path
+SCENARIOS = (
+    ("vector", "similarity", True), ("threshold", "threshold", True), ("mmr", "mmr", True),
+    ("hybrid", "hybrid", True), ("hybrid_no_fast_path", "hybrid", False),
+)
+
+
+def entity_name(rng, used):
+    while True:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(3)).capitalize()
+        if name not in used:
+            used.add(name)
+            return name
+
+
+def synthetic_corpus(chunk_count, query_count, seed=0):
+    """Returns (chunk texts, [(question, kind, chunk number)])."""
+    rng = random.Random(seed)
+    chunks, facts, topics, used = [], [], [], set()
+    for _ in range(chunk_count):
+        topic = rng.sample(VOCABULARY, TOPIC_WORDS)
+        words = [rng.choice(topic) if rng.random() < TOPIC_SHARE else rng.choice(VOCABULARY) for _ in range(CHUNK_WORDS)]
+        sentences = [" ".join(words[i:i + 12]).capitalize() + "." for i in range(0, len(words), 12)]
+        fact = (rng.choice(ATTRIBUTES), entity_name(rng, used), rng.randint(10, 9999))
+        sentences.insert(rng.randrange(len(sentences)), f"The {fact[0]} of {fact[1]} is {fact[2]}.")
+        chunks.append(" ".join(sentences))
+        facts.append(fact)
+        topics.append(topic)
+
+    queries = []
+    for number in rng.sample(range(chunk_count), min(query_count, chunk_count)):
+        if len(queries) % 2 == 0:
+            attribute, entity, _ = facts[number]
+            queries.append((f"What is the {attribute} of {entity}?", "exact", number))
+        else:
+            queries.append((f"Explain {', '.join(rng.sample(topics[number], 3))}.", "topic", number))
+    return chunks, queries
+
+
+def evaluate(retriever, queries, ids, base_url, k, forget_query, embed_query):
+    """Runs each question as a chat turn does: a confident lexical match (hybrid mode) is used as is,
+    other questions are embedded for the answer cache lookup and then retrieved with that vector."""
+    latencies, hits, reciprocal_ranks, by_kind, embedded = [], 0, [], {}, 0
+    confident_documents = getattr(retriever, "confident_documents", None)
+    reset_api_stats(base_url)
+    for question, kind, number in queries:
+        forget_query(question)  # Every question is new to the query embedding cache, as in a real chat
+        start = time.perf_counter()
+        docs = confident_documents(question) if confident_documents else None
+        if docs is None:
+            embed_query(question)  # The answer cache lookup
+            embedded += 1
+            docs = retriever.invoke(question)
+        latencies.append(time.perf_counter() - start)
+        ranks = [doc.id for doc in docs[:k]]
+        rank = ranks.index(ids[number]) + 1 if ids[number] in ranks else None
+        hits += rank is not None
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        kind_stats = by_kind.setdefault(kind, {"queries": 0, "hits": 0})
+        kind_stats["queries"] += 1
+        kind_stats["hits"] += rank is not None
+    calls = api_stats(base_url)["calls"]
+    # The retriever reuses the lookup's vector, so a question is embedded once at most
+    assert calls["embeddings"] == embedded, f"{calls['embeddings']} embedding calls for {embedded} questions"
+    return {
+        "avg_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "recall_at_k": hits / len(queries),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "recall_by_kind": {kind: stats["hits"] / stats["queries"] for kind, stats in by_kind.items()},
+        "embedding_calls": calls["embeddings"],
+    }
+
+
+def run(chunk_count, query_count, k, fetch_k, base_url):
+    # Imported after the environment points the app at the fake backend and a scratch cache
+    from langchain_core.documents import Document
+    from lexical import build_lexical_index
+    from retrieval import default_settings, get_retriever
+    from tracing import get_session_spans, set_session
+    from cache import get_query_embeddings
+    from commons import get_embedding
+    from utils import chunk_ids, get_vectorstore, index_files
+
+    texts, queries = synthetic_corpus(chunk_count, query_count)
+    documents = [
+        Document(page_content=text, metadata={"source": "synthetic.pdf", "file_hash": "synthetic", "page": number + 1})
+        for number, text in enumerate(texts)
+    ]
+    ids = chunk_ids(documents)
+    vectorstore = get_vectorstore(documents, ids)
+    start = time.perf_counter()
+    lexical_index = build_lexical_index(vectorstore, index_files(documents, ids))
+    print(
+        f"{chunk_count} chunks: BM25 index built in {(time.perf_counter() - start) * 1000:.0f}ms, "
+        f"{len(lexical_index.terms)} terms, {len(lexical_index.doc_numbers)} postings, "
+        f"{lexical_index.nbytes() / 1024:.0f} KiB"
+    )
+
+    def forget_query(question):
+        get_query_embeddings().clear()
+
+    def embed_query(question):
+        get_query_embeddings().embed_query(question, get_embedding())
+
+    results = {}
+    for name, mode, fast_path in SCENARIOS:
+        settings = dict(default_settings(), mode=mode, k=k, fetch_k=fetch_k)
+        retriever = get_retriever(vectorstore, settings, lexical_index)
+        if mode == "hybrid":
+            retriever.fast_path = fast_path
+        session = f"retrieval-bench:{name}:{chunk_count}"
+        set_session(session)
+        result = evaluate(retriever, queries, ids, base_url, k, forget_query, embed_query)
+        fast = [record for record in get_session_spans(session) if record["attributes"].get("fast_path")]
+        result["fast_path_rate"] = len(fast) / len(queries)
+        results[f"{name}/{chunk_count}c"] = result
+        print(
+            f"{name:<22} avg {result['avg_ms']:7.1f}ms  p50 {result['p50_ms']:7.1f}ms  p95 {result['p95_ms']:7.1f}ms  "
+            f"recall@{k} {result['recall_at_k']:.3f}  mrr {result['mrr']:.3f}  "
+            f"by kind {', '.join(f'{kind} {recall:.3f}' for kind, recall in result['recall_by_kind'].items())}  "
+            f"embedding calls {result['embedding_calls']}  fast path {result['fast_path_rate']:.0%}"
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, nargs="+", default=[2000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake backend latency per request (s)")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    add_rate_limit_arguments(parser)
+    args = parser.parse_args()
+
+    server, _, base_url = start_server(latency=args.latency, word_embeddings=True)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="study-buddy-retrieval-bench-") as work_dir:
+        use_fake_backend(base_url, work_dir, args.rate_limit_rpm, args.rate_limit_tpm)
+        for chunk_count in args.chunks:
+            results.update(run(chunk_count, args.queries, args.k, args.fetch_k, base_url))
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# bench/session_benchmark.py
+"""Rerun time and per-session memory of a long study session.
+
+    python bench/session_benchmark.py --messages 200 --items 500
+    python bench/session_benchmark.py --messages 50 200 1000 --output sessions.json
+
+Rerun time: a session with N chat messages is rerun with the whole history rendered
+(STUDY_BUDDY_CHAT_WINDOW=0, as before the chat was windowed) and with the default window.
+Each configuration runs in a fresh interpreter through Streamlit's AppTest. Memory: the
+tracemalloc size of M flashcards and quiz questions as parsed dicts and as the records
+sessions keep, and what spilling such a session to disk frees and writes.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic_pdf import VOCABULARY  # noqa: E402
+
+RERUN = """
+import json, statistics, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("app.py", default_timeout=120)
+at.session_state["messages"] = [
+    {{"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(words[(i + j) % len(words)] for j in range(60))}}
+    for i in range({messages})
+]
+at.run()
+assert not at.exception, at.exception
+times = []
+for _ in range({repeats}):
+    start = time.perf_counter()
+    at.run()
+    times.append(time.perf_counter() - start)
+print("RERUN " + json.dumps({{"median_ms": statistics.median(times) * 1000, "rendered": len(at.chat_message)}}))
+"""
+
+
+def text(rng, words):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def study_aids(count, seed=0):
+    """Parsed flashcards and quiz questions, as the parsers and study packs return them."""
+    rng = random.Random(seed)
+    flashcards = [{"front": text(rng, 8), "back": text(rng, 30)} for _ in range(count)]
+    questions = [
+        {
+            "Question": text(rng, 15), "Type": "Multiple Choice",
+            "Options": [text(rng, 4) for _ in range(4)], "Correct Answer": "B",
+            "Explanation": text(rng, 25),
+        }
+        for _ in range(count)
+    ]
+    return flashcards, questions
+
+
+def traced_bytes(build):
+    """Memory held by what `build()` returns, measured with tracemalloc."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def record_memory(count):
+    from records import flashcard_records, question_records
+
+    flashcards, questions = study_aids(count)
+    # Records reference the parsed strings, so only the containers are counted on both sides
+    as_dicts = traced_bytes(lambda: ([dict(item) for item in flashcards], [dict(item) for item in questions]))
+    as_records = traced_bytes(lambda: (flashcard_records(flashcards), question_records(questions)))
+    return {"items": count, "dict_bytes": as_dicts, "record_bytes": as_records}
+
+
+def spill_memory(count, message_count, work_dir):
+    from records import flashcard_records, question_records
+    from sessions import SessionSpiller
+
+    def session():
+        rng = random.Random(1)
+        flashcards, questions = study_aids(count)
+        return {
+            "messages": [
+                {"role": "user" if i % 2 == 0 else "assistant", "content": text(rng, 60)}
+                for i in range(message_count)
+            ],
+            "flashcards": flashcard_records(flashcards),
+            "quiz_questions": question_records(questions),
+            "summary": text(rng, 400),
+        }
+
+    tracemalloc.start()
+    state = session()
+    held = tracemalloc.get_traced_memory()[0]
+    spiller = SessionSpiller(directory=os.path.join(work_dir, "sessions"), idle_after=1)
+    spiller.spill("bench", state)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    restored = {}
+    spiller.restore("bench", restored)
+    assert len(restored["messages"]) == message_count
+    return {"held_bytes": held, "freed_bytes": held - after, "file_bytes": spiller.spilled_bytes}
+
+
+def rerun(message_count, window, repeats, work_dir):
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "fake-key")
+    env["STUDY_BUDDY_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    env["STUDY_BUDDY_CHAT_WINDOW"] = str(window)
+    code = f"words = {list(VOCABULARY)!r}\n" + RERUN.format(messages=message_count, repeats=repeats)
+    result = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(f"rerun failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.split("RERUN ")[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, nargs="+", default=[200])
+    parser.add_argument("--items", type=int, default=500, help="Flashcards and quiz questions each")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="study-buddy-session-bench-") as work_dir:
+        for message_count in args.messages:
+            before = rerun(message_count, 0, args.repeats, work_dir)
+            after = rerun(message_count, int(os.getenv("STUDY_BUDDY_CHAT_WINDOW", "20")), args.repeats, work_dir)
+            results[f"rerun/{message_count}m"] = {"full_history": before, "windowed": after}
+            print(
+                f"rerun with {message_count} messages: full history {before['median_ms']:.0f}ms "
+                f"({before['rendered']} rendered), windowed {after['median_ms']:.0f}ms ({after['rendered']} rendered)"
+            )
+
+        memory = record_memory(args.items)
+        results["study_aids"] = memory
+        print(
+            f"{args.items} flashcards + {args.items} questions: dicts {memory['dict_bytes'] / 1024:.0f} KiB, "
+            f"records {memory['record_bytes'] / 1024:.0f} KiB"
+        )
+
+        spill = spill_memory(args.items, max(args.messages), work_dir)
+        results["spill"] = spill
+        print(
+            f"spilling an idle session: {spill['held_bytes'] / 1024:.0f} KiB in memory, "
+            f"{spill['freed_bytes'] / 1024:.0f} KiB freed, {spill['file_bytes'] / 1024:.0f} KiB on disk"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
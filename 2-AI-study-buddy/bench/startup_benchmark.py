@@ -0,0 +1,155 @@
+# bench/startup_benchmark.py
+"""Cold-start time of the app and an import-time breakdown (python -X importtime).
+
+    python bench/startup_benchmark.py --top 25
+    python bench/startup_benchmark.py --check --budget-ms 1500     # exits 1 on regression
+
+Every run imports app.py in a fresh interpreter, as a Streamlit server does for a new process.
+--check fails if a module that should only load on first use (FAISS on "Process", the OpenAI
+clients on the first request, PDF parsing on upload) is imported at startup, or if the median
+import takes longer than the budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+
+# Modules (and their submodules) that must not be imported by `import app`
+DEFERRED_MODULES = ("faiss", "openai", "langchain_openai", "langchain_community", "PyPDF2", "langchain.chains")
+# Imported by the tokenizer prewarm thread, which starts while app.py is still importing
+PREWARM_MODULES = ("tiktoken", "langchain_text_splitters")
+
+TIMED_IMPORT = (
+    "import time; start = time.perf_counter(); import app; "
+    "print(f'IMPORT_S {time.perf_counter() - start}')"
+)
+
+
+def app_env():
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "fake-key")  # Only read when a client is built
+    return env
+
+
+def parse_importtime(stderr):
+    """Returns [(module, self_us, cumulative_us, depth)] from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def import_profile():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TIMED_IMPORT],
+        cwd=APP_DIR, env=app_env(), capture_output=True, text=True,
+    )
+    if result.returncode:
+        sys.exit(f"import app failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def import_seconds():
+    """Wall time of `import app` in a fresh interpreter, without the profiling overhead."""
+    result = subprocess.run(
+        [sys.executable, "-c", TIMED_IMPORT], cwd=APP_DIR, env=app_env(), capture_output=True, text=True,
+    )
+    if result.returncode:
+        sys.exit(f"import app failed:\n{result.stderr[-2000:]}")
+    return float(result.stdout.split("IMPORT_S")[-1])
+
+
+def first_render_seconds():
+    """Wall time of the first script run of a new session, including the import of app.py."""
+    code = (
+        "import time; from streamlit.testing.v1 import AppTest; start = time.perf_counter(); "
+        "at = AppTest.from_file('app.py', default_timeout=120).run(); "
+        "assert not at.exception, at.exception; print(f'RENDER_S {time.perf_counter() - start}')"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, env=app_env(), capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(f"first render failed:\n{result.stderr[-2000:]}")
+    return float(result.stdout.split("RENDER_S")[-1])
+
+
+def package_times(rows):
+    """Cumulative import time per top-level package, counted where another package (or the script) imports it."""
+    totals = {}
+    parents = []  # (depth, package) of the enclosing imports; -X importtime lists children before parents
+    for name, _, cumulative_us, depth in reversed(rows):
+        while parents and parents[-1][0] >= depth:
+            parents.pop()
+        package = name.split(".")[0]
+        if not parents or parents[-1][1] != package:
+            totals[package] = totals.get(package, 0) + cumulative_us
+        parents.append((depth, package))
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def deferred_imports(rows):
+    names = {name for name, *_ in rows}
+    return sorted(
+        name for name in names
+        if any(name == module or name.startswith(module + ".") for module in DEFERRED_MODULES)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20, help="Slowest packages and modules to list")
+    parser.add_argument("--render", action="store_true", help="Also time the first render of a session")
+    parser.add_argument("--check", action="store_true", help="Exit 1 on deferred imports or a blown budget")
+    parser.add_argument("--budget-ms", type=float, default=1500.0, help="Allowed median import time")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    rows = import_profile()
+    packages = package_times(rows)
+    total_us = sum(cumulative_us for _, _, cumulative_us, depth in rows if depth == 0)
+    print(f"Import-time breakdown ({len(rows)} modules, {total_us / 1000:.0f}ms with -X importtime)")
+    for package, cumulative_us in packages[:args.top]:
+        note = "  (prewarm thread)" if package in PREWARM_MODULES else ""
+        print(f"  {package:<32} {cumulative_us / 1000:8.1f}ms  {100 * cumulative_us / total_us:5.1f}%{note}")
+    print("Slowest modules (self time)")
+    for name, self_us, _, _ in sorted(rows, key=lambda row: row[1], reverse=True)[:args.top]:
+        print(f"  {name:<48} {self_us / 1000:8.1f}ms")
+
+    seconds = [import_seconds() for _ in range(args.repeats)]
+    results = {
+        "import_p50_ms": statistics.median(seconds) * 1000,
+        "import_max_ms": max(seconds) * 1000,
+        "modules": len(rows),
+        "packages_ms": {package: cumulative_us / 1000 for package, cumulative_us in packages},
+        "deferred_imported": deferred_imports(rows),
+    }
+    print(f"import app: p50 {results['import_p50_ms']:.0f}ms  max {results['import_max_ms']:.0f}ms")
+    if args.render:
+        results["first_render_ms"] = first_render_seconds() * 1000
+        print(f"first render: {results['first_render_ms']:.0f}ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.check:
+        failures = [f"{name} is imported at startup" for name in results["deferred_imported"]]
+        if results["import_p50_ms"] > args.budget_ms:
+            failures.append(f"import app p50 {results['import_p50_ms']:.0f}ms > budget {args.budget_ms:.0f}ms")
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
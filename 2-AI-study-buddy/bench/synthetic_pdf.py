@@ -0,0 +1,72 @@
+# bench/synthetic_pdf.py
+"""Writes deterministic text PDFs of any page count for benchmarks, without extra dependencies."""
+import random
+
+VOCABULARY = (
+    "cell membrane nucleus mitochondria ribosome protein enzyme energy glucose photosynthesis "
+    "chlorophyll respiration osmosis diffusion gradient molecule atom electron bond reaction "
+    "catalyst equilibrium pressure volume temperature velocity acceleration force momentum "
+    "gravity orbit planet economy market supply demand inflation policy revenue history empire "
+    "revolution treaty parliament democracy literature metaphor narrative theory evidence "
+    "hypothesis experiment variable analysis function derivative integral matrix vector"
+).split()
+
+LINES_PER_PAGE = 46
+WORDS_PER_LINE = 12
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def page_lines(rng, page_number):
+    lines = [f"Chapter {page_number // 10 + 1}.{page_number % 10 + 1} {rng.choice(VOCABULARY).title()}", ""]
+    while len(lines) < LINES_PER_PAGE:
+        sentence = " ".join(rng.choice(VOCABULARY) for _ in range(WORDS_PER_LINE))
+        lines.append(sentence.capitalize() + ".")
+        if rng.random() < 0.15:
+            lines.append("")  # Paragraph break
+    return lines[:LINES_PER_PAGE]
+
+
+def write_pdf(path, page_count, seed=0):
+    """Writes a PDF with `page_count` pages of Helvetica text to `path`."""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Page tree, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for number in range(page_count):
+        text_ops = ["BT", "/F1 10 Tf", "13 TL", "56 780 Td"]
+        for line in page_lines(rng, number):
+            text_ops.append(f"({escape(line)}) Tj T*")
+        text_ops.append("ET")
+        stream = "\n".join(text_ops).encode("latin-1")
+
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_ref = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_ref
+        )
+        page_refs.append(len(objects))
+
+    kids = " ".join(f"{ref} 0 R" for ref in page_refs).encode()
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % page_count
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_at = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_at)
+
+    with open(path, "wb") as f:
+        f.write(out)
+    return path
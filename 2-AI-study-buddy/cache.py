@@ -0,0 +1,476 @@
+# cache.py
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from langchain_core.documents import Document
+from commons import (
+    CACHE_DIR, PACK_DIR, EMBEDDING_NAME, INGEST_CACHE_MAX_BYTES, EMBEDDING_BATCH_SIZE,
+    GENERATION_CACHE_TTL_S, GENERATION_CACHE_MAX_BYTES, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_S, ANSWER_CACHE_SIZE,
+    QUERY_EMBEDDING_CACHE_SIZE,
+)
+
+INGEST_DIR = os.path.join(CACHE_DIR, "ingest")
+
+
+def file_hash(pdf) -> str:
+    """Returns the sha256 of an uploaded file (or any file-like object) without moving its cursor."""
+    if hasattr(pdf, "getvalue"):
+        data = pdf.getvalue()
+    else:
+        position = pdf.tell()
+        pdf.seek(0)
+        data = pdf.read()
+        pdf.seek(position)
+    return hashlib.sha256(data).hexdigest()
+
+
+def splitter_settings(text_splitter) -> dict:
+    """Settings of the splitter that change the produced chunks."""
+    return {
+        "type": type(text_splitter).__name__,
+        "chunk_size": getattr(text_splitter, "_chunk_size", None),
+        "chunk_overlap": getattr(text_splitter, "_chunk_overlap", None),
+        "chunking": "structure",  # Paragraph/heading-aware splitting per page range, see chunking.py
+    }
+
+
+def ingest_cache_key(pdf_docs, text_splitter) -> str:
+    """Content address of an upload: the PDF bytes, the splitter settings, the embedding model and the index settings."""
+    from indexes import index_settings  # indexes.py imports faiss, needed only once PDFs are processed
+    key_data = {
+        "files": [file_hash(pdf) for pdf in pdf_docs],
+        "splitter": splitter_settings(text_splitter),
+        "embedding": EMBEDDING_NAME,
+        "index": index_settings(),
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def load_ingest(key, embedding):
+    """Returns (documents, vectorstore) for a cached upload, or None on a miss."""
+    from langchain_community.vectorstores import FAISS
+    from indexes import prepare_index
+    entry_dir = os.path.join(INGEST_DIR, key)
+    if not os.path.isdir(entry_dir):
+        return None
+
+    try:
+        with open(os.path.join(entry_dir, "chunks.json"), encoding="utf-8") as f:
+            stored = json.load(f)
+        documents = [
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(stored["chunks"], stored["metadatas"])
+        ]
+        # The index was written by save_ingest below, so unpickling its docstore is safe
+        vectorstore = FAISS.load_local(
+            os.path.join(entry_dir, "faiss"), embedding, allow_dangerous_deserialization=True
+        )
+        prepare_index(vectorstore.index)  # Search parameters aren't stored in the index file
+    except Exception as e:
+        print(f"Ignoring unreadable ingest cache entry {key}: {e}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    os.utime(entry_dir)  # Mark as recently used for LRU eviction
+    return documents, vectorstore
+
+
+def save_ingest(key, documents, vectorstore):
+    """Stores a processed upload and evicts old entries above INGEST_CACHE_MAX_BYTES."""
+    os.makedirs(INGEST_DIR, exist_ok=True)
+    entry_dir = os.path.join(INGEST_DIR, key)
+
+    try:
+        # Write into a temporary directory first so readers never see a half-written entry
+        tmp_dir = tempfile.mkdtemp(dir=INGEST_DIR, prefix=".tmp-")
+        with open(os.path.join(tmp_dir, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "chunks": [doc.page_content for doc in documents],
+                "metadatas": [doc.metadata for doc in documents],
+            }, f)
+        vectorstore.save_local(os.path.join(tmp_dir, "faiss"))
+
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # Another session stored it first
+        else:
+            os.replace(tmp_dir, entry_dir)
+    except Exception as e:
+        print(f"Error writing ingest cache entry {key}: {e}")
+        return
+
+    evict_ingest(INGEST_CACHE_MAX_BYTES)
+
+
+def dir_size(path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def evict_ingest(max_bytes):
+    """Deletes least recently used entries until the ingest cache fits in `max_bytes`."""
+    if not os.path.isdir(INGEST_DIR):
+        return
+
+    entries = []
+    for name in os.listdir(INGEST_DIR):
+        path = os.path.join(INGEST_DIR, name)
+        if os.path.isdir(path) and not name.startswith(".tmp-"):
+            entries.append((os.path.getmtime(path), dir_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):  # Oldest first
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def load_pack(file_hash):
+    """Returns the study pack batch.py wrote for the PDF with this hash, or None."""
+    try:
+        with open(os.path.join(PACK_DIR, f"{file_hash}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable study pack {file_hash}: {e}")
+        return None
+
+
+def save_pack(file_hash, pack):
+    """Writes a study pack atomically, so a crash never leaves a half-written pack behind."""
+    os.makedirs(PACK_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PACK_DIR, prefix=".tmp-", suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(pack, f)
+    os.replace(tmp_path, os.path.join(PACK_DIR, f"{file_hash}.json"))
+
+
+def text_hash(text) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """Persistent chunk embeddings keyed by (model name, text hash), stored as float32 blobs in SQLite."""
+
+    # SQLite limits the number of bound parameters per statement
+    LOOKUP_BATCH = 500
+
+    def __init__(self, path, model_name=EMBEDDING_NAME):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self.conn.commit()
+        self.hits = 0  # Unique texts served from the store
+        self.misses = 0  # Unique texts sent to the embedding API
+        self.duplicates = 0  # Repeated texts within a batch that were embedded only once
+        self.api_calls = 0
+
+    def lookup(self, hashes) -> dict:
+        found = {}
+        with self.lock:
+            for i in range(0, len(hashes), self.LOOKUP_BATCH):
+                batch = hashes[i:i + self.LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model_name, *batch],
+                )
+                for hash_, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[hash_] = vector.tolist()
+        return found
+
+    def store(self, items):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(self.model_name, hash_, array("f", vector).tobytes()) for hash_, vector in items],
+            )
+            self.conn.commit()
+
+    def embed_texts(self, texts, embedding, batch_size=EMBEDDING_BATCH_SIZE) -> list:
+        """Returns one vector per text, embedding only the texts that are not stored yet."""
+        hashes = [text_hash(text) for text in texts]
+        unique = dict(zip(hashes, texts))  # Dedupe within the batch, keeps first-seen order
+        self.duplicates += len(hashes) - len(unique)
+
+        vectors = self.lookup(list(unique))
+        missing = [hash_ for hash_ in unique if hash_ not in vectors]
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            new_vectors = embedding.embed_documents([unique[hash_] for hash_ in batch])
+            self.api_calls += 1
+            self.store(zip(batch, new_vectors))
+            vectors.update(zip(batch, new_vectors))
+
+        return [vectors[hash_] for hash_ in hashes]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "duplicates": self.duplicates,
+            "api_calls": self.api_calls,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class QueryEmbeddingCache:
+    """Embeddings of recent chat questions, shared by all sessions and kept in memory only: unlike
+    chunks, questions are user text, and most are asked once. The answer cache lookup and the
+    retriever embed a question through here, so it's sent to the API once. Above `max_entries`
+    the least recently used go.
+    """
+
+    def __init__(self, max_entries=QUERY_EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.vectors = OrderedDict()  # (model name, text hash) -> vector
+        self.hits = 0
+        self.misses = 0
+
+    def embed_query(self, text, embedding) -> list:
+        key = (getattr(embedding, "model", EMBEDDING_NAME), text_hash(text))
+        with self.lock:
+            vector = self.vectors.get(key)
+            if vector is not None:
+                self.vectors.move_to_end(key)
+                self.hits += 1
+                return vector
+            self.misses += 1
+        vector = embedding.embed_query(text)
+        with self.lock:
+            self.vectors[key] = vector
+            while len(self.vectors) > self.max_entries:
+                self.vectors.popitem(last=False)
+        return vector
+
+    def clear(self):
+        with self.lock:
+            self.vectors.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.vectors), "hits": self.hits, "misses": self.misses}
+
+
+@lru_cache(maxsize=None)
+def get_query_embeddings() -> QueryEmbeddingCache:
+    return QueryEmbeddingCache()
+
+
+def generation_key(tool_name, prompt, model, text) -> str:
+    """Cache key of an LLM result: tool, prompt template, model and input text."""
+    model_name = getattr(model, "model_name", None) or type(model).__name__
+    return f"{tool_name}:{text_hash(prompt.template)}:{model_name}:{text_hash(text)}"
+
+
+class ResultCache:
+    """Persistent JSON results (e.g. parsed LLM outputs) keyed by a caller-built string key.
+
+    Entries expire `ttl` seconds after they were written, and least recently used
+    entries are evicted once the stored values exceed `max_bytes`.
+    """
+
+    # Eviction scans the table, so it runs once per this many writes
+    EVICT_EVERY = 50
+
+    def __init__(self, path, ttl=GENERATION_CACHE_TTL_S, max_bytes=GENERATION_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def get(self, key):
+        """Returns the stored value, or None on a miss or an expired entry."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self.conn.commit()
+            self.writes += 1
+            if self.writes % self.EVICT_EVERY == 0:
+                self.evict()
+
+    def evict(self):
+        """Drops expired entries, then least recently used ones until the values fit in max_bytes. Caller holds the lock."""
+        self.conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        total = self.conn.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM results").fetchone()[0]
+        if total > self.max_bytes:
+            rows = self.conn.execute("SELECT key, LENGTH(value) FROM results ORDER BY accessed").fetchall()
+            stale = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            self.conn.executemany("DELETE FROM results WHERE key = ?", stale)
+        self.conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_result_cache() -> ResultCache:
+    return ResultCache(os.path.join(CACHE_DIR, "results.sqlite"))
+
+
+class SemanticCache:
+    """In-memory chat answers keyed by (scope, question embedding), shared by all sessions.
+
+    A lookup returns the stored answer of the most similar earlier question in the same scope
+    (e.g. index and retrieval settings) if the cosine similarity reaches `threshold`. Entries
+    expire `ttl` seconds after they were stored; above `max_entries` the least recently used go.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL_S, max_entries=ANSWER_CACHE_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # entry id -> {"scope", "value", "created", "latency_s"}
+        self.scopes = {}  # scope -> {"ids": [entry id, ...], "vectors": normalized vectors, one row per id}
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, scope, vector, latency_s=0.0):
+        """Returns (answer, similarity) on a hit, else None. `latency_s` is how long the lookup
+        took, to report the time saved compared to the original answer."""
+        vector = self.normalize(vector)
+        with self.lock:
+            self.remove_expired(scope)
+            rows = self.scopes.get(scope)
+            if rows is not None:
+                similarities = rows["vectors"] @ vector
+                best = int(np.argmax(similarities))
+                entry_id = rows["ids"][best]
+                entry = self.entries[entry_id]
+                if similarities[best] >= self.threshold:
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    self.seconds_saved += max(0.0, entry["latency_s"] - latency_s)
+                    return entry["value"], float(similarities[best])
+            self.misses += 1
+            return None
+
+    def store(self, scope, vector, value, latency_s):
+        """Stores an answer that took `latency_s` seconds to produce."""
+        vector = self.normalize(vector)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {"scope": scope, "value": value, "created": time.time(), "latency_s": latency_s}
+            rows = self.scopes.setdefault(scope, {"ids": [], "vectors": np.empty((0, len(vector)), dtype=np.float32)})
+            rows["ids"].append(entry_id)
+            rows["vectors"] = np.vstack([rows["vectors"], vector])
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+
+    def remove_expired(self, scope):
+        """Drops the scope's entries older than the TTL, so they can't hide a valid match. Entries
+        are appended in creation order, so the expired ones are the first rows. Caller holds the lock."""
+        rows = self.scopes.get(scope)
+        if rows is None:
+            return
+        cutoff = time.time() - self.ttl
+        expired = 0
+        while expired < len(rows["ids"]) and self.entries[rows["ids"][expired]]["created"] < cutoff:
+            expired += 1
+        if not expired:
+            return
+        for entry_id in rows["ids"][:expired]:
+            del self.entries[entry_id]
+        del rows["ids"][:expired]
+        rows["vectors"] = rows["vectors"][expired:]
+        if not rows["ids"]:
+            del self.scopes[scope]
+
+    def remove(self, entry_id):
+        """Caller holds the lock."""
+        entry = self.entries.pop(entry_id)
+        rows = self.scopes[entry["scope"]]
+        row = rows["ids"].index(entry_id)
+        del rows["ids"][row]
+        rows["vectors"] = np.delete(rows["vectors"], row, axis=0)
+        if not rows["ids"]:
+            del self.scopes[entry["scope"]]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "seconds_saved": self.seconds_saved,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_answer_cache() -> SemanticCache:
+    return SemanticCache()
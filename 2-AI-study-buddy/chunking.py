@@ -0,0 +1,157 @@
+# chunking.py
+"""Structure-aware splitting of extracted PDF pages into token-bounded chunks.
+
+Runs inside the PDF worker processes (see utils.chunk_pdfs), so it only uses tiktoken and
+plain data: pages go in as (page number, text), chunks come out as (text, metadata).
+"""
+import re
+from functools import lru_cache
+import tiktoken
+
+HEADING_MAX_CHARS = 80
+# A heading starts a new chunk once the current one holds this fraction of the chunk size;
+# smaller sections are kept together instead of becoming tiny chunks
+HEADING_BREAK_FILL = 0.25
+
+NUMBERED_HEADING = re.compile(r"(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.)\s+[^\W\d]")
+KEYWORD_HEADING = re.compile(r"(?:chapter|section|part|unit|lesson|appendix)\s+\w+", re.IGNORECASE)
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(name)
+
+
+def splitter_config(text_splitter) -> tuple:
+    """(chunk_size, chunk_overlap, encoding name) of a TokenTextSplitter, which can be sent to workers."""
+    return text_splitter._chunk_size, text_splitter._chunk_overlap, text_splitter._tokenizer.name
+
+
+def is_heading(line) -> bool:
+    """Short lines that look like "# Title", "2.3 Enzymes", "Chapter 4 ..." or "SUMMARY"."""
+    line = line.strip()
+    if not line or len(line) > HEADING_MAX_CHARS:
+        return False
+    if line.startswith("#"):
+        return True
+    if line[-1] in ".,;:!?":
+        return False
+    if NUMBERED_HEADING.match(line) or KEYWORD_HEADING.match(line):
+        return True
+    letters = [c for c in line if c.isalpha()]
+    return len(letters) >= 3 and all(c.isupper() for c in letters)
+
+
+def iter_blocks(text):
+    """Yields (offset, text, is_heading) for the paragraphs and headings of a page.
+
+    Paragraphs end at blank lines and headings; `offset` is the character position in `text`.
+    """
+    paragraph_start = None
+    position = 0
+    for line in text.splitlines(keepends=True):
+        line_start = position
+        position += len(line)
+        if not line.strip() or is_heading(line):
+            if paragraph_start is not None:
+                yield paragraph_start, text[paragraph_start:line_start].strip(), False
+                paragraph_start = None
+            if line.strip():
+                yield line_start + len(line) - len(line.lstrip()), line.strip(), True
+        elif paragraph_start is None:
+            paragraph_start = line_start + len(line) - len(line.lstrip())
+    if paragraph_start is not None:
+        yield paragraph_start, text[paragraph_start:].strip(), False
+
+
+def split_oversized(offset, text, encoding, chunk_size):
+    """Yields (offset, text, tokens) pieces of a block longer than a chunk: whole sentences where
+    possible, token windows for sentences that are too long themselves."""
+    start = 0
+    for match in [*SENTENCE_END.finditer(text), None]:
+        end = match.start() if match else len(text)
+        sentence = text[start:end]
+        tokens = encoding.encode(sentence, disallowed_special=())
+        if len(tokens) <= chunk_size:
+            yield offset + start, sentence, len(tokens)
+        else:
+            position = start
+            for window_start in range(0, len(tokens), chunk_size):
+                window = encoding.decode(tokens[window_start:window_start + chunk_size])
+                yield offset + position, window, len(tokens[window_start:window_start + chunk_size])
+                position += len(window)
+        start = match.end() if match else len(text)
+
+
+def iter_pieces(pages, encoding, chunk_size):
+    """Yields [text, page, offset, tokens, is_heading, separator] for every piece of the pages, in order."""
+    for page, text in pages:
+        for offset, block, heading in iter_blocks(text):
+            tokens = len(encoding.encode(block, disallowed_special=()))
+            if tokens <= chunk_size:
+                yield [block, page, offset, tokens, heading, "\n\n"]
+                continue
+            for number, (piece_offset, piece, piece_tokens) in enumerate(split_oversized(offset, block, encoding, chunk_size)):
+                yield [piece, page, piece_offset, piece_tokens, False, "\n\n" if number == 0 else " "]
+
+
+def chunk_pages(pages, chunk_size, chunk_overlap, encoding_name):
+    """Splits consecutive pages of one document into chunks of at most `chunk_size` tokens.
+
+    Chunks end at paragraph boundaries (sentences, for paragraphs longer than a chunk) and
+    preferably before headings. Consecutive chunks share up to `chunk_overlap` tokens of
+    whole paragraphs, except across a heading. Returns ([(text, metadata)], token count), where
+    metadata has the page and character offset the chunk starts at, its end page and the
+    heading of the section it starts in.
+    """
+    encoding = get_encoding(encoding_name)
+    chunks, current = [], []
+    total_tokens = 0
+    section = None
+
+    def emit():
+        first = current[0]
+        text = first[0] + "".join(piece[5] + piece[0] for piece in current[1:])
+        metadata = {"page": first[1], "offset": first[2], "end_page": current[-1][1]}
+        if first[6]:
+            metadata["section"] = first[6]
+        chunks.append((text, metadata))
+
+    separator_tokens = {separator: len(encoding.encode(separator)) for separator in ("\n\n", " ")}
+
+    def size(pieces):
+        # Pieces are tokenized separately, so this can be off by a token where a join merges tokens
+        return sum(piece[3] for piece in pieces) + sum(separator_tokens[piece[5]] for piece in pieces[1:])
+
+    for piece in iter_pieces(pages, encoding, chunk_size):
+        total_tokens += piece[3]
+        heading = piece[4]
+        if heading:
+            section = piece[0]
+        piece.append(section)
+
+        if current:
+            full = size(current + [piece]) > chunk_size
+            section_break = heading and size(current) >= chunk_size * HEADING_BREAK_FILL
+            if full or section_break:
+                carried = []
+                if current[-1][4]:
+                    carried = [current.pop()]  # Don't leave a heading at the end of a chunk
+                if current:
+                    emit()
+                if not heading and not carried:
+                    # Overlap: repeat the trailing pieces that fit in chunk_overlap
+                    for previous in reversed(current):
+                        if size([previous] + carried) > chunk_overlap or size([previous] + carried + [piece]) > chunk_size:
+                            break
+                        carried.insert(0, previous)
+                current = carried
+                if current and size(current + [piece]) > chunk_size:
+                    emit()  # A heading followed by a full-size piece
+                    current = []
+        current.append(piece)
+
+    if current:
+        emit()
+    return chunks, total_tokens
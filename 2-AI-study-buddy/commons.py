@@ -1,21 +1,202 @@
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from openai import OpenAI
+from functools import lru_cache
+from typing import TYPE_CHECKING
 import os
+import threading
+
+# The client and tokenizer libraries take seconds to import, so they are imported where the
+# clients are built (on first use), not when the page first renders
+if TYPE_CHECKING:
+    import tiktoken
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from langchain_text_splitters import TokenTextSplitter
+    from openai import OpenAI
+
+load_dotenv()
 
 MODEL_NAME = "gpt-4o-mini"
 EMBEDDING_NAME = "text-embedding-3-small"
-BASE_URL = "https://ainovate.novare.com.hk/"
+BASE_URL = os.getenv("STUDY_BUDDY_BASE_URL", "https://ainovate.novare.com.hk/")
 MODERATION_MODEL = "omni-moderation-latest"
 
+# Max number of LLM calls in flight when fanning out over text chunks
+MAX_CONCURRENCY = 4
 
-load_dotenv()
+# On-disk cache for processed uploads (chunks with page metadata and FAISS index)
+CACHE_DIR = os.getenv("STUDY_BUDDY_CACHE_DIR", ".cache")
+INGEST_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Least recently used entries are evicted above this size
+
+# Study packs (summary, flashcards and quiz of one PDF) pre-generated by batch.py, loaded by the app
+# instead of generating them again when a student uploads the same PDF
+PACK_DIR = os.getenv("STUDY_BUDDY_PACK_DIR", os.path.join(CACHE_DIR, "packs"))
+
+# Chunk embeddings are cached in SQLite; only misses are sent to the API, this many texts per request.
+# Chat questions are user text and only cached in memory, the QUERY_EMBEDDING_CACHE_SIZE most recent
+EMBEDDING_BATCH_SIZE = 512
+QUERY_EMBEDDING_CACHE_SIZE = 2000
+
+# PDF pages are extracted and split into chunks in worker processes, PDF_PAGES_PER_TASK pages
+# per task. Chunks don't span two tasks, so larger tasks mean fewer chunks cut at a task boundary
+PDF_WORKERS = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 16
+
+# Summaries: concatenated text up to this many tokens is summarized in one call, larger inputs are
+# summarized per chunk and the partial summaries collapsed level by level until they fit
+SUMMARY_TOKEN_BUDGET = 6000
+
+# Flashcards/quizzes: consecutive chunks are packed into one request up to this many tokens (0 disables packing)
+PACK_TOKEN_BUDGET = 8000
+
+# Generated summaries, flashcards and quiz questions are cached per chunk
+GENERATION_CACHE_TTL_S = 30 * 24 * 3600
+GENERATION_CACHE_MAX_BYTES = 256 * 1024 ** 2  # Least recently used results are evicted above this size
+
+# Moderation: verdicts are cached per normalized text, greetings and thanks on a small exact allowlist
+# skip the API (False disables that), and in overlap mode moderation runs during retrieval
+MODERATION_TIMEOUT_S = 5.0
+MODERATION_RETRIES = 2
+MODERATION_CACHE_SIZE = 10000
+MODERATION_ALLOWLIST = True
+MODERATION_OVERLAP = True
+
+# Spans of the hot paths can be exported as JSON lines to STUDY_BUDDY_TRACE_FILE (off by default).
+# Spans are written in batches, once TRACE_FLUSH_SPANS are buffered or TRACE_FLUSH_INTERVAL_S after the
+# last write. Above TRACE_FILE_MAX_BYTES the file is moved to "<file>.1" (replacing the previous one)
+TRACE_FILE = os.getenv("STUDY_BUDDY_TRACE_FILE", "")
+TRACE_FLUSH_SPANS = 200
+TRACE_FLUSH_INTERVAL_S = 5.0
+TRACE_FILE_MAX_BYTES = 64 * 1024 ** 2
+
+# FAISS index type: "flat", "ivf", "hnsw", "ivfpq", "ivfsq" or "auto" (flat up to INDEX_AUTO_FLAT_MAX
+# chunks, IVF up to INDEX_AUTO_IVF_MAX, 8-bit quantized IVF above). IVF variants are trained on a
+# sample of INDEX_TRAIN_SAMPLE vectors; 0 for nlist / PQ sub-vectors picks them from the corpus size
+INDEX_TYPE = os.getenv("STUDY_BUDDY_INDEX_TYPE", "auto")
+INDEX_AUTO_FLAT_MAX = 20000
+INDEX_AUTO_IVF_MAX = 500000
+INDEX_NLIST = 0
+INDEX_NPROBE = 16
+INDEX_HNSW_M = 32
+INDEX_HNSW_EF_SEARCH = 64
+INDEX_PQ_M = 0
+INDEX_TRAIN_SAMPLE = 50000
+
+# Loaded indexes are shared by all sessions that uploaded the same PDFs. Indexes no session is
+# attached to are dropped above this size; a session idle this long counts as detached
+INDEX_REGISTRY_MAX_BYTES = 2 * 1024 ** 3
+INDEX_REGISTRY_SESSION_TTL_S = 3600
+
+# Chat retrieval defaults (mode "hybrid", "similarity", "threshold" or "mmr", changeable per session in
+# the sidebar). Retrieved chunks are packed into the prompt up to CONTEXT_TOKEN_BUDGET tokens (0: no limit)
+RETRIEVAL_MODE = "hybrid"
+RETRIEVAL_K = 4
+RETRIEVAL_FETCH_K = 20
+RETRIEVAL_SCORE_THRESHOLD = 0.5
+RETRIEVAL_LAMBDA_MULT = 0.5
+CONTEXT_TOKEN_BUDGET = 6000  # Chunks are up to 4000 tokens (TokenTextSplitter default)
+
+# Hybrid mode mixes BM25 scores from a local inverted index (weight HYBRID_LEXICAL_WEIGHT) with vector
+# relevance. When the best BM25 match contains every query term and scores LEXICAL_CONFIDENT_MARGIN
+# times the match just outside the top k, the lexical results are used and the question isn't embedded
+BM25_K1 = 1.2
+BM25_B = 0.75
+HYBRID_LEXICAL_WEIGHT = 0.5
+LEXICAL_FAST_PATH = True
+LEXICAL_CONFIDENT_MARGIN = 1.5
+
+# Chat answers are reused for questions whose embedding has at least this cosine similarity to an
+# earlier question on the same documents and retrieval settings (False disables the answer cache)
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_TTL_S = 7 * 24 * 3600
+ANSWER_CACHE_SIZE = 5000  # Least recently used answers are evicted above this many
+
+# Background jobs (generation and ingestion) running at once per server process
+MAX_CONCURRENT_JOBS = 4
+
+# Stream chat answers token by token instead of waiting for the full completion
+STREAM_ANSWERS = True
+
+# The chat shows the last CHAT_WINDOW_MESSAGES messages; older ones stay collapsed behind a button
+# that shows CHAT_PAGE_MESSAGES more at a time (0 shows the whole history)
+CHAT_WINDOW_MESSAGES = int(os.getenv("STUDY_BUDDY_CHAT_WINDOW", "20"))
+CHAT_PAGE_MESSAGES = 20
+
+# Sessions idle this long (0: never) have their chat and study aids written to SESSION_SPILL_DIR and
+# their index references dropped; both come back on the next rerun. Spilled state is kept this long
+SESSION_SPILL_AFTER_S = int(os.getenv("STUDY_BUDDY_SESSION_SPILL_AFTER_S", "900"))
+SESSION_SPILL_DIR = os.path.join(CACHE_DIR, "sessions")
+SESSION_SPILL_TTL_S = 24 * 3600
+
+# Every API request goes through one process-wide scheduler (scheduler.py): token buckets on requests
+# and tokens per minute (0: no limit), at most SCHEDULER_MAX_CONCURRENCY requests in flight (halved on
+# 429/5xx, growing back on success), chat before background generation. Throttled and failed
+# requests are retried up to SCHEDULER_MAX_RETRIES times, honouring Retry-After
+RATE_LIMIT_RPM = int(os.getenv("STUDY_BUDDY_RATE_LIMIT_RPM", "500"))
+RATE_LIMIT_TPM = int(os.getenv("STUDY_BUDDY_RATE_LIMIT_TPM", "200000"))
+SCHEDULER_MAX_CONCURRENCY = 16
+SCHEDULER_MAX_RETRIES = 4
+SCHEDULER_BACKOFF_S = 1.0
+SCHEDULER_COMPLETION_TOKENS = 500  # Expected answer length, counted against the token bucket
+
+
+def http_client():
+    """The scheduled HTTP client all API clients share, see scheduler.py."""
+    from scheduler import get_http_client  # scheduler.py reads its settings from this module
+    return get_http_client()
+
+# The clients don't retry (max_retries=0): the scheduled transport retries throttled and failed requests
+# within their timeout, and SDK retries on top would multiply its attempts
+def init_model() -> "ChatOpenAI":
+    from langchain_openai import ChatOpenAI
+    # stream_usage reports token counts for streamed answers too
+    return ChatOpenAI(
+        model_name=MODEL_NAME, base_url=BASE_URL, stream_usage=True, max_retries=0, http_client=http_client()
+    )
+
+def init_embedding() -> "OpenAIEmbeddings":
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(model=EMBEDDING_NAME, base_url=BASE_URL, max_retries=0, http_client=http_client())
+
+def init_moderation() -> "OpenAI":
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=BASE_URL, max_retries=0, http_client=http_client())
+
+
+# Process-wide shared clients. Streamlit re-runs app.py on every interaction but keeps imported
+# modules, so these are built once per server process and keep their HTTP connection pools warm.
+@lru_cache(maxsize=None)
+def get_model() -> "ChatOpenAI":
+    return init_model()
+
+@lru_cache(maxsize=None)
+def get_embedding() -> "OpenAIEmbeddings":
+    return init_embedding()
+
+@lru_cache(maxsize=None)
+def get_moderation() -> "OpenAI":
+    return init_moderation()
+
+@lru_cache(maxsize=None)
+def get_text_splitter() -> "TokenTextSplitter":
+    from langchain_text_splitters import TokenTextSplitter
+    return TokenTextSplitter.from_tiktoken_encoder(model_name=MODEL_NAME)
 
-def init_model() -> ChatOpenAI:
-    return ChatOpenAI(model_name=MODEL_NAME, base_url=BASE_URL)
+@lru_cache(maxsize=None)
+def get_tokenizer() -> "tiktoken.Encoding":
+    """The tiktoken encoding the text splitter uses, for token budgeting."""
+    import tiktoken
+    return tiktoken.encoding_for_model(MODEL_NAME)
 
-def init_embedding() -> OpenAIEmbeddings:
-    return OpenAIEmbeddings(model=EMBEDDING_NAME, base_url=BASE_URL)
+def count_tokens(text: str) -> int:
+    return len(get_tokenizer().encode(text, disallowed_special=()))
 
-def init_moderation() -> OpenAI:
-    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=BASE_URL)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def prewarm_tokenizer() -> threading.Thread:
+    """Loads the tokenizer and text splitter in a background thread, once per process. The page
+    renders without waiting for them, and they are usually ready by the first upload."""
+    def load():
+        get_tokenizer()
+        get_text_splitter()
+    thread = threading.Thread(target=load, name="prewarm-tokenizer", daemon=True)
+    thread.start()
+    return thread
@@ -1,7 +1,46 @@
 import streamlit as st
+from tracing import get_session_spans, summarize_spans
+from actions import get_session_jobs, has_undelivered_items, cancel_job, get_retrieval_settings, JOB_LABELS
+from retrieval import RETRIEVAL_MODES, parse_pages
+from registry import get_index_registry
+from sessions import get_session_spiller
+from cache import get_answer_cache
+from moderation import get_moderation_stats
+from scheduler import get_scheduler
+
+# Flashcard navigation buttons get equal widths. Drawn inside the keyed container, so the CSS is only
+# sent while flashcards are shown; the selector only matches there, so other buttons keep their size.
+# Streamlit drops elements a rerun doesn't draw again, so it can't be sent just once per session
+FLASHCARD_NAV_STYLES = """
+<style>
+.st-key-flashcard_nav div.stButton > button {
+    min-width: 150px;
+}
+</style>
+"""
+
+def item_count(items, generating):
+    """ "M" for the "N of M" counters, marked while a background job is still adding items."""
+    return f"{len(items)} (generating...)" if generating else f"{len(items)}"
+
+def render_live(render, generating):
+    """Calls render(), and again every second while a background job is still adding items."""
+    if generating:
+        st.fragment(run_every=1)(render)()
+    else:
+        render()
+
+@st.fragment(run_every=1)
+def wait_for_more(items, available, message):
+    """Shown at the end of a list that is still being generated; reruns the app once it grows."""
+    if len(items) > available:
+        st.rerun()
+    st.info(message)
 
 def display_quiz():
     if "quiz_questions" in st.session_state and st.session_state.quiz_questions:
+        quiz_questions = st.session_state.quiz_questions
+        generating = st.session_state.get("generating_quiz", False)
         if "current_question" not in st.session_state:
             st.session_state.current_question = 0
         if "score" not in st.session_state:
@@ -12,14 +51,16 @@ def display_quiz():
         if st.session_state.current_question < len(st.session_state.quiz_questions):
             question_data = st.session_state.quiz_questions[st.session_state.current_question]
 
-            st.subheader(f"Question {st.session_state.current_question + 1} of {len(st.session_state.quiz_questions)}")
-            st.markdown(f"**{question_data.get('Question', 'Question text not available')}**")
+            def question_counter():
+                st.subheader(f"Question {st.session_state.current_question + 1} of {item_count(quiz_questions, generating)}")
+            render_live(question_counter, generating)
+            st.markdown(f"**{question_data.question or 'Question text not available'}**")
 
-            question_type = question_data.get("Type")
+            question_type = question_data.type
 
             # Multiple-Choice Question Handling
             if question_type == "multiple_choice":
-                options_str = question_data.get("Options", "")
+                options_str = question_data.options
                 options_list = options_str.split(",")
 
                 options = {}
@@ -49,8 +90,8 @@ def display_quiz():
             if not st.session_state.submitted:
                 if st.button("Submit"):
                     st.session_state.submitted = True
-                    correct_answer = question_data.get("Correct Answer")
-                    explanation = question_data.get("Explanation", "No explanation available.")
+                    correct_answer = question_data.correct_answer
+                    explanation = question_data.explanation or "No explanation available."
 
                     # Store the correct answer and explanation for display
                     st.session_state.correct_answer = correct_answer
@@ -78,6 +119,10 @@ def display_quiz():
                     st.session_state.submitted = False  # Reset submission state for the next question
                     st.rerun()
 
+        elif generating:
+            # Answered everything generated so far, the next question shows up as soon as its chunk is done
+            wait_for_more(quiz_questions, st.session_state.current_question, "⏳ Generating the next question...")
+
         else:
             st.subheader("🎉 Quiz Completed!")
             st.write(f"Your final score: **{st.session_state.score} / {len(st.session_state.quiz_questions)}**")
@@ -92,14 +137,13 @@ def display_quiz():
 
             with col2:
                 if st.button("End Quiz"):
+                    cancel_job("quiz")  # Otherwise a still running job reopens the quiz when it finishes
                     del st.session_state.quiz_questions
                     st.session_state.current_question = 0
                     st.session_state.score = 0
                     st.session_state.submitted = False
                     st.rerun()
 
-import streamlit as st
-
 def display_flashcards():
     """Handles the display and interaction of flashcards."""
     if "flashcards" in st.session_state and st.session_state.flashcards:
@@ -109,11 +153,14 @@ def display_flashcards():
 
         flashcards = st.session_state.flashcards
         total_flashcards = len(flashcards)
+        generating = st.session_state.get("generating_flashcards", False)
 
-        st.markdown(f"<h3 style='text-align: center;'>🃏 Flashcard {st.session_state.current_flashcard + 1} of {total_flashcards}</h3>", unsafe_allow_html=True)
+        def flashcard_counter():
+            st.markdown(f"<h3 style='text-align: center;'>🃏 Flashcard {st.session_state.current_flashcard + 1} of {item_count(flashcards, generating)}</h3>", unsafe_allow_html=True)
+        render_live(flashcard_counter, generating)
 
         flashcard = flashcards[st.session_state.current_flashcard]
-        st.markdown(f"<h4 style='text-align: center;'> {flashcard['front']}</h4>", unsafe_allow_html=True)
+        st.markdown(f"<h4 style='text-align: center;'> {flashcard.front}</h4>", unsafe_allow_html=True)
 
         # Reveal Answer Button - Centered
         col = st.columns([2, 1, 2])
@@ -125,54 +172,171 @@ def display_flashcards():
 
         # Show Answer if Revealed
         if st.session_state.reveal_answer:
-            st.markdown(f"<h4 style='text-align: center;'> {flashcard['back']}</h4>", unsafe_allow_html=True)
+            st.markdown(f"<h4 style='text-align: center;'> {flashcard.back}</h4>", unsafe_allow_html=True)
 
         st.markdown("---")
 
-        # Navigation Buttons - Equal columns and centered content
-        col1, col2, col3 = st.columns(3)  # Equal columns
-
-        # Custom CSS for consistent button widths
-        st.markdown(
-            """
-            <style>
-            div.stButton > button {
-                min-width: 150px; /* Adjust this value as needed */
-            }
-            </style>
-            """,
-            unsafe_allow_html=True,
-        )
+        # Navigation Buttons - Equal columns (button widths come from FLASHCARD_NAV_STYLES)
+        nav = st.container(key="flashcard_nav")
+        nav.html(FLASHCARD_NAV_STYLES)  # Style-only HTML takes no space in the layout
+        col1, col2, col3 = nav.columns(3)
 
         with col1:
-            with st.container():
-                st.markdown("<div style='text-align: center;'>", unsafe_allow_html=True)
-                if st.button("⬅️ Previous", disabled=st.session_state.current_flashcard == 0):
-                    st.session_state.current_flashcard -= 1
-                    st.session_state.reveal_answer = False
-                    st.rerun()
-                st.markdown("</div>", unsafe_allow_html=True)
+            if st.button("⬅️ Previous", disabled=st.session_state.current_flashcard == 0):
+                st.session_state.current_flashcard -= 1
+                st.session_state.reveal_answer = False
+                st.rerun()
 
         with col2:
-            with st.container():
-                st.markdown("<div style='text-align: center;'>", unsafe_allow_html=True)
-                if st.button("❌ Exit Flashcards"):
+            if st.button("❌ Exit Flashcards"):
+                cancel_job("flashcards")  # Stop generating cards nobody will look at
+                for key in ["current_flashcard", "reveal_answer", "flashcards"]:
+                    st.session_state.pop(key, None)
+                st.rerun()
+
+        with col3:
+            if st.session_state.current_flashcard < total_flashcards - 1:
+                if st.button("➡️ Next"):
+                    st.session_state.current_flashcard += 1
+                    st.session_state.reveal_answer = False
+                    st.rerun()
+            elif generating:
+                wait_for_more(flashcards, total_flashcards, "⏳ More cards coming...")
+            else:
+                if st.button("🏁 Exit Flashcards"):
                     for key in ["current_flashcard", "reveal_answer", "flashcards"]:
                         st.session_state.pop(key, None)
                     st.rerun()
-                st.markdown("</div>", unsafe_allow_html=True)
 
-        with col3:
-            with st.container():
-                st.markdown("<div style='text-align: center;'>", unsafe_allow_html=True)
-                if st.session_state.current_flashcard < total_flashcards - 1:
-                    if st.button("➡️ Next"):
-                        st.session_state.current_flashcard += 1
-                        st.session_state.reveal_answer = False
-                        st.rerun()
-                else:
-                    if st.button("🏁 Exit Flashcards"):
-                        for key in ["current_flashcard", "reveal_answer", "flashcards"]:
-                            st.session_state.pop(key, None)
-                        st.rerun()
-                st.markdown("</div>", unsafe_allow_html=True)
\ No newline at end of file
+def display_performance_panel():
+    """Shows the current session's latency breakdown per span and its token spend."""
+    registry = get_index_registry().stats()
+    st.caption(
+        f"Shared indexes: {registry['indexes']} loaded ({registry['bytes'] / 1024 ** 2:.1f} MB), "
+        f"{registry['sessions']} session(s) attached, {registry['hits']} reused / {registry['builds']} built"
+    )
+    chunks = registry["chunks"]
+    sessions = get_session_spiller().stats()
+    st.caption(
+        f"Chunk store: {chunks['texts']} texts ({chunks['bytes'] / 1024 ** 2:.1f} MB), {chunks['interned']} shared; "
+        f"idle sessions: {sessions['spilled']} of {sessions['sessions']} on disk, "
+        f"{sessions['spills']} spilled / {sessions['restores']} restored"
+    )
+
+    answers = get_answer_cache().stats()
+    st.caption(
+        f"Answer cache: {answers['hits']} hits / {answers['misses']} misses "
+        f"(hit rate {answers['hit_rate']:.0%}), {answers['seconds_saved']:.1f}s of answering saved"
+    )
+
+    # Shared by all sessions: how questions were moderated, and how long the API calls took
+    moderation = get_moderation_stats()
+    st.caption(
+        f"Moderation: {moderation['checks']} checks, {moderation['cache_hits']} from cached verdicts "
+        f"(hit rate {moderation['hit_rate']:.0%}, {moderation['cached_verdicts']} cached), "
+        f"{moderation['prefilter_passes']} passed by the pre-check, {moderation['api_calls']} API calls "
+        f"({moderation['api_errors']} failed)"
+    )
+    if moderation["api_calls"]:
+        st.dataframe([moderation["latency_histogram"]], hide_index=True)
+
+    # Shared by all sessions: queue depth and wait per lane of the API request scheduler
+    scheduler = get_scheduler().stats()
+    st.caption(
+        f"API scheduler: {scheduler['in_flight']} in flight (limit {scheduler['limit']})"
+        + (f", paused {scheduler['paused_s']:.1f}s by the gateway" if scheduler["paused_s"] else "")
+    )
+    st.dataframe([{"lane": lane, **lane_stats} for lane, lane_stats in scheduler["lanes"].items()], hide_index=True)
+
+    rows = summarize_spans(get_session_spans(st.session_state.session_id))
+    if not rows:
+        st.caption("No timings recorded yet.")
+        return
+
+    input_tokens = sum(row["input_tokens"] for row in rows)
+    output_tokens = sum(row["output_tokens"] for row in rows)
+    st.caption(f"Tokens this session: {input_tokens} in / {output_tokens} out")
+    chunking = [record["attributes"] for record in get_session_spans(st.session_state.session_id)
+                if record["name"] == "chunk_pdfs"]
+    if chunking:
+        last = chunking[-1]
+        st.caption(
+            f"Last chunking: {last['pages']} pages, {last['tokens']} tokens into {last['chunks']} chunks "
+            f"at {last['tokens_per_s']:,} tokens/s ({last['workers']} workers)"
+        )
+    st.dataframe(rows, hide_index=True)
+
+    # Prompt tokens and latency per chat turn for each retrieval mode used in this session
+    chat_spans = [record for record in get_session_spans(st.session_state.session_id)
+                  if record["name"] in ("retrieval", "llm.chat", "qa_chain")]
+    mode_rows = summarize_spans(chat_spans, group_by="mode")
+    if mode_rows:
+        st.caption("Chat by retrieval mode (per question)")
+        st.dataframe([
+            {
+                "span": row["span"], "questions": row["count"],
+                "avg_ms": row["total_ms"] / row["count"],
+                "avg_prompt_tokens": row["input_tokens"] / row["count"],
+            }
+            for row in mode_rows
+        ], hide_index=True)
+
+    lexical = [record for record in get_session_spans(st.session_state.session_id) if record["name"] == "lexical_search"]
+    if lexical:
+        fast = sum(1 for record in lexical if record["attributes"].get("fast_path"))
+        st.caption(f"Hybrid retrieval: {fast} of {len(lexical)} questions answered lexically, without a query embedding")
+
+def display_retrieval_settings():
+    """Sidebar controls for how chat questions retrieve chunks (see retrieval.py)."""
+    settings = get_retrieval_settings()
+    with st.expander("Retrieval settings"):
+        mode = st.selectbox("Mode", RETRIEVAL_MODES, index=RETRIEVAL_MODES.index(settings["mode"]), key="retrieval_mode")
+        k = st.slider("Chunks per question (k)", 1, 20, settings["k"], key="retrieval_k")
+        fetch_k = settings["fetch_k"]
+        score_threshold = settings["score_threshold"]
+        lambda_mult = settings["lambda_mult"]
+        if mode == "threshold":
+            score_threshold = st.slider(
+                "Minimum relevance score", 0.0, 1.0, score_threshold, 0.05, key="retrieval_score_threshold"
+            )
+        if mode == "hybrid":
+            fetch_k = st.slider("Candidates per search (fetch_k)", 1, 100, fetch_k, key="retrieval_fetch_k")
+        if mode == "mmr":
+            fetch_k = st.slider("Candidates for MMR (fetch_k)", 1, 100, fetch_k, key="retrieval_fetch_k")
+            lambda_mult = st.slider("Relevance vs. diversity", 0.0, 1.0, lambda_mult, 0.05, key="retrieval_lambda_mult")
+        context_token_budget = st.number_input(
+            "Context token budget (0: no limit)", 0, 100000, settings["context_token_budget"], 500,
+            key="retrieval_context_token_budget",
+        )
+
+        indexed_files = st.session_state.get("indexed_files", {})
+        all_sources = sorted({entry["source"] for entry in indexed_files.values()})
+        if "retrieval_sources" in st.session_state:
+            # Drop documents that were removed from the index since they were selected
+            st.session_state.retrieval_sources = [
+                source for source in st.session_state.retrieval_sources if source in all_sources
+            ]
+        sources = st.multiselect("Only these documents", all_sources, key="retrieval_sources")
+        pages = parse_pages(st.text_input("Only these pages (e.g. 1-5, 8)", key="retrieval_pages"))
+        st.checkbox("Bypass answer cache", key="bypass_answer_cache", help="Always generate a fresh answer")
+
+    st.session_state.retrieval_settings = {
+        "mode": mode, "k": k, "fetch_k": fetch_k, "score_threshold": score_threshold, "lambda_mult": lambda_mult,
+        "context_token_budget": int(context_token_budget), "sources": tuple(sources), "pages": pages,
+    }
+
+@st.fragment(run_every=1)
+def display_job_progress():
+    """Live progress of this session's background jobs; reruns the app once one of them finishes."""
+    jobs = get_session_jobs()
+    if any(job.finished or has_undelivered_items(kind, job) for kind, job in jobs.items()):
+        st.rerun()  # Full rerun so the (first) results are handed into session state
+
+    for kind, job in jobs.items():
+        label = JOB_LABELS[kind]
+        if job.total:
+            st.progress(job.done / job.total, text=f"{label}: {job.done} / {job.total} chunks")
+        else:
+            st.caption(f"{label}: {job.status}...")
+        if st.button("Cancel", key=f"cancel_{kind}_job", disabled=job.cancel_event.is_set()):
+            job.cancel()
@@ -0,0 +1,144 @@
+# indexes.py
+import math
+import faiss
+import numpy as np
+from commons import (
+    INDEX_TYPE, INDEX_AUTO_FLAT_MAX, INDEX_AUTO_IVF_MAX, INDEX_NLIST, INDEX_NPROBE, INDEX_HNSW_M,
+    INDEX_HNSW_EF_SEARCH, INDEX_PQ_M, INDEX_TRAIN_SAMPLE,
+)
+
+# "flat": exact search, memory grows with the corpus; "ivf": searches the nprobe nearest of nlist
+# clusters; "hnsw": graph search, fast but the largest in memory; "ivfpq"/"ivfsq": IVF with
+# product-quantized (one byte per sub-vector) or 8-bit scalar-quantized (4x smaller) vectors
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq", "ivfsq")
+
+
+def index_settings() -> dict:
+    """The configured index settings; part of the ingest cache key, since they change what is stored."""
+    return {
+        "type": INDEX_TYPE, "nlist": INDEX_NLIST, "hnsw_m": INDEX_HNSW_M, "pq_m": INDEX_PQ_M,
+        "auto_flat_max": INDEX_AUTO_FLAT_MAX, "auto_ivf_max": INDEX_AUTO_IVF_MAX,
+    }
+
+
+def choose_index_type(vector_count, index_type=INDEX_TYPE) -> str:
+    """Resolves "auto" by corpus size: exact search for small corpora, IVF for large ones and
+    scalar-quantized IVF when the vectors alone would take too much memory."""
+    if index_type != "auto":
+        return index_type
+    if vector_count <= INDEX_AUTO_FLAT_MAX:
+        return "flat"
+    if vector_count <= INDEX_AUTO_IVF_MAX:
+        return "ivf"
+    return "ivfsq"
+
+
+def index_type_of(index) -> str:
+    """The INDEX_TYPES name of a built or loaded index."""
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVFScalarQuantizer):
+        return "ivfsq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def index_nbytes(index) -> int:
+    """Approximate memory of an index, from its vector count, dimension and type. Unlike
+    serialize_index() it doesn't copy the index, which would double its memory for a moment."""
+    vector_bytes = index.ntotal * index.d * 4  # float32
+    index_type = index_type_of(index)
+    if index_type == "flat":
+        return vector_bytes
+    if index_type == "hnsw":
+        return vector_bytes + index.hnsw.neighbors.size() * 4  # Plus the graph's 4-byte neighbor ids
+    ivf = faiss.extract_index_ivf(index)
+    # Codes plus an 8-byte id per vector in the inverted lists and 8 bytes in the direct map, the centroids
+    nbytes = index.ntotal * (ivf.code_size + 16) + ivf.nlist * index.d * 4
+    if index_type == "ivfpq":
+        nbytes += 256 * index.d * 4  # PQ codebooks: 256 centroids per sub-vector
+    return nbytes
+
+
+def supports_removal(index) -> bool:
+    """LangChain's FAISS.delete renumbers the remaining vectors 0..n-1, which only flat indexes do too.
+    Other index types are rebuilt without the removed vectors instead."""
+    return index_type_of(index) == "flat"
+
+
+def default_nlist(vector_count) -> int:
+    # ~4*sqrt(n) lists, with at least 39 training vectors per list as faiss recommends
+    nlist = INDEX_NLIST or int(4 * math.sqrt(vector_count))
+    return max(1, min(nlist, vector_count // 39))
+
+
+def default_pq_m(dimension) -> int:
+    """Number of PQ sub-vectors: the largest common choice that divides the dimension into
+    sub-vectors of at least 16 dimensions (96 for 1536-dimensional embeddings)."""
+    if INDEX_PQ_M:
+        return INDEX_PQ_M
+    for m in (96, 64, 48, 32, 16, 8, 4, 2):
+        if dimension % m == 0 and dimension // m >= 16:
+            return m
+    return 1
+
+
+def training_sample(vectors, sample_size=INDEX_TRAIN_SAMPLE):
+    """A random sample of the vectors; training on all of a large corpus is slow and doesn't help much."""
+    if len(vectors) <= sample_size:
+        return vectors
+    rows = np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)
+    return vectors[rows]
+
+
+def prepare_index(index, nprobe=INDEX_NPROBE, ef_search=INDEX_HNSW_EF_SEARCH):
+    """Sets the search parameters (not stored in the index file) after building or loading an index."""
+    index_type = index_type_of(index)
+    if index_type in ("ivf", "ivfpq", "ivfsq"):
+        ivf = faiss.extract_index_ivf(index)
+        ivf.nprobe = min(nprobe, ivf.nlist)
+        ivf.make_direct_map()  # MMR reconstructs candidate vectors by position
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def build_index(vectors, index_type=INDEX_TYPE, nlist=None, nprobe=INDEX_NPROBE, hnsw_m=INDEX_HNSW_M,
+                ef_search=INDEX_HNSW_EF_SEARCH, pq_m=None):
+    """Builds an empty FAISS index for `vectors` (float32, n x d), trained on a sample if needed.
+
+    The vectors are not added; the caller adds them, e.g. through FAISS.add_embeddings.
+    Falls back to a flat index when there are too few vectors to train the requested type.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    count, dimension = vectors.shape
+    index_type = choose_index_type(count, index_type)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES} or 'auto'")
+
+    nlist = nlist or default_nlist(count)
+    if index_type in ("ivf", "ivfpq", "ivfsq") and count < 39 * nlist:
+        print(f"Only {count} vectors, too few to train a {index_type} index with {nlist} lists; using flat")
+        index_type = "flat"
+    if index_type == "ivfpq" and count < 256 * 39:
+        print(f"Only {count} vectors, too few to train PQ codebooks; using ivf")
+        index_type = "ivf"
+
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dimension)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        return prepare_index(index, nprobe, ef_search)
+
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    elif index_type == "ivfpq":
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m or default_pq_m(dimension), 8)
+    else:
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit)
+    index.train(training_sample(vectors))
+    return prepare_index(index, nprobe, ef_search)
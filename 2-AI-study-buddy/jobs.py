@@ -0,0 +1,171 @@
+# jobs.py
+import contextvars
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from commons import MAX_CONCURRENT_JOBS
+from tracing import bind_context
+from scheduler import set_lane
+
+# Finished jobs nobody collected (e.g. the browser tab was closed) are dropped after this long
+FINISHED_JOB_TTL_S = 3600
+
+# The job whose function is running, so deep code can report progress and check for cancellation
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class Job:
+    """A unit of background work with progress, cancellation and a result to hand off."""
+
+    def __init__(self, kind, session_id):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.session_id = session_id
+        self.status = "queued"  # queued -> running -> done / failed / cancelled
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.partial = []  # Items the job has produced so far, readable while it runs
+        self.stats = {}  # Run statistics reported by the job's code (report_stats), handed over with the result
+        self.error = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def add_total(self, amount):
+        with self.lock:
+            self.total += amount
+
+    def advance(self, amount=1):
+        with self.lock:
+            self.done += amount
+
+
+def add_progress_total(amount):
+    """Announces `amount` more units of work for the current job (no-op outside a job)."""
+    job = current_job.get()
+    if job is not None:
+        job.add_total(amount)
+
+
+def advance_progress(amount=1):
+    """Marks `amount` units of the current job's work as done (no-op outside a job)."""
+    job = current_job.get()
+    if job is not None:
+        job.advance(amount)
+
+
+def partial_results() -> list:
+    """The current job's list of items produced so far; the job appends to it as it goes.
+
+    The script thread may read it while the job runs. Outside a job this is a fresh list.
+    """
+    job = current_job.get()
+    return job.partial if job is not None else []
+
+
+def report_stats(label, **values):
+    """Adds `values` to the current job's statistics under `label` (no-op outside a job)."""
+    job = current_job.get()
+    if job is not None:
+        with job.lock:
+            job.stats.setdefault(label, {}).update(values)
+
+
+def count_stats(label, **amounts):
+    """Adds `amounts` to the counters of the current job's statistics under `label`, e.g. tokens
+    spent by concurrent requests (no-op outside a job)."""
+    job = current_job.get()
+    if job is not None:
+        with job.lock:
+            stats = job.stats.setdefault(label, {})
+            for name, amount in amounts.items():
+                stats[name] = stats.get(name, 0) + amount
+
+
+@contextmanager
+def collect_stats():
+    """Runs the block as a job of its own outside the JobRunner (e.g. in batch.py), so the code in
+    it reports statistics and progress the same way. Yields the job's stats dict."""
+    job = Job("inline", None)
+    token = current_job.set(job)
+    try:
+        yield job.stats
+    finally:
+        current_job.reset(token)
+
+
+def is_cancelled() -> bool:
+    """True if the current job was cancelled; long loops should stop starting new work."""
+    job = current_job.get()
+    return job is not None and job.cancel_event.is_set()
+
+
+class JobRunner:
+    """Process-wide worker pool; at most `max_workers` jobs run at once, the rest wait in order."""
+
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, kind, session_id, fn, *args, **kwargs) -> Job:
+        job = Job(kind, session_id)
+
+        def run():
+            if job.cancel_event.is_set():
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                return
+            job.status = "running"
+            token = current_job.set(job)
+            set_lane("bulk")  # Only affects this job's context; chat requests go first
+            try:
+                result = fn(*args, **kwargs)
+                if job.cancel_event.is_set():
+                    job.status = "cancelled"
+                else:
+                    job.result = result
+                    job.status = "done"
+            except Exception as e:
+                print(f"Job {job.kind} failed: {e}")
+                job.error = e
+                job.status = "failed"
+            finally:
+                current_job.reset(token)
+                job.finished_at = time.time()
+
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        self.executor.submit(bind_context(run))
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def prune(self):
+        """Drops long-finished jobs. Caller holds the lock."""
+        cutoff = time.time() - FINISHED_JOB_TTL_S
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+
+@lru_cache(maxsize=None)
+def get_job_runner() -> JobRunner:
+    return JobRunner()
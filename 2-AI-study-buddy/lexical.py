@@ -0,0 +1,233 @@
+# lexical.py
+"""BM25 inverted index over the chunks of a vector store, the hybrid retriever built on it, and the
+vector retriever of the other modes.
+
+Imported on the first upload or question (see actions.py), like the rest of the retrieval stack.
+"""
+import heapq
+import math
+import re
+import sys
+import time
+from array import array
+from typing import Any
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStoreRetriever
+from commons import BM25_K1, BM25_B, HYBRID_LEXICAL_WEIGHT, LEXICAL_FAST_PATH, LEXICAL_CONFIDENT_MARGIN
+from retrieval import metadata_filter
+from tracing import record_span, span
+
+WORD = re.compile(r"\w+")
+# Question words and fillers that say nothing about which chunk answers the question
+STOPWORDS = frozenset(
+    "a an and are as at be been but by can could did do does explain for from had has have how i in is it "
+    "its me of on or say should tell that the their them there these this those to was we were what when "
+    "where which who whom why will with would you your about describe define definition mean means "
+    "meaning".split()
+)
+MAX_FREQUENCY = 2 ** 16 - 1  # Term frequencies are stored as unsigned shorts
+
+
+def tokenize(text) -> list:
+    """Lowercased words without stopwords; a plural "s" is dropped so "enzymes" finds "enzyme"."""
+    terms = []
+    for word in WORD.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class LexicalIndex:
+    """BM25 index of chunk texts with array-backed postings.
+
+    Chunk i is vector store id `ids[i]`. The postings of term t are the chunk numbers
+    doc_numbers[offsets[t]:offsets[t + 1]], with the term's count in each chunk at the same
+    positions of `frequencies`. Per-chunk length normalization and per-term idf are precomputed.
+    """
+
+    def __init__(self, ids, texts, k1=BM25_K1, b=BM25_B):
+        self.ids = list(ids)
+        self.k1 = k1
+        self.terms = {}  # term -> term number
+        postings = []  # term number -> [(chunk number, frequency)]
+        lengths = array("I")
+        for number, text in enumerate(texts):
+            counts = {}
+            for term in tokenize(text):
+                counts[term] = counts.get(term, 0) + 1
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                term_number = self.terms.setdefault(term, len(self.terms))
+                if term_number == len(postings):
+                    postings.append([])
+                postings[term_number].append((number, min(count, MAX_FREQUENCY)))
+
+        self.offsets = array("I", [0])
+        self.doc_numbers = array("I")
+        self.frequencies = array("H")
+        for term_postings in postings:
+            for number, count in term_postings:
+                self.doc_numbers.append(number)
+                self.frequencies.append(count)
+            self.offsets.append(len(self.doc_numbers))
+
+        chunk_count = len(self.ids)
+        self.idf = array("f", (
+            math.log(1 + (chunk_count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for term_postings in postings
+        ))
+        average = sum(lengths) / chunk_count if chunk_count else 0.0
+        # k1 * (1 - b + b * length / average length), the length part of the BM25 denominator
+        self.norms = array("f", (k1 * (1 - b + b * length / average) if average else k1 for length in lengths))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self) -> int:
+        arrays = (self.offsets, self.doc_numbers, self.frequencies, self.idf, self.norms)
+        return (
+            sum(len(values) * values.itemsize for values in arrays)
+            + sum(sys.getsizeof(term) for term in self.terms)
+            + sys.getsizeof(self.terms)
+        )
+
+    def search(self, terms, limit, keep=None) -> list:
+        """The `limit` best chunks for the query terms as [(id, score, number of query terms matched)].
+
+        `keep(id)` can exclude chunks, e.g. for the source/page filters.
+        """
+        scores, matched = {}, {}
+        for term in set(terms):
+            term_number = self.terms.get(term)
+            if term_number is None:
+                continue
+            idf = self.idf[term_number]
+            for position in range(self.offsets[term_number], self.offsets[term_number + 1]):
+                number = self.doc_numbers[position]
+                frequency = self.frequencies[position]
+                score = idf * frequency * (self.k1 + 1) / (frequency + self.norms[number])
+                scores[number] = scores.get(number, 0.0) + score
+                matched[number] = matched.get(number, 0) + 1
+
+        if keep is None:
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        else:
+            best = []
+            for number, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+                if keep(self.ids[number]):
+                    best.append((number, score))
+                    if len(best) == limit:
+                        break
+        return [(self.ids[number], score, matched[number]) for number, score in best]
+
+
+def build_lexical_index(vectorstore, indexed_files) -> LexicalIndex:
+    """Indexes the chunks of the vector store, in upload order."""
+    start = time.time()
+    ids = [id_ for entry in indexed_files.values() for id_ in entry["ids"]]
+    index = LexicalIndex(ids, (vectorstore.docstore.search(id_).page_content for id_ in ids))
+    record_span("lexical_build", start, time.time(), {
+        "chunks": len(index), "terms": len(index.terms), "postings": len(index.doc_numbers),
+        "index_bytes": index.nbytes(),
+    })
+    return index
+
+
+def is_confident(matches, term_count, k) -> bool:
+    """True if the best lexical match contains every query term and clearly beats the match just
+    outside the top k (or fewer than k + 1 chunks match at all)."""
+    if not matches or term_count == 0 or matches[0][2] < term_count:
+        return False
+    return len(matches) <= k or matches[0][1] >= LEXICAL_CONFIDENT_MARGIN * matches[k][1]
+
+
+class HybridRetriever(BaseRetriever):
+    """Ranks chunks by a mix of BM25 (divided by the best match's score) and the vector relevance
+    score the threshold mode uses. Confident lexical matches skip the query embedding.
+
+    The chat checks confident_documents() before the answer cache, which would embed the
+    question; other questions are embedded once for both through the query embedding cache (see
+    actions.handle_user_input).
+    """
+
+    vectorstore: Any
+    lexical_index: Any
+    settings: dict
+    lexical_weight: float = HYBRID_LEXICAL_WEIGHT
+    fast_path: bool = LEXICAL_FAST_PATH
+    last_lexical: Any = None  # (query, matches, confident) of the latest lexical search
+
+    def lexical_search(self, query):
+        """Returns (matches, confident) for the query; the latest query's result is reused."""
+        if self.last_lexical is not None and self.last_lexical[0] == query:
+            return self.last_lexical[1:]
+        k = self.settings["k"]
+        fetch_k = max(self.settings["fetch_k"], k)
+        docstore = self.vectorstore.docstore
+        chunk_filter = metadata_filter(self.settings)
+        with span("lexical_search") as attributes:
+            terms = tokenize(query)
+            keep = None if chunk_filter is None else (lambda id_: chunk_filter(docstore.search(id_).metadata))
+            matches = self.lexical_index.search(terms, max(fetch_k, k + 1), keep)
+            confident = self.fast_path and is_confident(matches, len(set(terms)), k)
+            attributes["matches"] = len(matches)
+            attributes["fast_path"] = confident
+        self.last_lexical = (query, matches, confident)
+        return matches, confident
+
+    def confident_documents(self, query):
+        """The top k chunks if the lexical match is confident, else None. Doesn't embed the query."""
+        matches, confident = self.lexical_search(query)
+        if not confident:
+            return None
+        return [self.vectorstore.docstore.search(id_) for id_, _, _ in matches[:self.settings["k"]]]
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        k = self.settings["k"]
+        fetch_k = max(self.settings["fetch_k"], k)
+        docstore = self.vectorstore.docstore
+        chunk_filter = metadata_filter(self.settings)
+
+        matches, confident = self.lexical_search(query)
+        if confident:
+            return [docstore.search(id_) for id_, _, _ in matches[:k]]
+
+        from cache import get_query_embeddings
+        with span("vector_search"):
+            vector = get_query_embeddings().embed_query(query, self.vectorstore.embedding_function)
+            hits = self.vectorstore.similarity_search_with_score_by_vector(
+                vector, k=fetch_k, filter=chunk_filter, fetch_k=fetch_k
+            )
+        relevance = self.vectorstore._select_relevance_score_fn()
+
+        scores, docs = {}, {}
+        best_lexical = matches[0][1] if matches else 0.0
+        for id_, score, _ in matches[:fetch_k]:
+            scores[id_] = self.lexical_weight * score / best_lexical
+        for doc, distance in hits:
+            docs[doc.id] = doc
+            scores[doc.id] = scores.get(doc.id, 0.0) + (1 - self.lexical_weight) * relevance(distance)
+        ranked = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [docs.get(id_) or docstore.search(id_) for id_, _ in ranked]
+
+
+class VectorRetriever(VectorStoreRetriever):
+    """The vector store's retriever for the similarity, threshold and mmr modes, except that the
+    question is embedded through the query embedding cache, which the answer cache lookup filled
+    already, and the store is searched by vector."""
+
+    def _get_relevant_documents(self, query, *, run_manager=None, **kwargs):
+        from cache import get_query_embeddings
+        search_kwargs = self.search_kwargs | kwargs
+        vector = get_query_embeddings().embed_query(query, self.vectorstore.embedding_function)
+        if self.search_type == "mmr":
+            return self.vectorstore.max_marginal_relevance_search_by_vector(vector, **search_kwargs)
+        score_threshold = search_kwargs.pop("score_threshold", None)
+        hits = self.vectorstore.similarity_search_with_score_by_vector(vector, **search_kwargs)
+        if self.search_type != "similarity_score_threshold":
+            return [doc for doc, _ in hits]
+        relevance = self.vectorstore._select_relevance_score_fn()
+        return [doc for doc, distance in hits if relevance(distance) >= score_threshold]
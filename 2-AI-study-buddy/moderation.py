@@ -0,0 +1,138 @@
+# moderation.py
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tracing import bind_context, span
+from commons import (
+    get_moderation, MODERATION_MODEL, MODERATION_TIMEOUT_S, MODERATION_RETRIES, MODERATION_CACHE_SIZE,
+    MODERATION_ALLOWLIST
+)
+
+# The only inputs that skip the moderation API (after normalize() and dropping punctuation)
+SAFE_PHRASES = frozenset((
+    "hi", "hello", "hey", "hi there", "hello there", "good morning", "good afternoon", "good evening",
+    "thanks", "thank you", "thanks a lot", "thank you very much", "ok", "okay", "ok thanks", "bye", "goodbye",
+))
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+# Upper bounds (seconds) of the moderation latency histogram buckets, the last bucket is open
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+
+stats_lock = threading.Lock()
+moderation_stats = {
+    "checks": 0,
+    "cache_hits": 0,
+    "prefilter_passes": 0,
+    "api_calls": 0,
+    "api_errors": 0,
+    "latency_histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+}
+
+verdict_cache = OrderedDict()  # normalized text -> is_safe, most recently used last
+verdict_lock = threading.Lock()
+
+# Background moderation for overlap mode, shared by all sessions
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="moderation")
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def is_trivially_safe(normalized: str, enabled=MODERATION_ALLOWLIST) -> bool:
+    """Local pre-check: a greeting or thanks on the exact allowlist, nothing else."""
+    return enabled and " ".join(PUNCTUATION.sub(" ", normalized).split()) in SAFE_PHRASES
+
+
+def cached_verdict(normalized):
+    with verdict_lock:
+        verdict = verdict_cache.get(normalized)
+        if verdict is not None:
+            verdict_cache.move_to_end(normalized)
+        return verdict
+
+
+def store_verdict(normalized, is_safe, max_size=MODERATION_CACHE_SIZE):
+    with verdict_lock:
+        verdict_cache[normalized] = is_safe
+        verdict_cache.move_to_end(normalized)
+        while len(verdict_cache) > max_size:
+            verdict_cache.popitem(last=False)
+
+
+def record_latency(seconds):
+    with stats_lock:
+        moderation_stats["latency_histogram"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def call_moderation_api(text, timeout=MODERATION_TIMEOUT_S, retries=MODERATION_RETRIES) -> bool:
+    """Returns True if the API did not flag the text. Retries with exponential backoff, raises after the last attempt."""
+    from scheduler import NO_RETRY_HEADER  # These attempts are the only ones; the transport sends each once
+    client = get_moderation().with_options(timeout=timeout, max_retries=0, default_headers={NO_RETRY_HEADER: "1"})
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            with stats_lock:
+                moderation_stats["api_calls"] += 1
+            response = client.moderations.create(input=text, model=MODERATION_MODEL)
+            record_latency(time.perf_counter() - start)
+            return not response.results[0].flagged
+        except Exception as e:
+            record_latency(time.perf_counter() - start)
+            with stats_lock:
+                moderation_stats["api_errors"] += 1
+            if attempt == retries:
+                raise
+            print(f"Moderation attempt {attempt + 1} failed ({e}), retrying")
+            time.sleep(0.2 * 2 ** attempt)
+
+
+def moderate_text(text: str) -> bool:
+    """Returns True if the text is safe. Checks the verdict cache and the local pre-check before the API."""
+    with span("moderate_text", bytes=len(text)) as attributes:
+        normalized = normalize(text)
+        with stats_lock:
+            moderation_stats["checks"] += 1
+
+        verdict = cached_verdict(normalized)
+        if verdict is not None:
+            with stats_lock:
+                moderation_stats["cache_hits"] += 1
+            attributes["source"] = "cache"
+            return verdict
+
+        if is_trivially_safe(normalized):
+            with stats_lock:
+                moderation_stats["prefilter_passes"] += 1
+            attributes["source"] = "prefilter"
+            return True
+
+        attributes["source"] = "api"
+        try:
+            is_safe = call_moderation_api(text)
+        except Exception as e:
+            print(f"Error during moderation: {e}")
+            return False  # Assume unsafe in case of error, and don't cache that
+
+        store_verdict(normalized, is_safe)
+        return is_safe
+
+
+def start_moderation(text: str):
+    """Starts moderate_text in the background and returns a Future of its verdict."""
+    return executor.submit(bind_context(moderate_text), text)
+
+
+def get_moderation_stats() -> dict:
+    """Counters shared by all sessions, shown in the performance panel."""
+    with stats_lock:
+        stats = dict(moderation_stats, latency_histogram=list(moderation_stats["latency_histogram"]))
+    labels = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+    stats["latency_histogram"] = dict(zip(labels, stats["latency_histogram"]))
+    stats["hit_rate"] = stats["cache_hits"] / stats["checks"] if stats["checks"] else 0.0
+    with verdict_lock:
+        stats["cached_verdicts"] = len(verdict_cache)
+    return stats
@@ -0,0 +1,54 @@
+# records.py
+"""Flashcard and quiz question records as sessions keep them.
+
+The parsers, the result cache and the study packs work with plain dicts (they are stored as
+JSON); a session converts them to these slotted records, which take a fraction of a dict's
+memory and pickle compactly when an idle session is spilled to disk (see sessions.py).
+"""
+import sys
+
+
+class Flashcard:
+    __slots__ = ("front", "back")
+
+    def __init__(self, front, back):
+        self.front = front
+        self.back = back
+
+    @classmethod
+    def from_dict(cls, item):
+        return cls(item["front"], item["back"])
+
+    def to_dict(self) -> dict:
+        return {"front": self.front, "back": self.back}
+
+
+class QuizQuestion:
+    __slots__ = ("question", "type", "options", "correct_answer", "explanation")
+
+    def __init__(self, question, type, options, correct_answer, explanation):
+        self.question = question
+        # A handful of distinct values, so every question shares the same string objects
+        self.type = sys.intern(type)
+        self.options = options
+        self.correct_answer = sys.intern(correct_answer)
+        self.explanation = explanation
+
+    @classmethod
+    def from_dict(cls, item):
+        """From a parse_questions() dict ("Question", "Type", "Options", "Correct Answer", "Explanation")."""
+        return cls(item["Question"], item["Type"], item["Options"], item["Correct Answer"], item["Explanation"])
+
+    def to_dict(self) -> dict:
+        return {
+            "Question": self.question, "Type": self.type, "Options": self.options,
+            "Correct Answer": self.correct_answer, "Explanation": self.explanation,
+        }
+
+
+def flashcard_records(items) -> list:
+    return [Flashcard.from_dict(item) for item in items]
+
+
+def question_records(items) -> list:
+    return [QuizQuestion.from_dict(item) for item in items]
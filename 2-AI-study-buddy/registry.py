@@ -0,0 +1,160 @@
+# registry.py
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from commons import INDEX_REGISTRY_MAX_BYTES, INDEX_REGISTRY_SESSION_TTL_S
+
+
+def estimate_bytes(vectorstore, text_chunks, lexical_index) -> int:
+    """Approximate memory of a loaded index: the FAISS index, the chunk texts and the BM25 index."""
+    from indexes import index_nbytes  # Only needed once an index exists; keeps faiss out of the first page load
+    return index_nbytes(vectorstore.index) + sum(len(chunk) for chunk in text_chunks) + lexical_index.nbytes()
+
+
+class ChunkStore:
+    """One copy of every distinct chunk text held by the loaded indexes.
+
+    Overlapping uploads (a PDF on its own and together with others) are separate registry entries
+    with separate documents; interning their texts makes them share one string per chunk. A text
+    is counted once per entry chunk holding it and dropped with the last one. Caller holds the
+    registry lock.
+    """
+
+    def __init__(self):
+        self.texts = {}  # text -> [the shared string, references]
+        self.interned = 0  # Chunks that reused a string already in the store
+
+    def intern(self, vectorstore, indexed_files) -> list:
+        """Points the vector store's documents at the shared strings; returns them in upload order."""
+        texts = []
+        for entry in indexed_files.values():
+            for id_ in entry["ids"]:
+                doc = vectorstore.docstore.search(id_)
+                shared = self.texts.get(doc.page_content)
+                if shared is None:
+                    shared = self.texts[doc.page_content] = [doc.page_content, 0]
+                else:
+                    self.interned += 1
+                    doc.page_content = shared[0]
+                shared[1] += 1
+                texts.append(shared[0])
+        return texts
+
+    def release(self, texts):
+        for text in texts:
+            shared = self.texts[text]
+            shared[1] -= 1
+            if shared[1] == 0:
+                del self.texts[text]
+
+    def stats(self) -> dict:
+        return {"texts": len(self.texts), "bytes": sum(len(text) for text in self.texts), "interned": self.interned}
+
+
+class IndexRegistry:
+    """Process-wide, reference-counted registry of loaded indexes keyed by upload content hash.
+
+    Sessions uploading the same PDFs attach to one vector store instead of building their own.
+    Registered vector stores are never modified; an upload change builds a new entry. Entries
+    no session is attached to are evicted, least recently used first, above `max_bytes`.
+    Streamlit doesn't tell us when a browser tab closes, so a session that wasn't seen for
+    `session_ttl` seconds no longer counts as attached.
+    """
+
+    def __init__(self, max_bytes=INDEX_REGISTRY_MAX_BYTES, session_ttl=INDEX_REGISTRY_SESSION_TTL_S):
+        self.max_bytes = max_bytes
+        self.session_ttl = session_ttl
+        # key -> {"vectorstore", "indexed_files", "text_chunks", "lexical_index", "bytes", "sessions"}
+        self.entries = OrderedDict()
+        self.build_locks = {}
+        self.chunks = ChunkStore()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def acquire(self, key, session_id, build) -> dict:
+        """Attaches the session to the entry for `key`, calling build() -> (vectorstore, indexed_files,
+        text_chunks, lexical_index) only if no session loaded it yet. Concurrent sessions with the same key wait for
+        one build instead of each running their own."""
+        with self.lock:
+            build_lock = self.build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    entry["sessions"][session_id] = time.time()
+                    return entry
+
+            vectorstore, indexed_files, text_chunks, lexical_index = build()
+            with self.lock:
+                text_chunks = self.chunks.intern(vectorstore, indexed_files)
+            entry = {
+                "vectorstore": vectorstore,
+                "indexed_files": indexed_files,
+                "text_chunks": text_chunks,
+                "lexical_index": lexical_index,
+                "bytes": estimate_bytes(vectorstore, text_chunks, lexical_index),
+                "sessions": {session_id: time.time()},
+            }
+            with self.lock:
+                self.builds += 1
+                self.entries[key] = entry
+                self.build_locks.pop(key, None)
+                self.evict()
+            return entry
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def touch(self, key, session_id):
+        """Marks the session as still attached (called on every rerun)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["sessions"][session_id] = time.time()
+                self.entries.move_to_end(key)
+
+    def release(self, key, session_id):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["sessions"].pop(session_id, None)
+                self.evict()
+
+    def attached_sessions(self, entry) -> int:
+        cutoff = time.time() - self.session_ttl
+        return sum(1 for last_seen in entry["sessions"].values() if last_seen >= cutoff)
+
+    def evict(self):
+        """Drops unattached entries, least recently used first, until under budget. Caller holds the lock."""
+        total = sum(entry["bytes"] for entry in self.entries.values())
+        for key in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            entry = self.entries[key]
+            if self.attached_sessions(entry) == 0:
+                total -= entry["bytes"]
+                self.chunks.release(entry["text_chunks"])
+                del self.entries[key]
+        if total > self.max_bytes:
+            print(f"Index registry over budget: {total / 1024 ** 2:.0f} MB held by attached sessions")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "indexes": len(self.entries),
+                "bytes": sum(entry["bytes"] for entry in self.entries.values()),
+                "sessions": sum(self.attached_sessions(entry) for entry in self.entries.values()),
+                "hits": self.hits,
+                "builds": self.builds,
+                "chunks": self.chunks.stats(),
+            }
+
+
+@lru_cache(maxsize=None)
+def get_index_registry() -> IndexRegistry:
+    return IndexRegistry()
@@ -0,0 +1,111 @@
+# retrieval.py
+import re
+from commons import (
+    RETRIEVAL_MODE, RETRIEVAL_K, RETRIEVAL_FETCH_K, RETRIEVAL_SCORE_THRESHOLD, RETRIEVAL_LAMBDA_MULT,
+    CONTEXT_TOKEN_BUDGET, get_tokenizer,
+)
+
+# "hybrid": k chunks by BM25 and vector relevance combined (see lexical.py); "similarity": the k nearest
+# chunks; "threshold": nearest chunks above a relevance score (may be fewer than k, or none); "mmr": k
+# chunks picked from the fetch_k nearest for relevance and diversity
+RETRIEVAL_MODES = ("hybrid", "similarity", "threshold", "mmr")
+
+# A chunk cut to fit the context budget is only kept if this many tokens of it fit
+MIN_PARTIAL_TOKENS = 200
+
+
+def default_settings() -> dict:
+    """Retrieval settings of a new session; the sidebar changes them per session."""
+    return {
+        "mode": RETRIEVAL_MODE,
+        "k": RETRIEVAL_K,
+        "fetch_k": RETRIEVAL_FETCH_K,
+        "score_threshold": RETRIEVAL_SCORE_THRESHOLD,
+        "lambda_mult": RETRIEVAL_LAMBDA_MULT,
+        "context_token_budget": CONTEXT_TOKEN_BUDGET,  # 0 keeps every retrieved chunk
+        "sources": (),  # Only chunks of these documents (empty: all documents)
+        "pages": (),  # Only chunks starting on these pages (empty: all pages)
+    }
+
+
+def settings_key(settings) -> tuple:
+    """Hashable form of the settings, to tell whether a cached retriever still matches."""
+    return tuple(sorted(settings.items()))
+
+
+def parse_pages(text) -> tuple:
+    """Parses a page selection like "1-5, 8" into (1, 2, 3, 4, 5, 8). Invalid parts are ignored."""
+    pages = set()
+    for part in text.split(","):
+        match = re.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", part)
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or start)
+            pages.update(range(start, end + 1))
+    return tuple(sorted(pages))
+
+
+def metadata_filter(settings):
+    """FAISS filter callable for the source/page selection, or None to search all chunks."""
+    if not settings["sources"] and not settings["pages"]:
+        return None
+    sources, pages = set(settings["sources"]), set(settings["pages"])
+
+    def keep(metadata):
+        if sources and metadata.get("source") not in sources:
+            return False
+        if pages and metadata.get("page") not in pages:
+            return False
+        return True
+    return keep
+
+
+def get_retriever(vectorstore, settings, lexical_index=None):
+    """Builds a retriever for the mode. fetch_k is passed in every mode, since filters are
+    applied to the fetch_k nearest chunks. Hybrid mode needs the lexical index of the vector
+    store and falls back to similarity search without one. Every mode embeds the question through
+    the query embedding cache."""
+    from lexical import HybridRetriever, VectorRetriever
+    if settings["mode"] == "hybrid" and lexical_index is not None:
+        return HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index, settings=settings)
+
+    search_kwargs = {"k": settings["k"], "fetch_k": max(settings["fetch_k"], settings["k"])}
+    chunk_filter = metadata_filter(settings)
+    if chunk_filter is not None:
+        search_kwargs["filter"] = chunk_filter
+
+    if settings["mode"] == "threshold":
+        search_kwargs["score_threshold"] = settings["score_threshold"]
+        return VectorRetriever(
+            vectorstore=vectorstore, search_type="similarity_score_threshold", search_kwargs=search_kwargs
+        )
+    if settings["mode"] == "mmr":
+        search_kwargs["lambda_mult"] = settings["lambda_mult"]
+        return VectorRetriever(vectorstore=vectorstore, search_type="mmr", search_kwargs=search_kwargs)
+    return VectorRetriever(vectorstore=vectorstore, search_kwargs=search_kwargs)
+
+
+def pack_context(docs, token_budget) -> list:
+    """Keeps retrieved chunks in rank order while their total stays within `token_budget` tokens.
+
+    The first chunk that doesn't fit is cut to the remaining budget (if at least
+    MIN_PARTIAL_TOKENS are left, or it is the best chunk), the rest are dropped.
+    A budget of 0 keeps everything.
+    """
+    if token_budget <= 0:
+        return list(docs)
+    from langchain_core.documents import Document  # Keeps langchain_core out of the first page load
+
+    tokenizer = get_tokenizer()
+    packed, used = [], 0
+    for doc in docs:
+        tokens = tokenizer.encode(doc.page_content, disallowed_special=())
+        if used + len(tokens) <= token_budget:
+            packed.append(doc)
+            used += len(tokens)
+            continue
+        remaining = token_budget - used
+        if remaining >= MIN_PARTIAL_TOKENS or not packed:
+            packed.append(Document(page_content=tokenizer.decode(tokens[:remaining]), metadata=doc.metadata))
+        break
+    return packed
@@ -0,0 +1,301 @@
+# scheduler.py
+import contextvars
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+import httpx
+from commons import (
+    RATE_LIMIT_RPM, RATE_LIMIT_TPM, SCHEDULER_MAX_CONCURRENCY, SCHEDULER_MAX_RETRIES, SCHEDULER_BACKOFF_S,
+    SCHEDULER_COMPLETION_TOKENS,
+)
+
+# Lanes in priority order: chat turns, moderation and query embeddings go before background jobs
+LANES = ("interactive", "bulk")
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_BACKOFF_S = 60.0
+RECENT_WAITS = 500
+# Requests carrying this header are sent once, without transport retries (the header isn't sent on)
+NO_RETRY_HEADER = "x-study-buddy-no-retry"
+
+# Lane of the code that is running; background jobs switch to "bulk", bind_context copies it into worker threads
+current_lane = contextvars.ContextVar("current_lane", default="interactive")
+
+
+def set_lane(lane):
+    """Schedules API requests made from now on (in this context) in `lane`."""
+    if lane not in LANES:
+        raise ValueError(f"Unknown lane {lane!r}, expected one of {LANES}")
+    return current_lane.set(lane)
+
+
+class TokenBucket:
+    """Allows `per_minute` units a minute, in bursts of up to a minute's worth. 0 means unlimited."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount) -> float:
+        """Seconds until `amount` units are available (0 if they are now). Caller refills first."""
+        if not self.capacity:
+            return 0.0
+        amount = min(amount, self.capacity)  # A request larger than the bucket waits for a full one
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class RequestScheduler:
+    """Process-wide admission control for API requests, shared by every session and client.
+
+    A request is sent once it is the highest-priority waiter (interactive before bulk, then first
+    come first served), the request and token buckets have room, fewer than `limit` requests are in
+    flight and no Retry-After pause is active. `limit` is halved on 429/5xx responses and grows back
+    by about one per `limit` successful requests (AIMD), up to `max_concurrency`.
+    """
+
+    def __init__(self, rpm=RATE_LIMIT_RPM, tpm=RATE_LIMIT_TPM, max_concurrency=SCHEDULER_MAX_CONCURRENCY):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.waiters = []  # Heap of (lane priority, arrival number)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.lane_stats = {
+            lane: {"queued": 0, "max_queued": 0, "requests": 0, "wait_s": 0.0, "max_wait_s": 0.0,
+                   "recent_waits": deque(maxlen=RECENT_WAITS), "throttled": 0, "server_errors": 0, "retries": 0}
+            for lane in LANES
+        }
+
+    def acquire(self, lane, tokens, timeout=None, ticket=None):
+        """Blocks until the request may be sent and takes its share of the buckets. Returns its ticket
+        (pass it back when retrying to keep the place in the queue). Raises TimeoutError after `timeout`."""
+        ticket = ticket or (LANES.index(lane), next(self.sequence))
+        stats = self.lane_stats[lane]
+        start = time.monotonic()
+        deadline = start + timeout if timeout is not None else None
+        with self.condition:
+            heapq.heappush(self.waiters, ticket)
+            stats["queued"] += 1
+            stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self.wait_time(ticket, tokens, now)
+                    if wait == 0.0:
+                        break
+                    if deadline is not None and now >= deadline:
+                        raise TimeoutError(f"Waited {now - start:.1f}s for the API rate limit")
+                    # Woken early when a slot frees up or the queue head changes
+                    self.condition.wait(min(wait, deadline - now) if deadline is not None else wait)
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                stats["queued"] -= 1
+                self.condition.notify_all()
+
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            waited = time.monotonic() - start
+            stats["requests"] += 1
+            stats["wait_s"] += waited
+            stats["max_wait_s"] = max(stats["max_wait_s"], waited)
+            stats["recent_waits"].append(waited)
+        return ticket
+
+    def wait_time(self, ticket, tokens, now) -> float:
+        """Seconds the request should sleep before checking again, 0 if it can go now. Caller holds the lock."""
+        if self.waiters[0] != ticket:
+            return 1.0  # Not first in line; woken when the head leaves
+        if self.in_flight >= max(1, int(self.limit)):
+            return 1.0  # Woken by release()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def release(self, lane, status=None, retry_after=None, retrying=False):
+        """Frees the request's slot and adapts the concurrency limit to its outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            if retrying:
+                self.lane_stats[lane]["retries"] += 1
+            if status in RETRY_STATUSES:
+                self.limit = max(1.0, self.limit / 2)
+                self.lane_stats[lane]["throttled" if status == 429 else "server_errors"] += 1
+                if status == 429 and retry_after:
+                    # The gateway asked everyone to wait, not just this request
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            elif status is not None:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            lanes = {}
+            for lane, stats in self.lane_stats.items():
+                waits = sorted(stats["recent_waits"])
+                lanes[lane] = {
+                    "queued": stats["queued"], "max_queued": stats["max_queued"], "requests": stats["requests"],
+                    "avg_wait_ms": stats["wait_s"] / stats["requests"] * 1000 if stats["requests"] else 0.0,
+                    "p95_wait_ms": waits[int(0.95 * (len(waits) - 1))] * 1000 if waits else 0.0,
+                    "max_wait_ms": stats["max_wait_s"] * 1000,
+                    "throttled": stats["throttled"], "server_errors": stats["server_errors"],
+                    "retries": stats["retries"],
+                }
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "paused_s": max(0.0, self.paused_until - time.monotonic()),
+                "lanes": lanes,
+            }
+
+
+def retry_after_seconds(response):
+    """Delay requested by the gateway in seconds (retry-after-ms or Retry-After), or None."""
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        value = response.headers.get("retry-after")
+        if value is None:
+            return None
+        if value.strip().replace(".", "", 1).isdigit():
+            return float(value)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(request) -> int:
+    """Rough token cost of a request: ~4 bytes per prompt token, plus the expected completion for chat."""
+    try:
+        tokens = len(request.content) // 4
+    except httpx.RequestNotRead:
+        tokens = 0
+    if request.url.path.endswith("/chat/completions"):
+        tokens += SCHEDULER_COMPLETION_TOKENS
+    return tokens
+
+
+class ReleasingStream(httpx.SyncByteStream):
+    """Response body that frees the scheduler slot once it is closed, so streamed answers count as in flight."""
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if self.release is not None:
+                self.release()
+                self.release = None
+
+
+class ScheduledTransport(httpx.HTTPTransport):
+    """HTTP transport that admits every request through the scheduler and retries 429/5xx responses
+    and failed connections.
+
+    Retries keep their place in the queue and wait for Retry-After (or an exponential backoff),
+    so a throttled gateway slows generation down instead of dropping chunks. All attempts of a
+    request, and their waits, stay within its read timeout: a retry that wouldn't fit returns the
+    error to the caller. Callers with their own retry policy send NO_RETRY_HEADER. The API clients
+    don't retry themselves (see commons.py), so retries don't multiply.
+    """
+
+    def __init__(self, scheduler, max_retries=SCHEDULER_MAX_RETRIES, backoff=SCHEDULER_BACKOFF_S, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def backoff_delay(self, attempt, retry_after=None) -> float:
+        return retry_after if retry_after is not None else min(MAX_BACKOFF_S, self.backoff * 2 ** attempt)
+
+    def handle_request(self, request):
+        lane = current_lane.get()
+        tokens = estimate_tokens(request)
+        timeouts = request.extensions.get("timeout") or {}
+        max_retries = 0 if request.headers.pop(NO_RETRY_HEADER, None) else self.max_retries
+        deadline = time.monotonic() + timeouts["read"] if timeouts.get("read") is not None else None
+        ticket = None
+        for attempt in range(max_retries + 1):
+            timeout = timeouts.get("pool")
+            if attempt and deadline is not None:
+                timeout = max(0.0, min(timeout if timeout is not None else deadline, deadline - time.monotonic()))
+            try:
+                ticket = self.scheduler.acquire(lane, tokens, timeout, ticket)
+            except TimeoutError as e:
+                raise httpx.PoolTimeout(str(e), request=request) from e
+            try:
+                response = super().handle_request(request)
+            except (httpx.ConnectError, httpx.RemoteProtocolError) as e:
+                self.scheduler.release(lane)
+                delay = self.backoff_delay(attempt)
+                if attempt == max_retries or not self.fits(delay, deadline):
+                    raise
+                print(f"API request failed ({e}), retrying in {delay:.1f}s ({lane} lane)")
+                time.sleep(delay * random.uniform(0.8, 1.2))
+                continue
+            except Exception:
+                self.scheduler.release(lane)
+                raise
+
+            retry_after = retry_after_seconds(response) if response.status_code in RETRY_STATUSES else None
+            delay = self.backoff_delay(attempt, retry_after)
+            if (response.status_code not in RETRY_STATUSES or attempt == max_retries
+                    or not self.fits(delay, deadline)):
+                status = response.status_code
+                response.stream = ReleasingStream(response.stream, lambda: self.scheduler.release(lane, status))
+                return response
+
+            try:
+                response.read()  # Drain the small error body so the connection can be reused
+            finally:
+                response.close()
+            self.scheduler.release(lane, response.status_code, retry_after, retrying=True)
+            print(f"API returned {response.status_code}, retrying in {delay:.1f}s ({lane} lane)")
+            if response.status_code != 429 or retry_after is None:
+                time.sleep(delay * random.uniform(0.8, 1.2))  # 429s with Retry-After pause the whole scheduler
+
+    @staticmethod
+    def fits(delay, deadline) -> bool:
+        """True if waiting `delay` seconds leaves time for another attempt before the deadline."""
+        return deadline is None or time.monotonic() + delay < deadline
+
+
+@lru_cache(maxsize=None)
+def get_scheduler() -> RequestScheduler:
+    return RequestScheduler()
+
+
+@lru_cache(maxsize=None)
+def get_http_client() -> httpx.Client:
+    """HTTP client shared by the chat, embedding and moderation clients (one connection pool)."""
+    return httpx.Client(
+        transport=ScheduledTransport(get_scheduler()),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+        follow_redirects=True,
+    )
@@ -0,0 +1,172 @@
+# sessions.py
+import os
+import pickle
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from commons import SESSION_SPILL_AFTER_S, SESSION_SPILL_DIR, SESSION_SPILL_TTL_S
+from registry import get_index_registry
+from jobs import get_job_runner
+from tracing import drop_session_spans, span
+
+# Written to disk when a session is spilled and put back on its next rerun
+SPILL_KEYS = ("messages", "flashcards", "quiz_questions", "summary")
+# Dropped when a session is spilled; actions.restore_session_index() reattaches them from index_key
+INDEX_KEYS = ("vectorstore", "text_chunks", "lexical_index", "qa_chain")
+SWEEP_INTERVAL_S = 60
+
+
+class SessionSpiller:
+    """Moves the chat history and study aids of idle sessions to disk and frees their index references.
+
+    Streamlit keeps a session's state in memory for as long as its tab is open, even if nobody
+    looks at it. Every script run reports its start (track) and end (finish) here; sessions
+    without a running script or background jobs whose last run ended `idle_after` seconds ago are
+    spilled by the next sweep, which runs in another session's script thread. Both happen under
+    the lock, so a run starting during a spill waits for it and then gets the values back. Spill
+    files of sessions that don't come back within `ttl` seconds are deleted. Until then the
+    spiller holds a reference to the (emptied) state, since Streamlit doesn't tell when a tab was
+    closed.
+    """
+
+    def __init__(self, directory=SESSION_SPILL_DIR, idle_after=SESSION_SPILL_AFTER_S, ttl=SESSION_SPILL_TTL_S):
+        self.directory = directory
+        self.idle_after = idle_after
+        self.ttl = ttl
+        self.sessions = {}  # session id -> {"state": its session state, "last_seen", "runs", "spilled"}
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+        self.spills = 0
+        self.restores = 0
+        self.spilled_bytes = 0
+
+    def path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.pkl")
+
+    def track(self, session_id, state) -> bool:
+        """Marks a script run of the session as started (before it reads any SPILL_KEYS); it isn't
+        spilled until finish(). Returns True if its spilled values were just restored."""
+        if not self.idle_after:
+            return False  # Spilling is off; don't hold on to the states of closed sessions
+        with self.lock:
+            session = self.sessions.setdefault(session_id, {"spilled": False, "runs": 0})
+            session["state"] = state
+            session["last_seen"] = time.time()
+            session["runs"] += 1
+            if not session["spilled"]:
+                return False
+            session["spilled"] = False
+            return self.restore(session_id, state)
+
+    def finish(self, session_id):
+        """Marks a script run of the session as ended (also when it stopped early, e.g. by st.rerun)."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session["runs"] -= 1
+                session["last_seen"] = time.time()
+
+    def sweep(self):
+        """Spills idle sessions, at most once per SWEEP_INTERVAL_S."""
+        now = time.time()
+        if not self.idle_after or now - self.last_sweep < SWEEP_INTERVAL_S:
+            return
+        with self.lock:
+            self.last_sweep = now
+            for session_id, session in list(self.sessions.items()):
+                idle = now - session["last_seen"]
+                if session["spilled"] and idle > self.ttl:
+                    # Gone for good: forget the state, its spill file and its spans
+                    del self.sessions[session_id]
+                    drop_session_spans(session_id)
+                    if os.path.exists(self.path(session_id)):
+                        os.remove(self.path(session_id))
+                elif not session["spilled"] and not session["runs"] and idle > self.idle_after:
+                    state = session["state"]
+                    if self.has_running_jobs(state):
+                        continue  # The job hands its result to the session's state on a rerun
+                    self.spill(session_id, state)
+                    session["spilled"] = True
+            self.remove_expired_files(now)
+
+    def has_running_jobs(self, state) -> bool:
+        if "jobs" not in state:
+            return False
+        runner = get_job_runner()
+        return any(
+            job is not None and not job.finished for job in (runner.get(job_id) for job_id in state["jobs"].values())
+        )
+
+    def spill(self, session_id, state):
+        """Writes the session's SPILL_KEYS to disk, deletes them and its INDEX_KEYS from `state` and drops its spans.
+        Caller holds the lock and checked that no script run of the session is active."""
+        with span("session_spill", spilled_session=session_id) as attributes:
+            values = {key: state[key] for key in SPILL_KEYS if key in state}
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-", suffix=".pkl")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(tmp_path, self.path(session_id))
+            attributes["bytes"] = size
+
+        for key in SPILL_KEYS + INDEX_KEYS:
+            if key in state:
+                del state[key]
+        if "index_key" in state:
+            # The shared index may be evicted while nobody else uses it; it is reloaded on return
+            get_index_registry().release(state["index_key"], session_id)
+        drop_session_spans(session_id)  # The performance panel starts over when the session comes back
+        self.spills += 1
+        self.spilled_bytes += size
+
+    def restore(self, session_id, state) -> bool:
+        path = self.path(session_id)
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            values = pickle.load(f)
+        for key, value in values.items():
+            state[key] = value
+        os.remove(path)
+        self.restores += 1
+        return True
+
+    def remove_expired_files(self, now):
+        """Spill files left by earlier server processes. Caller holds the lock."""
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and now - entry.stat().st_mtime > self.ttl:
+                os.remove(entry.path)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "spilled": sum(1 for session in self.sessions.values() if session["spilled"]),
+                "spills": self.spills,
+                "restores": self.restores,
+                "spilled_bytes": self.spilled_bytes,
+            }
+
+
+@lru_cache(maxsize=None)
+def get_session_spiller() -> SessionSpiller:
+    return SessionSpiller()
+
+
+@contextmanager
+def session_run(session_id):
+    """Wraps a script run of the session: restores its spilled state on entry, keeps it from being
+    spilled until the run ends, and spills idle sessions. Yields True if the state was restored."""
+    spiller = get_session_spiller()
+    restored = spiller.track(session_id, get_script_run_ctx().session_state)
+    try:
+        spiller.sweep()
+        yield restored
+    finally:
+        spiller.finish(session_id)
@@ -0,0 +1,110 @@
+# summarize.py
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain.prompts import PromptTemplate
+from cache import generation_key, get_result_cache, text_hash
+from commons import MAX_CONCURRENCY, SUMMARY_TOKEN_BUDGET, count_tokens
+from utils import pack_by_tokens
+from tracing import add_token_usage, bind_context, span
+from jobs import add_progress_total, advance_progress, count_stats, is_cancelled
+
+# Used for the per-chunk map step as well as for collapsing partial summaries
+summary_prompt = PromptTemplate(
+    input_variables=["text"],
+    template=(
+        "Analyze the provided text and extract the key information concisely. If the text is structured into sections, "
+        "identify and summarize each section separately. If the text is unstructured, generate a well-organized summary "
+        "covering the main points. Keep the summaries clear, concise, and informative.\n\n"
+        "**Text:**\n{text}\n\n"
+        "**Summary:**\n[Generate a structured or free-form summary based on the document format.]"
+    )
+)
+
+MAX_COLLAPSE_LEVELS = 5
+
+
+def summarize_text(text, model) -> str:
+    with span("llm.summary", bytes=len(text)) as attributes:
+        response = (summary_prompt | model).invoke({"text": text})
+        add_token_usage(attributes, response)
+    count_stats("summary", input_tokens=attributes.get("input_tokens", 0), output_tokens=attributes.get("output_tokens", 0))
+    return response.content
+
+
+def map_chunks(text_chunks, model, max_concurrency=MAX_CONCURRENCY, regenerate=False) -> list:
+    """Summarizes every chunk concurrently. Partial summaries are cached by chunk hash,
+    so after a small document change only the changed chunks are sent to the model.
+    Chunks not yet started when the job is cancelled are skipped (their summary is None)."""
+    result_cache = get_result_cache()
+
+    def map_one(chunk):
+        key = generation_key("summary_map", summary_prompt, model, chunk)
+        cached = None if regenerate else result_cache.get(key)
+        if cached is None:
+            if is_cancelled():
+                return None, False
+            cached = summarize_text(chunk, model)
+            result_cache.set(key, cached)
+            was_cached = False
+        else:
+            was_cached = True
+        advance_progress()
+        return cached, was_cached
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        results = list(executor.map(bind_context(map_one), text_chunks))
+
+    cached_count = sum(1 for _, was_cached in results if was_cached)
+    print(f"[summary] map: {len(text_chunks)} chunks, {cached_count} from cache")
+    return [partial for partial, _ in results]
+
+
+def collapse(summaries, model, token_budget=SUMMARY_TOKEN_BUDGET, max_concurrency=MAX_CONCURRENCY) -> list:
+    """Merges partial summaries level by level until all of them fit into one call."""
+    level = 0
+    while len(summaries) > 1 and count_tokens("\n\n".join(summaries)) > token_budget:
+        level += 1
+        if level > MAX_COLLAPSE_LEVELS:
+            print(f"[summary] still over budget after {MAX_COLLAPSE_LEVELS} collapse levels, reducing anyway")
+            break
+
+        groups = pack_by_tokens(summaries, token_budget)
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            summaries = list(executor.map(
+                bind_context(lambda group: summarize_text("\n\n".join(group), model)), groups
+            ))
+        print(f"[summary] collapse level {level}: {len(groups)} group(s)")
+    return summaries
+
+
+def summarize_chunks(
+    text_chunks, model, token_budget=SUMMARY_TOKEN_BUDGET, max_concurrency=MAX_CONCURRENCY, regenerate=False
+) -> str:
+    """Summarizes the chunks in one call if they fit the token budget, else map -> collapse -> reduce.
+
+    The final summary is cached for the exact chunk list; `regenerate` skips all cache lookups.
+    Returns None if the background job running it is cancelled.
+    """
+    start = time.perf_counter()
+    result_cache = get_result_cache()
+    key = generation_key("summary", summary_prompt, model, "\n".join(text_hash(chunk) for chunk in text_chunks))
+    summary = None if regenerate else result_cache.get(key)
+    add_progress_total(len(text_chunks))
+    if summary is not None:
+        print(f"[summary] {len(text_chunks)} chunks, summary from cache")
+        advance_progress(len(text_chunks))
+        return summary
+
+    full_text = "\n\n".join(text_chunks)
+    if count_tokens(full_text) <= token_budget:
+        summary = summarize_text(full_text, model)
+        advance_progress(len(text_chunks))
+    else:
+        summaries = map_chunks(text_chunks, model, max_concurrency, regenerate)
+        if is_cancelled():
+            return None
+        summaries = collapse(summaries, model, token_budget, max_concurrency)
+        summary = summarize_text("\n\n".join(summaries), model)
+    result_cache.set(key, summary)
+    print(f"[summary] {len(text_chunks)} chunks summarized in {time.perf_counter() - start:.2f}s")
+    return summary
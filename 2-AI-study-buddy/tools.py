@@ -1,101 +1,304 @@
-from langchain.docstore.document import Document
-from langchain.chains.summarize import load_summarize_chain
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain.prompts import PromptTemplate
 from langchain.tools import tool
-from utils import parse_questions, parse_flashcards
+from cache import generation_key, get_result_cache, splitter_settings, text_hash
+from commons import MAX_CONCURRENCY, PACK_TOKEN_BUDGET, SUMMARY_TOKEN_BUDGET, count_tokens
+from utils import parse_questions, parse_flashcards, pack_by_tokens
+from summarize import summarize_chunks, summary_prompt
+from tracing import add_token_usage, bind_context, span
+from jobs import add_progress_total, advance_progress, count_stats, is_cancelled, report_stats
 
-# Summarization function (takes `model` as a parameter)
-@tool
-def generate_summary(text_chunks: list[str], model) -> str:
-    """Generates a summary from the given text chunks using the provided model."""
-    
-    docs = [Document(page_content=chunk) for chunk in text_chunks]
-
-    summary_prompt = PromptTemplate(
-        input_variables=["text"],
-        template=(
-            "Analyze the provided text and extract the key information concisely. If the text is structured into sections, "
-            "identify and summarize each section separately. If the text is unstructured, generate a well-organized summary "
-            "covering the main points. Keep the summaries clear, concise, and informative.\n\n"
-            "**Text:**\n{text}\n\n"
-            "**Summary:**\n[Generate a structured or free-form summary based on the document format.]"
+# Packed requests hold several chunks, each introduced by a numbered marker line
+SECTION_MARKER = "=== SECTION {} ==="
+SECTION_PATTERN = re.compile(r"^[#*\s]*=== SECTION (\d+) ===[*\s]*$", re.MULTILINE)
+PACKING_INSTRUCTIONS = (
+    "\n\nThe text above is divided into sections, each starting with a line like '=== SECTION 1 ==='. "
+    "Handle every section separately. Start the output for each section with its marker line, "
+    "exactly as given, followed by the items for that section."
+)
+
+question_prompt = PromptTemplate(
+    input_variables=["text"],
+    template="Generate a mix of MULTIPLE-CHOICE and TRUE/FALSE quiz questions based on the following text:\n{text}.\n\n"
+             "The number of questions should be proportional to the length of the text.\n\n"
+             "Each question MUST be formatted like this:\n"
+             "Question: The question text\n"
+             "Type: multiple_choice or true_false\n"
+             "Options: (For multiple-choice) A) Option A, B) Option B, C) Option C, D) Option D\n"
+             "Options: (For true/false) A) True, B) False\n"
+             "Correct Answer: A or B or C or D (for multiple-choice), A or B (for true/false)\n"
+             "Explanation: Explanation of the answer\n\n"
+             "Separate each question with a blank line.\n\n"
+             "Return ONLY the questions in the specified format. Do not include any other text."
+)
+
+flashcard_prompt = PromptTemplate(
+    input_variables=["text"],
+    template="Generate concise and stricly an identification type of flashcards from the following text:\n{text}\n\n"
+             "Each flashcard should have:\n"
+             "- **Front (Question):** A key concept in question form.\n"
+             "- **Back (Answer):** The answer or explanation.\n\n"
+             "Format each flashcard like this:\n"
+             "Front: [Question]\n"
+             "Back: [Answer]\n\n"
+             "Return ONLY the flashcards in this format, without extra text."
+)
+
+
+def iter_concurrently(chain, request_texts, label, max_concurrency=MAX_CONCURRENCY, chunk_counts=None):
+    """Invokes the chain on every text with at most `max_concurrency` calls in flight.
+
+    Yields (request index, response content) as the calls finish. A failed call is logged
+    and gives None, the other calls are not affected. When running as a background job,
+    each finished request advances the job's progress by its entry in `chunk_counts`
+    (default 1), and requests that haven't started when the job is cancelled are skipped.
+    Token usage and failed requests are counted in the job's statistics under `label`.
+    """
+    def run_one(text, chunk_count):
+        call_start = time.perf_counter()
+        if is_cancelled():
+            return None, 0.0
+        with span(f"llm.{label}", bytes=len(text)) as attributes:
+            try:
+                response = chain.invoke({"text": text})
+                add_token_usage(attributes, response)
+                content = response.content
+            except Exception as e:
+                print(f"Error generating {label} for chunk: {e}")
+                attributes["error"] = str(e)
+                content = None
+        count_stats(
+            label, input_tokens=attributes.get("input_tokens", 0), output_tokens=attributes.get("output_tokens", 0),
+            failed_requests=int(content is None),
         )
+        advance_progress(chunk_count)
+        return content, time.perf_counter() - call_start
+
+    if chunk_counts is None:
+        chunk_counts = [1] * len(request_texts)
+    start = time.perf_counter()
+    request_latencies = [0.0] * len(request_texts)
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {
+            executor.submit(bind_context(run_one), text, chunk_count): i
+            for i, (text, chunk_count) in enumerate(zip(request_texts, chunk_counts))
+        }
+        try:
+            for future in as_completed(futures):
+                content, request_latencies[futures[future]] = future.result()
+                yield futures[future], content
+        except GeneratorExit:
+            # The caller stopped early: drop queued requests, only the ones in flight finish
+            for future in futures:
+                future.cancel()
+            raise
+    wall_clock = time.perf_counter() - start
+
+    latencies = sorted(request_latencies)
+    stats = {
+        "chunks": len(request_texts),
+        "max_concurrency": max_concurrency,
+        "wall_clock_s": wall_clock,
+        "chunk_latencies_s": request_latencies,
+        "p50_chunk_s": latencies[len(latencies) // 2] if latencies else 0.0,
+        "max_chunk_s": latencies[-1] if latencies else 0.0,
+    }
+    report_stats(label, **stats)  # Shown with the job's result, see actions.show_run_stats()
+    print(
+        f"[{label}] {stats['chunks']} requests in {wall_clock:.2f}s "
+        f"(concurrency={max_concurrency}, p50 request={stats['p50_chunk_s']:.2f}s, max request={stats['max_chunk_s']:.2f}s)"
     )
 
-    chain_type = "map_reduce" if len(docs) > 5 else "stuff"
-    chain = load_summarize_chain(model, chain_type=chain_type, prompt=summary_prompt)
 
-    summary_dict = chain.invoke(docs)
-    return summary_dict["output_text"]
+def invoke_concurrently(chain, request_texts, label, max_concurrency=MAX_CONCURRENCY, chunk_counts=None):
+    """Like iter_concurrently(), but waits for all calls and returns the contents in input order."""
+    contents = [None] * len(request_texts)
+    for i, content in iter_concurrently(chain, request_texts, label, max_concurrency, chunk_counts):
+        contents[i] = content
+    return contents
 
-@tool
-def generate_quiz_questions(text_chunks: list, model) -> list:
-    """Generates a mix of multiple-choice and true/false quiz questions from a list of text chunks."""
 
-    question_prompt = PromptTemplate(
-        input_variables=["text"],
-        template="Generate a mix of MULTIPLE-CHOICE and TRUE/FALSE quiz questions based on the following text:\n{text}.\n\n"
-                 "The number of questions should be proportional to the length of the text.\n\n"
-                 "Each question MUST be formatted like this:\n"
-                 "Question: The question text\n"
-                 "Type: multiple_choice or true_false\n"
-                 "Options: (For multiple-choice) A) Option A, B) Option B, C) Option C, D) Option D\n"
-                 "Options: (For true/false) A) True, B) False\n"
-                 "Correct Answer: A or B or C or D (for multiple-choice), A or B (for true/false)\n"
-                 "Explanation: Explanation of the answer\n\n"
-                 "Separate each question with a blank line.\n\n"
-                 "Return ONLY the questions in the specified format. Do not include any other text."
+def pack_requests(text_chunks, prompt, token_budget, label):
+    """Groups consecutive chunks into requests of at most `token_budget` tokens.
+
+    Returns (prompt, groups, request_texts): the prompt asks for per-section output and
+    groups holds the chunk positions of each request. With a budget of 0 every chunk is
+    its own request and the prompt is unchanged.
+    """
+    if token_budget <= 0 or not text_chunks:
+        return prompt, [[i] for i in range(len(text_chunks))], list(text_chunks)
+
+    packed_prompt = PromptTemplate(input_variables=["text"], template=prompt.template + PACKING_INSTRUCTIONS)
+    groups, position = [], 0
+    for group in pack_by_tokens(text_chunks, token_budget):
+        groups.append(list(range(position, position + len(group))))
+        position += len(group)
+    request_texts = [
+        "\n\n".join(f"{SECTION_MARKER.format(number)}\n{text_chunks[i]}" for number, i in enumerate(group, 1))
+        for group in groups
+    ]
+
+    unpacked_tokens = sum(count_tokens(prompt.format(text=chunk)) for chunk in text_chunks)
+    packed_tokens = sum(count_tokens(packed_prompt.format(text=text)) for text in request_texts)
+    print(
+        f"[{label}] packed {len(text_chunks)} chunks into {len(request_texts)} requests: "
+        f"{len(text_chunks) - len(request_texts)} requests and {unpacked_tokens - packed_tokens} prompt tokens saved"
+    )
+    # With the request stats of the same label, shown by actions.show_run_stats()
+    report_stats(
+        label, packed_chunks=len(text_chunks), requests_saved=len(text_chunks) - len(request_texts),
+        prompt_tokens_saved=unpacked_tokens - packed_tokens,
+        fill_ratio=packed_tokens / (len(request_texts) * token_budget),
     )
+    return packed_prompt, groups, request_texts
 
-    all_questions = []
-    for chunk in text_chunks:
-        chain = question_prompt | model  # Create the RunnableSequence
-        response = chain.invoke({"text": chunk})  # Invoke the chain, passing input as a dictionary
-        questions_str = response.content  # Access the content (string)
 
-        try:
-            questions_list = parse_questions(questions_str)
-            if isinstance(questions_list, list) and len(questions_list) > 0:
-                all_questions.extend(questions_list)
-            else:
-                print(f"LLM did not return questions in the correct format. Raw string: {questions_str}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}. Raw string: {questions_str}")
+def split_sections(content, parse, section_count):
+    """Parses a response into one item list per section, in section order.
 
-    return all_questions
+    Returns (per_section, attributed). When a response for several sections has no
+    section markers, every item goes to the first section and attributed is False.
+    """
+    parts = SECTION_PATTERN.split(content)
+    if len(parts) == 1:
+        # No markers: fine for a single section, otherwise the items can't be told apart
+        return [parse(content)] + [[] for _ in range(section_count - 1)], section_count == 1
 
-@tool
-def generate_flashcards(text_chunks: list, model) -> list:
-    """Generates flashcards from text chunks where the front is a question and the back is an answer."""
+    per_section = [[] for _ in range(section_count)]
+    for number, body in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < section_count:
+            per_section[index].extend(parse(body))
+    return per_section, True
 
-    flashcard_prompt = PromptTemplate(
-        input_variables=["text"],
-        template="Generate concise and stricly an identification type of flashcards from the following text:\n{text}\n\n"
-                 "Each flashcard should have:\n"
-                 "- **Front (Question):** A key concept in question form.\n"
-                 "- **Back (Answer):** The answer or explanation.\n\n"
-                 "Format each flashcard like this:\n"
-                 "Front: [Question]\n"
-                 "Back: [Answer]\n\n"
-                 "Return ONLY the flashcards in this format, without extra text."
-    )
 
-    all_flashcards = []
-    for chunk in text_chunks:
-        chain = flashcard_prompt | model
-        response = chain.invoke({"text": chunk})
+def iter_items(prompt, text_chunks, model, parse, label, max_concurrency, token_budget, regenerate=False):
+    """Runs `prompt` over the chunks and yields (chunk index, parsed items) as chunks complete.
 
+    Parsed items are cached per chunk and cached chunks are yielded first. Only chunks
+    without a cached result are packed into requests and sent to the model; `regenerate`
+    skips the lookup (results are still stored). A chunk whose request or parse fails
+    yields nothing.
+    """
+    result_cache = get_result_cache()
+    keys = [generation_key(label, prompt, model, chunk) for chunk in text_chunks]
+    missing = []
+    for i, key in enumerate(keys):
+        items = None if regenerate else result_cache.get(key)
+        if items is None:
+            missing.append(i)
+        else:
+            yield i, items
+    print(f"[{label}] {len(text_chunks) - len(missing)} of {len(text_chunks)} chunks from cache")
+    add_progress_total(len(text_chunks))
+    advance_progress(len(text_chunks) - len(missing))  # Cached chunks are done already
+
+    request_prompt, groups, request_texts = pack_requests(
+        [text_chunks[i] for i in missing], prompt, token_budget, label
+    )
+    chain = request_prompt | model  # Create the RunnableSequence once, it is shared by all requests
+    for request_index, content in iter_concurrently(
+        chain, request_texts, label, max_concurrency, [len(group) for group in groups]
+    ):
+        if content is None:
+            continue
+        group = groups[request_index]
         try:
-            # Extract flashcards
-            flashcards_list = parse_flashcards(response.content)
-            if isinstance(flashcards_list, list) and flashcards_list:
-                all_flashcards.extend(flashcards_list)
-            else:
-                print(f"LLM did not return flashcards correctly. Raw response: {response.content}")
+            with span(f"parse.{label}", bytes=len(content)):
+                per_section, attributed = split_sections(content, parse, len(group))
         except Exception as e:
-            print(f"Error parsing flashcards: {e}. Raw response: {response.content}")
+            print(f"Error parsing {label}: {e}. Raw response: {content}")
+            continue
+        if not any(per_section):
+            print(f"LLM did not return {label} in the correct format. Raw response: {content}")
+
+        for position, items in zip(group, per_section):
+            chunk_index = missing[position]
+            if attributed and items:
+                result_cache.set(keys[chunk_index], items)
+            yield chunk_index, items
+    report_stats(label, cache_hits=len(text_chunks) - len(missing))
+
+
+def generate_items(prompt, text_chunks, model, parse, label, max_concurrency, token_budget, regenerate=False) -> list:
+    """Like iter_items(), but waits for all chunks and returns the items in chunk order."""
+    per_chunk = [[] for _ in text_chunks]
+    for chunk_index, items in iter_items(
+        prompt, text_chunks, model, parse, label, max_concurrency, token_budget, regenerate
+    ):
+        per_chunk[chunk_index] = items
+
+    all_items = []
+    for items in per_chunk:
+        all_items.extend(items)
+    return all_items
+
+
+def iter_quiz_questions(
+    text_chunks, model, max_concurrency=MAX_CONCURRENCY, token_budget=PACK_TOKEN_BUDGET, regenerate=False
+):
+    """Yields the quiz questions of each chunk as soon as the chunk is done (in completion order)."""
+    with span("generate_quiz_questions", chunks=len(text_chunks)):
+        for _, items in iter_items(
+            question_prompt, text_chunks, model, parse_questions, "questions", max_concurrency, token_budget, regenerate
+        ):
+            yield items
+
+
+def iter_flashcards(
+    text_chunks, model, max_concurrency=MAX_CONCURRENCY, token_budget=PACK_TOKEN_BUDGET, regenerate=False
+):
+    """Yields the flashcards of each chunk as soon as the chunk is done (in completion order)."""
+    with span("generate_flashcards", chunks=len(text_chunks)):
+        for _, items in iter_items(
+            flashcard_prompt, text_chunks, model, parse_flashcards, "flashcards", max_concurrency, token_budget, regenerate
+        ):
+            yield items
+
 
-    return all_flashcards
+def pack_settings(model, text_splitter, chunk_count) -> dict:
+    """Everything a study pack of a PDF with `chunk_count` chunks depends on besides the PDF itself.
+    batch.py stores it in the pack, and a pack is only reused while all of it matches."""
+    prompts = (summary_prompt, question_prompt, flashcard_prompt)
+    return {
+        "model": getattr(model, "model_name", None) or type(model).__name__,
+        "splitter": splitter_settings(text_splitter),
+        "chunks": chunk_count,
+        "prompts": text_hash("\n".join(prompt.template for prompt in prompts) + PACKING_INSTRUCTIONS),
+        "summary_token_budget": SUMMARY_TOKEN_BUDGET,
+        "pack_token_budget": PACK_TOKEN_BUDGET,
+    }
 
 
+# Summarization function (takes `model` as a parameter)
+@tool
+def generate_summary(text_chunks: list[str], model, regenerate: bool = False) -> str:
+    """Generates a summary from the given text chunks using the provided model."""
+    
+    # Concurrent map with cached partial summaries and a token-budgeted, multi-level reduce
+    with span("generate_summary", chunks=len(text_chunks)):
+        return summarize_chunks(text_chunks, model, regenerate=regenerate)
 
+@tool
+def generate_quiz_questions(
+    text_chunks: list, model, max_concurrency: int = MAX_CONCURRENCY, token_budget: int = PACK_TOKEN_BUDGET,
+    regenerate: bool = False
+) -> list:
+    """Generates a mix of multiple-choice and true/false quiz questions from a list of text chunks."""
+    with span("generate_quiz_questions", chunks=len(text_chunks)):
+        return generate_items(
+            question_prompt, text_chunks, model, parse_questions, "questions", max_concurrency, token_budget, regenerate
+        )
+
+@tool
+def generate_flashcards(
+    text_chunks: list, model, max_concurrency: int = MAX_CONCURRENCY, token_budget: int = PACK_TOKEN_BUDGET,
+    regenerate: bool = False
+) -> list:
+    """Generates flashcards from text chunks where the front is a question and the back is an answer."""
+    with span("generate_flashcards", chunks=len(text_chunks)):
+        return generate_items(
+            flashcard_prompt, text_chunks, model, parse_flashcards, "flashcards", max_concurrency, token_budget, regenerate
+        )
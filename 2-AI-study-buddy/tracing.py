@@ -0,0 +1,185 @@
+# tracing.py
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from commons import TRACE_FILE, TRACE_FLUSH_SPANS, TRACE_FLUSH_INTERVAL_S, TRACE_FILE_MAX_BYTES
+
+# Spans kept in memory for the performance panel: the latest SPANS_PER_SESSION of at most MAX_SESSIONS
+# sessions. A session's spans go when it is spilled (see sessions.py) or records none for SPANS_IDLE_TTL_S
+MAX_SESSIONS = 1000
+SPANS_PER_SESSION = 500
+SPANS_IDLE_TTL_S = 3600
+
+# Session and parent span of the code that is running, copied into worker threads by bind_context
+current_session = contextvars.ContextVar("current_session", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+session_spans = OrderedDict()  # session id -> deque of finished spans, most recently active session last
+spans_lock = threading.Lock()
+export_lock = threading.Lock()  # Guards the buffer; spans are recorded without waiting for the file
+write_lock = threading.Lock()
+export_buffer = []  # JSON lines not written yet
+last_flush = time.monotonic()
+
+
+def set_session(session_id):
+    """Attributes spans recorded from now on (in this context) to `session_id`."""
+    current_session.set(session_id)
+
+
+def bind_context(fn):
+    """Wraps `fn` so it runs with the caller's session and parent span, e.g. in a thread pool."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)  # One copy per call, so threads never share a context
+
+    return run
+
+
+def export(record):
+    """Buffers the span for TRACE_FILE and writes the buffer once it is full or old enough."""
+    global last_flush
+    if not TRACE_FILE:
+        return
+    line = json.dumps(record)
+    with export_lock:
+        export_buffer.append(line)
+        now = time.monotonic()
+        if len(export_buffer) < TRACE_FLUSH_SPANS and now - last_flush < TRACE_FLUSH_INTERVAL_S:
+            return
+        lines = export_buffer[:]
+        export_buffer.clear()
+        last_flush = now
+    write_lines(lines)
+
+
+def write_lines(lines):
+    with write_lock:
+        os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE, TRACE_FILE + ".1")
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+@atexit.register
+def flush_traces():
+    """Writes the buffered spans (also on interpreter exit)."""
+    with export_lock:
+        lines = export_buffer[:]
+        export_buffer.clear()
+    if lines and TRACE_FILE:
+        write_lines(lines)
+
+
+def new_span_context(parent):
+    return {
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+        "span_id": uuid.uuid4().hex[:16],
+    }
+
+
+def record_span(name, start, end, attributes=None, parent=None, context=None):
+    """Stores a finished span and exports it to TRACE_FILE (if set) as an OpenTelemetry-style JSON line."""
+    parent = parent if parent is not None else current_span.get()
+    context = context or new_span_context(parent)
+    session_id = current_session.get()
+    record = {
+        "name": name,
+        "trace_id": context["trace_id"],
+        "span_id": context["span_id"],
+        "parent_span_id": parent["span_id"] if parent else None,
+        "start_time_unix_nano": int(start * 1e9),
+        "end_time_unix_nano": int(end * 1e9),
+        "duration_ms": (end - start) * 1000,
+        "attributes": dict(attributes or {}, session_id=session_id),
+    }
+    if session_id is not None:
+        with spans_lock:
+            spans = session_spans.get(session_id)
+            if spans is None:
+                spans = session_spans[session_id] = deque(maxlen=SPANS_PER_SESSION)
+            else:
+                session_spans.move_to_end(session_id)
+            spans.append(record)
+            evict_idle_sessions(end)
+    export(record)
+    return record
+
+
+def evict_idle_sessions(now):
+    """Drops the spans of the least recently active sessions while there are too many or they are
+    idle for over SPANS_IDLE_TTL_S. Caller holds spans_lock."""
+    while session_spans:
+        oldest = next(iter(session_spans.values()))
+        idle = now - oldest[-1]["end_time_unix_nano"] / 1e9
+        if len(session_spans) <= MAX_SESSIONS and idle <= SPANS_IDLE_TTL_S:
+            break
+        session_spans.popitem(last=False)
+
+
+def drop_session_spans(session_id):
+    """Frees the session's spans, e.g. when the session is spilled to disk."""
+    with spans_lock:
+        session_spans.pop(session_id, None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block. Yields the attribute dict, so callers can add token counts or bytes to it."""
+    parent = current_span.get()
+    context = new_span_context(parent)
+    start = time.time()
+    token = current_span.set(context)  # Spans opened inside the block become children of this one
+    try:
+        yield attributes
+    except Exception as e:
+        attributes["error"] = str(e)
+        raise
+    finally:
+        current_span.reset(token)
+        record_span(name, start, time.time(), attributes, parent, context)
+
+
+def add_token_usage(attributes, message):
+    """Copies token usage of a LangChain AIMessage (or stream chunk) into span attributes."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage:
+        attributes["input_tokens"] = attributes.get("input_tokens", 0) + usage.get("input_tokens", 0)
+        attributes["output_tokens"] = attributes.get("output_tokens", 0) + usage.get("output_tokens", 0)
+
+
+def get_session_spans(session_id) -> list:
+    with spans_lock:
+        return list(session_spans.get(session_id, ()))
+
+
+def summarize_spans(spans, group_by=None) -> list:
+    """Per span name: count, total and max duration, tokens and bytes.
+
+    With `group_by`, spans are further split by that attribute, e.g. "llm.chat [mmr]".
+    """
+    rows = {}
+    for record in spans:
+        name = record["name"]
+        if group_by and record["attributes"].get(group_by) is not None:
+            name = f"{name} [{record['attributes'][group_by]}]"
+        row = rows.setdefault(name, {
+            "span": name, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "input_tokens": 0, "output_tokens": 0, "bytes": 0,
+        })
+        attributes = record["attributes"]
+        row["count"] += 1
+        row["total_ms"] += record["duration_ms"]
+        row["max_ms"] = max(row["max_ms"], record["duration_ms"])
+        row["input_tokens"] += attributes.get("input_tokens", 0)
+        row["output_tokens"] += attributes.get("output_tokens", 0)
+        row["bytes"] += attributes.get("bytes", 0)
+    return sorted(rows.values(), key=lambda row: row["total_ms"], reverse=True)
@@ -1,43 +1,293 @@
 # utils.py
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from itertools import islice
+import faiss
 from PyPDF2 import PdfReader
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from commons import init_embedding, init_moderation
+from langchain_core.documents import Document
+from commons import (
+    get_embedding, count_tokens, CACHE_DIR, PDF_WORKERS, PDF_PAGES_PER_TASK, INDEX_TYPE
+)
+from indexes import build_index, choose_index_type, index_type_of, prepare_index, supports_removal
+from cache import EmbeddingStore
+from chunking import chunk_pages, splitter_config
+from tracing import span, record_span
 
-embedding = init_embedding()  # Initialize the embedding from commons.py
-moderation_client = init_moderation()
 
+@lru_cache(maxsize=None)
+def get_embedding_store() -> EmbeddingStore:
+    return EmbeddingStore(os.path.join(CACHE_DIR, "embeddings.sqlite"))
 
-def get_vectorstore(text_chunks):
-    # Use the initialized embedding from commons.py
-    vectorstore = FAISS.from_texts(texts=text_chunks, embedding=embedding)
+
+def get_vectorstore(documents, ids=None, index_type=INDEX_TYPE):
+    """Embeds the chunk Documents (through the embedding store) and indexes them in a FAISS index
+    of `index_type`, see indexes.py."""
+    embedding = get_embedding()  # Shared embedding client from commons.py
+    embedding_store = get_embedding_store()
+    text_chunks = [doc.page_content for doc in documents]
+
+    with span("get_vectorstore", chunks=len(text_chunks)):
+        # Reuse cached chunk embeddings, only new chunks go to the embedding API
+        misses_before = embedding_store.misses
+        with span("embed_texts", bytes=sum(len(chunk) for chunk in text_chunks)) as attributes:
+            vectors = embedding_store.embed_texts(text_chunks, embedding)
+            attributes["embedded"] = embedding_store.misses - misses_before
+        print(f"Embedding store: {embedding_store.stats()}")
+
+        # The embedding client is still used to embed queries
+        with span("faiss_build", vectors=len(vectors)) as attributes:
+            index = build_index(vectors, index_type)
+            vectorstore = FAISS(embedding, index, InMemoryDocstore(), {})
+            vectorstore.add_embeddings(
+                list(zip(text_chunks, vectors)), metadatas=[doc.metadata for doc in documents], ids=ids
+            )
+            attributes["index_type"] = index_type_of(index)
     return vectorstore
 
-def moderate_text(text: str) -> bool:
-    try:
-        # Create a moderation request (model is already set in init_moderation)
-        response = moderation_client.moderations.create(
-            input=text, 
-            model="omni-moderation-latest"
-        )    
-        is_flagged = response.results[0].flagged
-
-        if is_flagged:
-            return False # Text is unsafe
-        else: 
-            return True # Text is safe
-        
-    except Exception as e:
-        print(f"Error during moderation: {e}")
-        return False  # Assume unsafe in case of error
+
+def clone_vectorstore(vectorstore):
+    """An independent copy of the vector store (index, docstore and id mapping) that can be updated
+    without affecting sessions still using the original. Documents themselves are shared."""
+    return FAISS(
+        vectorstore.embedding_function,
+        prepare_index(faiss.clone_index(vectorstore.index)),
+        InMemoryDocstore(dict(vectorstore.docstore._dict)),
+        dict(vectorstore.index_to_docstore_id),
+    )
+
+
+def rebuild_vectorstore(vectorstore, index_type=INDEX_TYPE):
+    """Rebuilds the index of the vector store in place from its documents, e.g. with a type that
+    fits its new size. The embeddings come from the embedding store, so nothing is re-embedded."""
+    ids = [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))]
+    docs = [vectorstore.docstore.search(id_) for id_ in ids]
+    rebuilt = get_vectorstore(docs, ids, choose_index_type(len(docs), index_type))
+    vectorstore.index = rebuilt.index
+    vectorstore.docstore = rebuilt.docstore
+    vectorstore.index_to_docstore_id = rebuilt.index_to_docstore_id
+
+
+def chunk_ids(documents) -> list:
+    """Stable vector store ids, "<file hash>:<chunk number within that file>"."""
+    counts = {}
+    ids = []
+    for metadata in (doc.metadata for doc in documents):
+        number = counts.get(metadata["file_hash"], 0)
+        counts[metadata["file_hash"]] = number + 1
+        ids.append(f"{metadata['file_hash']}:{number}")
+    return ids
+
+
+def index_files(documents, ids) -> dict:
+    """Maps every file hash to its source name and the ids of its chunks in the vector store."""
+    indexed_files = {}
+    for doc, id_ in zip(documents, ids):
+        metadata = doc.metadata
+        entry = indexed_files.setdefault(metadata["file_hash"], {"source": metadata["source"], "ids": []})
+        entry["ids"].append(id_)
+    return indexed_files
+
+
+def chunk_pdfs(pdf_docs, text_splitter, max_workers=PDF_WORKERS) -> list:
+    """Returns the chunk Documents of the given PDFs, in document and page order.
+
+    Page ranges are extracted and split in worker processes (see chunking.py); every chunk has
+    source, file_hash, page, offset, end_page and, if it starts in a titled section, section metadata.
+    """
+    documents = []
+    pages = tokens = 0
+    start = time.time()
+    results = run_pdf_tasks(pdf_docs, chunk_page_range, splitter_config(text_splitter), max_workers)
+    for source, file_hash, first_page, last_page, (chunks, task_tokens) in results:
+        pages += last_page - first_page
+        tokens += task_tokens
+        for text, metadata in chunks:
+            documents.append(Document(page_content=text, metadata={"source": source, "file_hash": file_hash, **metadata}))
+    end = time.time()
+
+    tokens_per_s = tokens / max(end - start, 1e-9)
+    record_span("chunk_pdfs", start, end, {
+        "pages": pages, "chunks": len(documents), "tokens": tokens, "tokens_per_s": round(tokens_per_s),
+        "workers": max_workers,
+    })
+    print(f"Chunked {pages} pages ({tokens} tokens) into {len(documents)} chunks at {tokens_per_s:,.0f} tokens/s")
+    return documents
+
+
+def update_vectorstore(vectorstore, indexed_files, uploads, text_splitter):
+    """Brings the vector store in line with `uploads` ({file hash: pdf}) in place.
+
+    Only files that are new get chunked and embedded, and only the vectors of files
+    that are gone get deleted. Returns (added, removed) file counts.
+    """
+    removed = [file_hash for file_hash in indexed_files if file_hash not in uploads]
+    removed_ids = []
+    for file_hash in removed:
+        removed_ids.extend(indexed_files.pop(file_hash)["ids"])
+    needs_rebuild = False
+    if removed_ids and supports_removal(vectorstore.index):
+        vectorstore.delete(removed_ids)
+    elif removed_ids:
+        # Other index types can't drop vectors the way FAISS.delete expects: forget the
+        # documents here and rebuild the index from the rest below
+        removed_set = set(removed_ids)
+        vectorstore.docstore.delete(removed_ids)
+        kept = [id_ for _, id_ in sorted(vectorstore.index_to_docstore_id.items()) if id_ not in removed_set]
+        vectorstore.index_to_docstore_id = dict(enumerate(kept))
+        needs_rebuild = True
+
+    added = [pdf for file_hash, pdf in uploads.items() if file_hash not in indexed_files]
+    if added:
+        documents = chunk_pdfs(added, text_splitter)
+        ids = chunk_ids(documents)
+        if documents:
+            # Add to the existing (trained) index; merge_from only works between equal index types
+            text_chunks = [doc.page_content for doc in documents]
+            vectors = get_embedding_store().embed_texts(text_chunks, get_embedding())
+            vectorstore.add_embeddings(
+                list(zip(text_chunks, vectors)), metadatas=[doc.metadata for doc in documents], ids=ids
+            )
+        indexed_files.update(index_files(documents, ids))
+
+    # In auto mode, switch index type once the corpus outgrows (or shrinks below) the current one
+    wanted_type = choose_index_type(len(vectorstore.index_to_docstore_id))
+    if INDEX_TYPE == "auto" and wanted_type != index_type_of(vectorstore.index):
+        needs_rebuild = True
+    if needs_rebuild and vectorstore.index_to_docstore_id:
+        with span("faiss_rebuild", vectors=len(vectorstore.index_to_docstore_id)):
+            rebuild_vectorstore(vectorstore)
+    elif needs_rebuild:
+        vectorstore.index.reset()  # Every file was removed
+
+    return len(added), len(removed)
+
+
+def indexed_chunks(vectorstore, indexed_files) -> list:
+    """Text chunks of the vector store, grouped by file in upload order."""
+    return [
+        vectorstore.docstore.search(id_).page_content
+        for entry in indexed_files.values()
+        for id_ in entry["ids"]
+    ]
+
     
 
-def get_pdf_text(pdf_docs):
-    text = ""
-    for pdf in pdf_docs:
-        pdf_reader = PdfReader(pdf)
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-    return text
+def read_pdf_bytes(pdf) -> bytes:
+    """Returns the content of an uploaded file, a path or any file-like object."""
+    if isinstance(pdf, (str, os.PathLike)):
+        with open(pdf, "rb") as f:
+            return f.read()
+    if hasattr(pdf, "getvalue"):
+        return pdf.getvalue()
+    pdf.seek(0)
+    return pdf.read()
+
+
+def extract_page_range(path, start, end) -> list:
+    """Worker: extracts the text of pages [start, end) of the PDF at `path`."""
+    pdf_reader = PdfReader(path)
+    texts = []
+    for number in range(start, end):
+        try:
+            texts.append(pdf_reader.pages[number].extract_text() or "")
+        except Exception as e:
+            print(f"Error extracting page {number + 1} of {path}: {e}")
+            texts.append("")
+    return texts
+
+
+def chunk_page_range(path, start, end, chunk_size, chunk_overlap, encoding_name):
+    """Worker: extracts pages [start, end) of the PDF at `path` and splits them, see chunking.chunk_pages."""
+    texts = extract_page_range(path, start, end)
+    return chunk_pages(enumerate(texts, start + 1), chunk_size, chunk_overlap, encoding_name)
+
+
+@lru_cache(maxsize=None)
+def pdf_worker_context():
+    """Start method of the PDF worker processes. The app starts them from a multithreaded server and
+    from job threads; a forked child could inherit a lock another thread holds (stdout, tiktoken, the
+    scheduler) and block on it forever. Workers are forked from a single-threaded forkserver that has
+    imported this module already, so they start as fast as forked ones (spawn where there's none)."""
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def run_pdf_tasks(pdf_docs, worker, worker_args=(), max_workers=PDF_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    """Runs worker(path, start, end, *worker_args) over page ranges of every PDF and yields
+    (source, file_hash, start, end, result) in document and page order.
+
+    Tasks run in a process pool. Only a bounded number of tasks is in flight at a time,
+    so memory is bounded by a window of pages, not by the whole upload.
+    """
+    tasks = []  # (source, file_hash, path, start, end)
+    tmp_paths = []
+    try:
+        for pdf in pdf_docs:
+            data = read_pdf_bytes(pdf)
+            source = os.path.basename(getattr(pdf, "name", None) or str(pdf))
+            file_hash = hashlib.sha256(data).hexdigest()
+            page_count = len(PdfReader(BytesIO(data)).pages)
+
+            # Workers read the PDF from disk instead of receiving its bytes with every task
+            fd, path = tempfile.mkstemp(suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            tmp_paths.append(path)
+            del data
+
+            for start in range(0, page_count, pages_per_task):
+                tasks.append((source, file_hash, path, start, min(start + pages_per_task, page_count)))
+
+        if max_workers <= 1 or len(tasks) <= 1:
+            for source, file_hash, path, start, end in tasks:
+                yield source, file_hash, start, end, worker(path, start, end, *worker_args)
+            return
+
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=pdf_worker_context()) as executor:
+            task_iter = iter(tasks)
+            pending = deque(
+                (task, executor.submit(worker, *task[2:], *worker_args)) for task in islice(task_iter, max_workers * 2)
+            )
+            while pending:
+                (source, file_hash, _, start, end), future = pending.popleft()
+                result = future.result()
+                for task in islice(task_iter, 1):  # Keep the pool busy while results are consumed
+                    pending.append((task, executor.submit(worker, *task[2:], *worker_args)))
+                yield source, file_hash, start, end, result
+    finally:
+        for path in tmp_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def pack_by_tokens(texts, token_budget) -> list:
+    """Groups consecutive texts so each group stays within `token_budget` (a single oversized text gets its own group)."""
+    groups, group, group_tokens = [], [], 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if group and group_tokens + tokens > token_budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(text)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
 
 def parse_questions(questions_text):
     """Parses the generated questions text into a list of dictionaries."""